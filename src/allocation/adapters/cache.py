@@ -0,0 +1,106 @@
+# Caches for the read side (views). Values must be json-serializable, so the redis backed
+# one can store them too.
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Protocol
+
+import redis
+
+from src.allocation import config
+from src.allocation.adapters.metrics import metrics
+
+_MISSING = object()
+
+
+class AbstractCache(Protocol):
+
+    def get(self, key: str, default: Any = None) -> Any:
+        ...
+
+    def set(self, key: str, value: Any):
+        ...
+
+    def invalidate(self, key: str):
+        ...
+
+
+class NullCache:
+    def get(self, key, default=None):
+        return default
+
+    def set(self, key, value):
+        pass
+
+    def invalidate(self, key):
+        pass
+
+
+class LRUCache:
+    """
+    Keeps up to maxsize entries in this process, for ttl seconds each. Only writes
+    handled by this same process invalidate it, so the ttl is what bounds how stale a
+    read can be when the writes happen elsewhere (the redis consumer, for instance).
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 10.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict[str, tuple]
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(key, None)
+                metrics.increment("views_cache_misses")
+                return default
+            self._entries.move_to_end(key)
+            metrics.increment("views_cache_hits")
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    # shared by every process, so an invalidation anywhere is seen by all readers
+    def __init__(self, client: Optional[redis.Redis] = None, ttl: float = 10.0, prefix: str = "views:"):
+        self.client = client or redis.Redis(**config.get_redis_host_and_port())
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            metrics.increment("views_cache_misses")
+            return default
+        metrics.increment("views_cache_hits")
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+
+    def invalidate(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def build_cache(backend: str = "none", ttl: float = 10.0, maxsize: int = 10_000) -> AbstractCache:
+    if backend == "redis":
+        return RedisCache(ttl=ttl)
+    if backend == "memory":
+        return LRUCache(maxsize=maxsize, ttl=ttl)
+    return NullCache()
@@ -0,0 +1,195 @@
+# Encoders and decoders for the messages that go over redis, generated once for every message
+# type when it is registered, instead of reflecting over the dataclass (asdict) on every call.
+#
+# JSON is the default and keeps the payloads as they were (dates as ISO strings). The binary
+# format is opt in (REDIS_WIRE_FORMAT=binary): a version byte and the type's tag, then the
+# numbers and string lengths packed with struct, then the strings. decode() tells the two
+# apart by their first byte (a version byte is a control character no JSON text starts with,
+# whitespace included), so consumers take both while publishers switch over.
+import json
+import struct
+import typing
+from dataclasses import dataclass, fields, MISSING
+from datetime import date
+from typing import Any, Callable, Dict, Optional, Tuple, Type, Union
+
+from src.allocation.domain import commands, events
+from src.allocation.domain.model import Message
+
+FORMAT_VERSION = 1
+_JSON_WHITESPACE = b" \t\n\r"
+
+
+class UnknownMessage(ValueError):
+    pass
+
+
+class MalformedMessage(UnknownMessage):
+    # a known channel or tag whose payload doesn't parse: truncated, missing fields, bad JSON
+    pass
+
+
+@dataclass(frozen=True)
+class Codec:
+    type: Type
+    tag: int
+    channel: Optional[str]
+    to_dict: Callable[[Any], Dict]
+    from_dict: Callable[[Dict], Any]
+    pack: Callable[[Any], bytes]  # without the version and tag
+    unpack: Callable[[Any, int], Tuple[Any, int]]  # buffer, offset -> message, next offset
+
+
+def _kind(hint) -> str:
+    if hint in (str, int, date):
+        return hint.__name__
+    if hint == Optional[date]:
+        return "date"
+    if typing.get_origin(hint) is list:
+        return "list"
+    if typing.get_origin(hint) is tuple and typing.get_args(hint)[1:] == (...,):
+        return "tuple"
+    raise TypeError(f"no codec for fields of type {hint}")
+
+
+def _generate(cls: Type, aliases: Dict[str, str], codecs: Dict[Type, Codec]) -> Dict[str, Callable]:
+    # the same kind of code dataclasses generate for __init__: plain attribute reads and a
+    # single struct call per message, no per field dispatch left at run time
+    hints = typing.get_type_hints(cls)
+    namespace = {"cls": cls, "date": date}  # type: Dict[str, Any]
+    to_dict, from_dict = [], []
+    head, strings, lists = [], [], []
+    for i, field in enumerate(fields(cls)):
+        name, key, kind = field.name, aliases.get(field.name, field.name), _kind(hints[field.name])
+        value = f"m.{name}"
+        if kind == "date":
+            to_dict.append(f"{key!r}: None if {value} is None else {value}.isoformat()")
+            read = f"d.get({key!r})"
+            from_dict.append(f"None if {read} is None else date.fromisoformat({read})")
+            head.append((i, "i", f"0 if {value} is None else {value}.toordinal()"))
+            continue
+        if kind in ("list", "tuple"):
+            item = typing.get_args(hints[name])[0]
+            namespace[f"c{i}"] = codecs[item]
+            to_dict.append(f"{key!r}: [c{i}.to_dict(x) for x in {value}]")
+            items = f"[c{i}.from_dict(x) for x in d[{key!r}]]"
+            from_dict.append(f"tuple({items})" if kind == "tuple" else items)
+            head.append((i, "I", f"len({value})"))
+            lists.append(i)
+            continue
+        to_dict.append(f"{key!r}: {value}")
+        if field.default is not MISSING:
+            namespace[f"default{i}"] = field.default
+            from_dict.append(f"d.get({key!r}, default{i})")
+        else:
+            from_dict.append(f"d[{key!r}]")
+        if kind == "int":
+            head.append((i, "q", value))
+        else:
+            head.append((i, "I", f"len(s{i})"))
+            strings.append(i)
+
+    namespace["head"] = struct.Struct(">" + "".join(fmt for _, fmt, _ in head))
+    kinds = {i: _kind(hints[field.name]) for i, field in enumerate(fields(cls))}
+    pack = ["def pack(m):"]
+    pack += [f"    s{i} = m.{fields(cls)[i].name}.encode()" for i in strings]
+    pack.append("    return b''.join([head.pack(" + ", ".join(expr for _, _, expr in head) + ")"
+                + "".join(f", s{i}" for i in strings)
+                + "".join(f", *[c{i}.pack(x) for x in m.{fields(cls)[i].name}]" for i in lists) + "])")
+    unpack = ["def unpack(b, o):",
+              f"    {''.join(f'v{i}, ' for i, _, _ in head)}= head.unpack_from(b, o)",
+              "    o += head.size"]
+    for i in strings:
+        unpack += [f"    n = v{i}", f"    v{i} = str(b[o:o + n], 'utf-8')", "    o += n"]
+    for i in lists:
+        unpack += [f"    items{i} = []",
+                   f"    for _ in range(v{i}):",
+                   f"        x, o = c{i}.unpack(b, o)",
+                   f"        items{i}.append(x)",
+                   f"    v{i} = tuple(items{i})" if kinds[i] == "tuple" else f"    v{i} = items{i}"]
+    unpack += [f"    v{i} = None if v{i} == 0 else date.fromordinal(v{i})" for i, k in kinds.items() if k == "date"]
+    unpack.append("    return cls(" + ", ".join(f"v{i}" for i in range(len(kinds))) + "), o")
+
+    source = "\n".join([
+        "def to_dict(m):",
+        "    return {" + ", ".join(to_dict) + "}",
+        "def from_dict(d):",
+        "    return cls(" + ", ".join(from_dict) + ")",
+        *pack,
+        *unpack,
+    ])
+    exec(source, namespace)
+    return {name: namespace[name] for name in ("to_dict", "from_dict", "pack", "unpack")}
+
+
+class CodecRegistry:
+    """
+    One codec per message type, found by type (to encode), by channel (to decode JSON, whose
+    payloads don't say their type) or by tag (to decode the binary format). Tags go on the
+    wire, so a type keeps its tag for good.
+    """
+
+    def __init__(self):
+        self._by_type = {}  # type: Dict[Type, Codec]
+        self._by_channel = {}  # type: Dict[str, Codec]
+        self._by_tag = {}  # type: Dict[int, Codec]
+
+    def register(self, cls: Type, tag: int, channel: Optional[str] = None,
+                 aliases: Optional[Dict[str, str]] = None) -> Codec:
+        # aliases: field name -> key in the JSON payload, for channels that name a field differently
+        if tag in self._by_tag or not 0 < tag < 256:
+            raise ValueError(f"tag {tag} is taken or not a byte")
+        codec = Codec(type=cls, tag=tag, channel=channel, **_generate(cls, aliases or {}, self._by_type))
+        self._by_type[cls] = codec
+        self._by_tag[tag] = codec
+        if channel is not None:
+            self._by_channel[channel] = codec
+        return codec
+
+    def encode(self, message: Message, binary: bool = False) -> Union[str, bytes]:
+        codec = self._by_type.get(type(message))
+        if codec is None:
+            raise UnknownMessage(f"no codec for {type(message).__name__}")
+        if binary:
+            return bytes((FORMAT_VERSION, codec.tag)) + codec.pack(message)
+        return json.dumps(codec.to_dict(message), separators=(",", ":"))
+
+    def decode(self, channel: str, payload: Union[str, bytes]) -> Message:
+        if isinstance(payload, bytes) and payload[:1] and payload[0] < 0x20 and payload[0] not in _JSON_WHITESPACE:
+            return self._decode_binary(payload)
+        codec = self._by_channel.get(channel)
+        if codec is None:
+            raise UnknownMessage(f"unknown channel {channel}")
+        try:
+            return codec.from_dict(json.loads(payload))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise MalformedMessage(f"malformed {codec.type.__name__} on {channel}: {e!r}") from e
+
+    def _decode_binary(self, payload: bytes) -> Message:
+        if payload[0] != FORMAT_VERSION:
+            raise UnknownMessage(f"unsupported format version {payload[0]}")
+        if len(payload) < 2:
+            raise MalformedMessage("binary message without a tag")
+        codec = self._by_tag.get(payload[1])
+        if codec is None:
+            raise UnknownMessage(f"unknown message tag {payload[1]}")
+        try:
+            message, end = codec.unpack(memoryview(payload), 2)
+        except (struct.error, IndexError, ValueError, OverflowError) as e:
+            raise MalformedMessage(f"malformed {codec.type.__name__}: {e!r}") from e
+        if end != len(payload):
+            raise MalformedMessage(f"{len(payload) - end} bytes left after a {codec.type.__name__}")
+        return message
+
+
+registry = CodecRegistry()
+registry.register(events.Allocated, tag=1, channel="line_allocated")
+registry.register(events.Deallocated, tag=2)
+registry.register(events.OutOfStock, tag=3)
+registry.register(commands.Allocate, tag=16, channel="allocate_line")
+registry.register(commands.ChangeBatchQuantity, tag=17, channel="change_batch_quantity", aliases={"ref": "batchref"})
+registry.register(commands.CreateBatch, tag=18)
+registry.register(commands.AllocateMany, tag=19)
+
+encode = registry.encode
+decode = registry.decode
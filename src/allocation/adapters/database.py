@@ -0,0 +1,124 @@
+# Engines and their connection pools. The pool reports how long checkouts wait and how
+# many connections are in use to the metrics registry, which is what tells whether
+# pool_size/max_overflow (and postgres' max_connections) fit the load.
+import functools
+import threading
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool
+
+from src.allocation import config
+from src.allocation.adapters.metrics import metrics
+
+
+def instrument_pool(pool: QueuePool):
+    # connections handed out and not given back yet, counted from the pool's events
+    in_use = 0
+    lock = threading.Lock()
+
+    @event.listens_for(pool, "checkout")
+    def receive_checkout(*args):
+        nonlocal in_use
+        with lock:
+            in_use += 1
+            current = in_use
+        metrics.observe("db_pool_in_use", current)
+
+    @event.listens_for(pool, "checkin")
+    def receive_checkin(*args):
+        nonlocal in_use
+        with lock:
+            in_use -= 1
+
+    @event.listens_for(pool, "connect")
+    def receive_connect(*args):
+        metrics.increment("db_pool_connections_opened")
+
+
+def instrument_checkouts(engine: Engine):
+    # the sessions (sync and async) get their connections through engine.connect(), so
+    # timing it times the wait for the pool, plus opening a connection when it has to
+    connect = engine.connect
+
+    @functools.wraps(connect)
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return connect()
+        except exc.TimeoutError:
+            metrics.increment("db_pool_checkout_timeouts")
+            raise
+        finally:
+            metrics.observe("db_pool_checkout_wait_seconds", time.perf_counter() - start)
+
+    engine.connect = timed_connect  # type: ignore[method-assign]
+
+
+def instrument(engine: Engine):
+    if isinstance(engine.pool, QueuePool):
+        instrument_pool(engine.pool)
+    instrument_checkouts(engine)
+
+
+def pool_options(settings: Dict) -> Dict:
+    return dict(
+        pool_size=settings["pool_size"],
+        max_overflow=settings["max_overflow"],
+        pool_timeout=settings["pool_timeout"],
+        pool_pre_ping=settings["pool_pre_ping"],
+        pool_recycle=settings["pool_recycle"],
+    )
+
+
+def build_engine(uri: str, settings: Dict, isolation_level: str = "REPEATABLE READ",
+                 read_only: bool = False) -> Engine:
+    connect_args = {}
+    if settings["statement_timeout_ms"]:
+        connect_args["options"] = f"-c statement_timeout={settings['statement_timeout_ms']}"
+    engine = create_engine(
+        uri,
+        isolation_level=isolation_level,
+        poolclass=QueuePool,
+        connect_args=connect_args,
+        # SET TRANSACTION READ ONLY on postgres, ignored by other dialects
+        execution_options={"postgresql_readonly": True} if read_only else {},
+        **pool_options(settings),
+    )
+    instrument(engine)
+    return engine
+
+
+def build_async_engine(uri: str, settings: Dict, isolation_level: str = "REPEATABLE READ") -> AsyncEngine:
+    connect_args = {}
+    if settings["statement_timeout_ms"]:
+        connect_args["server_settings"] = {"statement_timeout": str(settings["statement_timeout_ms"])}
+    engine = create_async_engine(
+        uri,
+        isolation_level=isolation_level,
+        connect_args=connect_args,
+        **pool_options(settings),
+    )
+    instrument(engine.sync_engine)
+    return engine
+
+
+@functools.lru_cache(maxsize=None)
+def default_engine() -> Engine:
+    # one pool per process, shared by every unit of work built without a session factory
+    return build_engine(config.get_postgres_uri(), config.get_db_pool_settings())
+
+
+@functools.lru_cache(maxsize=None)
+def default_read_engine() -> Engine:
+    # queries only see committed data anyway, so READ COMMITTED is enough (and a replica can serve it)
+    return build_engine(config.get_replica_postgres_uri(), config.get_db_pool_settings(),
+                        isolation_level="READ COMMITTED", read_only=True)
+
+
+@functools.lru_cache(maxsize=None)
+def default_async_engine() -> AsyncEngine:
+    return build_async_engine(config.get_async_postgres_uri(), config.get_db_pool_settings())
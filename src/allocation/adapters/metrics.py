@@ -0,0 +1,55 @@
+# A small in-process metrics registry: counters and summaries (count/sum/max) that the
+# adapters update and that can be dumped as a dict, e.g. by an entrypoint or a benchmark.
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict
+
+
+@dataclass
+class Summary:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)  # type: Dict[str, int]
+        self.summaries = defaultdict(Summary)  # type: Dict[str, Summary]
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self.summaries[name].observe(value)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(
+                counters=dict(self.counters),
+                summaries={
+                    name: dict(count=s.count, sum=s.total, max=s.max, mean=s.mean)
+                    for name, s in self.summaries.items()
+                },
+            )
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.summaries.clear()
+
+
+metrics = Metrics()
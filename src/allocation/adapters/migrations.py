@@ -0,0 +1,91 @@
+# Brings an existing database up to the current schema in orm.py. There are no versioned
+# migrations here: every step checks what is already there, so upgrade() can run on every
+# deploy. On postgres the indexes are built CONCURRENTLY, without locking writes.
+#   python -m src.allocation.adapters.migrations
+import logging
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Engine
+
+from src.allocation import config
+from src.allocation.adapters import orm
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    "ix_order_lines_orderid_sku": ("order_lines", "orderid, sku"),
+    "ix_batches_reference": ("batches", "reference"),
+    "ix_batches_sku": ("batches", "sku"),
+    "ix_allocations_orderline_id": ("allocations", "orderline_id"),
+    "ix_allocations_batch_id": ("allocations", "batch_id"),
+}
+VIEW_KEY = "uq_allocations_view_orderid_sku"
+
+
+def upgrade(engine: Engine):
+    # new tables only, create_all leaves existing ones alone
+    orm.metadata.create_all(engine)
+    postgres = engine.dialect.name == "postgresql"
+    concurrently = "CONCURRENTLY " if postgres else ""
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        existing = {
+            index["name"]
+            for table in {table for table, _ in INDEXES.values()} | {"allocations_view"}
+            for index in inspect(conn).get_indexes(table)
+        } | {
+            constraint["name"]
+            for constraint in inspect(conn).get_unique_constraints("allocations_view")
+        }
+
+        for name, (table, columns) in INDEXES.items():
+            if name not in existing:
+                logger.info("creating index %s", name)
+                conn.execute(text(f"CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({columns})"))
+
+        if VIEW_KEY not in existing:
+            logger.info("adding %s", VIEW_KEY)
+            # keep the latest row of each (orderid, sku) the old inserts duplicated
+            if postgres:
+                conn.execute(text(
+                    "DELETE FROM allocations_view a USING allocations_view b"
+                    " WHERE a.orderid = b.orderid AND a.sku = b.sku AND a.ctid < b.ctid"
+                ))
+            else:
+                conn.execute(text(
+                    "DELETE FROM allocations_view WHERE rowid NOT IN"
+                    " (SELECT MAX(rowid) FROM allocations_view GROUP BY orderid, sku)"
+                ))
+            conn.execute(text(
+                f"CREATE UNIQUE INDEX {concurrently}IF NOT EXISTS {VIEW_KEY} ON allocations_view (orderid, sku)"
+            ))
+            if postgres:
+                conn.execute(text(
+                    f"ALTER TABLE allocations_view ADD CONSTRAINT {VIEW_KEY} UNIQUE USING INDEX {VIEW_KEY}"
+                ))
+
+        if postgres:
+            nullable = [
+                column["name"] for column in inspect(conn).get_columns("allocations_view")
+                if column["name"] in ("orderid", "sku") and column["nullable"]
+            ]
+            if nullable:
+                # the view's key, as orm.py declares it; a row missing either is never read
+                logger.info("making allocations_view.%s NOT NULL", ", ".join(nullable))
+                conn.execute(text("DELETE FROM allocations_view WHERE orderid IS NULL OR sku IS NULL"))
+                for column in nullable:
+                    conn.execute(text(f"ALTER TABLE allocations_view ALTER COLUMN {column} SET NOT NULL"))
+
+        if postgres and "id" not in {column["name"] for column in inspect(conn).get_columns("allocations_view")}:
+            # sqlite can't add a primary key to an existing table; there it only gets the unique key
+            logger.info("adding allocations_view.id")
+            conn.execute(text("ALTER TABLE allocations_view ADD COLUMN id SERIAL PRIMARY KEY"))
+
+        if "claimed_until" not in {column["name"] for column in inspect(conn).get_columns("event_retries")}:
+            logger.info("adding event_retries.claimed_until")
+            conn.execute(text("ALTER TABLE event_retries ADD COLUMN claimed_until FLOAT"))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    upgrade(create_engine(config.get_postgres_uri()))
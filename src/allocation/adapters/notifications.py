@@ -1,3 +1,4 @@
+import asyncio
 import smtplib
 from typing import Protocol
 
@@ -12,6 +13,11 @@ class NotificationsService(Protocol):
         ...
 
 
+class AsyncNotificationsService(Protocol):
+    async def send(self, destination, message):
+        ...
+
+
 class EmailNotifications:
     def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
         self.server = smtplib.SMTP(smtp_host, port=port)
@@ -24,3 +30,15 @@ class EmailNotifications:
             to_addrs=[destination],
             msg=msg,
         )
+
+
+class AsyncEmailNotifications:
+    # smtplib has no async api: the blocking send runs in a worker thread so the event loop
+    # keeps going, and the lock stops two sends from sharing the smtp connection at once
+    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.email = EmailNotifications(smtp_host, port)
+        self.lock = asyncio.Lock()
+
+    async def send(self, destination, message):
+        async with self.lock:
+            await asyncio.to_thread(self.email.send, destination, message)
@@ -1,4 +1,7 @@
-from sqlalchemy import Table, MetaData, Column, Integer, String, Date, ForeignKey, event
+from collections import deque
+
+from sqlalchemy import Table, MetaData, Column, Integer, String, Date, DateTime, Float, Text, ForeignKey, Index, \
+    UniqueConstraint, event, func
 from sqlalchemy.orm import registry, relationship
 
 from src.allocation.domain import model
@@ -14,6 +17,7 @@ order_lines = Table(
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
 )
+Index("ix_order_lines_orderid_sku", order_lines.c.orderid, order_lines.c.sku)
 
 version_number_column = Column("version_id_col", Integer, nullable=False, server_default="0")
 products = Table(
@@ -27,8 +31,8 @@ batches = Table(
     "batches",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("reference", String(255)),
-    Column("sku", ForeignKey("products.sku")),
+    Column("reference", String(255), index=True),  # get_by_batchref
+    Column("sku", ForeignKey("products.sku"), index=True),  # loading a product's batches
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
 )
@@ -37,17 +41,60 @@ allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("orderline_id", ForeignKey("order_lines.id")),
-    Column("batch_id", ForeignKey("batches.id")),
+    Column("orderline_id", ForeignKey("order_lines.id"), index=True),
+    Column("batch_id", ForeignKey("batches.id"), index=True),
 )
 
 # sem FK's YOLO
+# (but a key: one row per order line, and its index serves the "WHERE orderid" lookups as well)
 allocations_view = Table(
     "allocations_view",
     metadata,
-    Column("orderid", String(255)),
-    Column("sku", String(255)),
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
     Column("batchref", String(255)),
+    UniqueConstraint("orderid", "sku", name="uq_allocations_view_orderid_sku"),
+)
+
+# events to publish, written in the same transaction as the change that raised them and
+# relayed to redis by entrypoints/outbox_relay.py
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("created_at", DateTime, nullable=False, server_default=func.now()),
+    Column("published_at", DateTime, nullable=True),
+)
+Index("ix_outbox_unpublished", outbox.c.id, postgresql_where=outbox.c.published_at.is_(None))
+
+# event handlers that failed and are waiting for another attempt (see service_layer/retries.py)
+event_retries = Table(
+    "event_retries",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("handler", String(255), nullable=False),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("attempt", Integer, nullable=False),
+    Column("due_at", Float, nullable=False, index=True),
+    Column("last_error", Text),
+    Column("claimed_until", Float),  # epoch seconds, set while a scheduler runs it
+)
+
+# ... and the ones that ran out of attempts
+dead_letters = Table(
+    "dead_letters",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("handler", String(255), nullable=False),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("last_error", Text),
+    Column("failed_at", DateTime, nullable=False, server_default=func.now()),
 )
 
 
@@ -69,9 +116,41 @@ def start_mappers():
         products,
         properties={"batches": relationship(batches_mapper),
                     "version_id_col": version_number_column},
+        # the domain bumps the version itself; the UPDATE only matches the version we read,
+        # so a concurrent change shows up as a StaleDataError instead of a lost update
+        version_id_col=version_number_column,
+        version_id_generator=False,
     )
 
 
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
-    product.messages = []
+    product.messages = deque()
+    product._batches_by_eta = None
+    product._batches_by_line = None
+    product._lines_by_order = None
+
+
+@event.listens_for(model.Product, "expire")
+def receive_expire(product, attrs):
+    # batches will be reloaded from the db, so the eta ordering must be rebuilt too
+    # (product is None when the instance was already garbage collected)
+    if product is not None and (attrs is None or "batches" in attrs):
+        product._batches_by_eta = None
+        product._batches_by_line = None
+        product._lines_by_order = None
+
+
+@event.listens_for(model.Batch, "load")
+def receive_batch_load(batch, _):
+    batch._allocated_quantity = None
+    batch._lines_by_order = None
+
+
+@event.listens_for(model.Batch, "expire")
+def receive_batch_expire(batch, attrs):
+    # _allocations will be reloaded from the db, so the running total and the order index
+    # have to be recomputed
+    if batch is not None and (attrs is None or "_allocations" in attrs):
+        batch._allocated_quantity = None
+        batch._lines_by_order = None
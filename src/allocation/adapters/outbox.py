@@ -0,0 +1,77 @@
+# Transactional outbox: the events other systems care about are stored in the "outbox" table
+# by the same commit that changed the aggregate, so they can't be lost between the commit
+# and a publish. OutboxRelay pushes them to redis afterwards, outside of any request.
+import logging
+from typing import Dict, Type, Iterable, List, TypeGuard
+
+from sqlalchemy import select, update, delete, func
+
+from src.allocation.adapters import orm, codecs
+from src.allocation.adapters.redis_eventpublisher import AbstractPublisher
+from src.allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+CHANNELS = {
+    events.Allocated: "line_allocated",
+}  # type: Dict[Type[events.Event], str]
+
+
+def is_published(message) -> TypeGuard[events.Event]:
+    return type(message) in CHANNELS
+
+
+def rows_for(messages: Iterable[events.Event]) -> List[Dict]:
+    return [
+        # always JSON, the payload column is text
+        dict(channel=CHANNELS[type(message)], payload=codecs.encode(message))
+        for message in messages
+    ]
+
+
+class OutboxRelay:
+    """
+    Moves unpublished outbox rows to redis, batch_size at a time.
+
+    Rows are claimed with FOR UPDATE SKIP LOCKED and marked published_at in the same
+    transaction, after the publisher was flushed. So the relay's position lives in the
+    table itself and survives a crash: whatever wasn't marked is sent again on restart
+    (at least once delivery). A plain "last id" cursor would skip rows from transactions
+    that commit out of id order.
+    """
+
+    def __init__(self, session_factory, publisher: AbstractPublisher, batch_size: int = 500):
+        self.session_factory = session_factory
+        self.publisher = publisher
+        self.batch_size = batch_size
+
+    def relay_once(self) -> int:
+        with self.session_factory() as session:
+            rows = session.execute(
+                select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload)
+                .where(orm.outbox.c.published_at.is_(None))
+                .order_by(orm.outbox.c.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                return 0
+            for row in rows:
+                self.publisher.publish(row.channel, row.payload)
+            self.publisher.flush()
+            session.execute(
+                update(orm.outbox)
+                .where(orm.outbox.c.id.in_([row.id for row in rows]))
+                .values(published_at=func.now())
+            )
+            session.commit()
+        logger.debug("relayed %s outbox rows", len(rows))
+        return len(rows)
+
+    def prune(self, published_before):
+        with self.session_factory() as session:
+            session.execute(
+                delete(orm.outbox)
+                .where(orm.outbox.c.published_at < published_before)
+            )
+            session.commit()
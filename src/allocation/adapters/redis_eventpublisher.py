@@ -1,17 +1,98 @@
-import json
-from dataclasses import asdict
+import threading
+import time
+from typing import List, Tuple, Union, Protocol, Optional
 
 import redis
 import logging
 
 from src.allocation import config
+from src.allocation.adapters import codecs
+from src.allocation.adapters.metrics import metrics
 from src.allocation.domain import events
 
-r = redis.Redis(**config.get_redis_host_and_port())
+# one pool per process, shared by every client created here
+pool = redis.ConnectionPool(**config.get_redis_host_and_port(), **config.get_redis_pool_settings())
+r = redis.Redis(connection_pool=pool)
+binary = config.get_redis_publisher_settings()["binary"]
 
 logger = logging.getLogger(__name__)
 
 
 def publish(channel, event: events.Event):
     logging.debug("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    r.publish(channel, codecs.encode(event, binary))
+
+
+def publish_to_stream(stream, event: events.Event, maxlen: Optional[int] = None):
+    # unlike a channel, a stream keeps the message until a consumer group acks it
+    logging.debug("adding to stream: stream=%s, event=%s", stream, event)
+    r.xadd(stream, {"data": codecs.encode(event, binary)}, maxlen=maxlen, approximate=True)
+
+
+class AbstractPublisher(Protocol):
+
+    def publish(self, channel: str, message: Union[events.Event, str, bytes]):
+        ...
+
+    def flush(self):
+        ...
+
+
+class BatchingPublisher:
+    """
+    Buffers messages and sends them through one redis pipeline (a single round trip)
+    once max_batch_size of them are waiting, or when one has waited for max_delay
+    seconds by the time the next one arrives. Whoever needs them out at a given point
+    (e.g. before committing that they were published) calls flush(). A batch redis didn't
+    take is dropped, and the error goes to whoever triggered the flush: the outbox relay
+    selects those rows again, a failed event handler is retried.
+
+    With streams=True every channel is a stream instead (XADD, trimmed to about
+    stream_maxlen entries), for consumers that read them through a consumer group.
+    """
+
+    def __init__(self, client: Optional[redis.Redis] = None, max_batch_size: int = 100, max_delay: float = 0.05,
+                 streams: bool = False, stream_maxlen: Optional[int] = 100_000, binary: bool = False):
+        self.client = client or r
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.streams = streams
+        self.stream_maxlen = stream_maxlen
+        self.binary = binary
+        self._buffer = []  # type: List[Tuple[str, Union[str, bytes]]]
+        self._oldest = 0.0  # monotonic time the first buffered message arrived
+        self._lock = threading.Lock()
+
+    def publish(self, channel: str, message: Union[events.Event, str, bytes]):
+        # outbox rows arrive already serialized
+        payload = message if isinstance(message, (str, bytes)) else codecs.encode(message, self.binary)
+        with self._lock:
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append((channel, payload))
+            if len(self._buffer) >= self.max_batch_size or time.monotonic() - self._oldest >= self.max_delay:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        # kept, the batch would be sent again along with the copies its senders send again
+        batch, self._buffer = self._buffer, []
+        start = time.perf_counter()
+        pipe = self.client.pipeline(transaction=False)
+        for channel, payload in batch:
+            if self.streams:
+                pipe.xadd(channel, {"data": payload}, maxlen=self.stream_maxlen, approximate=True)
+            else:
+                pipe.publish(channel, payload)
+        pipe.execute()
+        metrics.observe("redis_publish_batch_size", len(batch))
+        metrics.observe("redis_publish_flush_seconds", time.perf_counter() - start)
+        logger.debug("published %s messages", len(batch))
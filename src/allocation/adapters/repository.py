@@ -1,7 +1,16 @@
 import functools
-from typing import Set, Callable, Any, Iterable, Collection, Protocol
+import inspect
+import threading
+from collections import OrderedDict
+from typing import Set, Callable, Any, Iterable, Collection, Protocol, Optional, Dict, List, Mapping, Iterator, \
+    TypeVar, cast
+
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload, joinedload, lazyload, class_mapper
+from sqlalchemy.orm.attributes import instance_state
 
 from src.allocation.adapters import orm
+from src.allocation.adapters.metrics import metrics
 from src.allocation.domain import model
 
 
@@ -17,9 +26,43 @@ class AbstractProductRepository(Protocol):
     def get(self, sku: str) -> model.Product:
         ...
 
+    def get_by_batchref(self, batchref: str) -> model.Product:
+        ...
+
+    def get_many(self, skus: Iterable[str]) -> List[model.Product]:
+        ...
+
+    def get_many_by_batchrefs(self, batchrefs: Iterable[str]) -> Dict[str, model.Product]:
+        ...
+
+    def iter_products(self, chunk_size: int = 500) -> Iterator[model.Product]:
+        ...
+
+
+class AbstractAsyncProductRepository(Protocol):
+    tracked: Set[model.Product]
+
+    async def add(self, product: model.Product):
+        ...
+
+    async def get(self, sku: str) -> model.Product:
+        ...
+
+    async def get_by_batchref(self, batchref: str) -> model.Product:
+        ...
+
+    async def get_many(self, skus: Iterable[str]) -> List[model.Product]:
+        ...
+
+    async def get_many_by_batchrefs(self, batchrefs: Iterable[str]) -> Dict[str, model.Product]:
+        ...
+
 
 # https://stackoverflow.com/questions/6307761/how-to-decorate-all-functions-of-a-class-without-typing-it-over-and-over-for-eac
 
+# the decorated method keeps its own signature, sync or async
+RepositoryMethod = TypeVar("RepositoryMethod", bound=Callable[..., Any])
+
 def check_tracked_entity_in_args(tracker: set, args: Iterable):
     for arg in args:
         check_for_tracked_entity(tracker, arg)
@@ -32,8 +75,19 @@ def check_for_tracked_entity(tracker: set, arg: model.Product | Iterable[model.P
         tracker.update(arg)
 
 
-def track_entity(func: Callable[[AbstractProductRepository, model.Product | Collection[model.Product]], None]
-                       | Callable[[Any], model.Product | Collection[model.Product]]) -> Callable:
+def track_entity(func: RepositoryMethod) -> RepositoryMethod:
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper_track_entity(self, *args, **kwargs):
+            check_tracked_entity_in_args(self.tracked, args)
+            check_tracked_entity_in_args(self.tracked, kwargs.values())
+            result = await func(self, *args, **kwargs)
+            if result:
+                check_for_tracked_entity(self.tracked, result)
+            return result
+
+        return cast(RepositoryMethod, async_wrapper_track_entity)
+
     @functools.wraps(func)
     def wrapper_track_entity(self, *args, **kwargs):
         check_tracked_entity_in_args(self.tracked, args)
@@ -43,13 +97,78 @@ def track_entity(func: Callable[[AbstractProductRepository, model.Product | Coll
             check_for_tracked_entity(self.tracked, result)
         return result
 
-    return wrapper_track_entity
+    return cast(RepositoryMethod, wrapper_track_entity)
+
+
+def track_entities(func: RepositoryMethod) -> RepositoryMethod:
+    # for methods that always return products, a list of them or a dict whose values are
+    # them: they are tracked as they are, without checking every item like track_entity
+    def track(tracker: set, result):
+        tracker.update(result.values() if isinstance(result, Mapping) else result)
+        return result
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper_track_entities(self, *args, **kwargs):
+            return track(self.tracked, await func(self, *args, **kwargs))
+
+        return cast(RepositoryMethod, async_wrapper_track_entities)
+
+    @functools.wraps(func)
+    def wrapper_track_entities(self, *args, **kwargs):
+        return track(self.tracked, func(self, *args, **kwargs))
+
+    return cast(RepositoryMethod, wrapper_track_entities)
+
+
+def chunks(values: Iterable[str], size: int = 1000) -> Iterable[List[str]]:
+    # keeps every IN (...) under the drivers' limits on bound parameters
+    values = list(dict.fromkeys(values))
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def by_batchref(products: Iterable[model.Product], batchrefs: Collection[str]) -> Dict[str, model.Product]:
+    return {
+        batch.reference: product
+        for product in products
+        for batch in product.batches
+        if batch.reference in batchrefs
+    }
+
+
+LOADERS = {
+    "selectin": selectinload,  # one extra SELECT ... WHERE IN per relationship
+    "joined": joinedload,  # everything in the product's own query
+    "lazy": lazyload,  # a SELECT per batch when it's touched (the mapper's default)
+}
+
+
+def product_load_options(strategy: str = "selectin"):
+    # allocating touches every batch and every batch's allocations, so loading them with the
+    # product keeps the number of queries constant instead of one per batch
+    loader = LOADERS[strategy]
+    # the attributes the mappers put on the classes, the domain model only has them on instances
+    batches = class_mapper(model.Product).relationships["batches"].class_attribute
+    allocations = class_mapper(model.Batch).relationships["_allocations"].class_attribute
+    return (loader(batches).options(loader(allocations)),)
 
 
 class SqlAlchemyProductRepository:
-    def __init__(self, session):
+    # how each method loads the products' batches and allocations, see LOADERS
+    loading = {
+        "get": "selectin",
+        "get_by_batchref": "selectin",
+        "list": "selectin",
+        "get_many": "selectin",
+        "get_many_by_batchrefs": "selectin",
+        "iter_products": "selectin",
+    }  # type: Dict[str, str]
+
+    def __init__(self, session, loading: Optional[Dict[str, str]] = None):
         self.session = session
         self.tracked = set()  # type: Set[model.Product]
+        self.loading = {**self.loading, **(loading or {})}
 
     @track_entity
     def add(self, product: model.Product):
@@ -57,11 +176,40 @@ class SqlAlchemyProductRepository:
 
     @track_entity
     def get(self, sku: str) -> model.Product:
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        return (
+            self.session.query(model.Product)
+            .filter_by(sku=sku)
+            .options(*product_load_options(self.loading["get"]))
+            .first()
+        )
 
-    @track_entity
+    @track_entities
     def list(self) -> Collection[model.Product]:
-        return self.session.query(model.Product).all()
+        return self.session.query(model.Product).options(*product_load_options(self.loading["list"])).all()
+
+    @track_entities
+    def get_many(self, skus: Iterable[str]) -> List[model.Product]:
+        return [
+            product
+            for chunk in chunks(skus)
+            for product in self.session.query(model.Product)
+            .filter(orm.products.c.sku.in_(chunk))
+            .options(*product_load_options(self.loading["get_many"]))
+        ]
+
+    @track_entities
+    def get_many_by_batchrefs(self, batchrefs: Iterable[str]) -> Dict[str, model.Product]:
+        # batchref -> its product; refs that don't exist are left out
+        batchrefs = set(batchrefs)
+        products = {
+            product
+            for chunk in chunks(batchrefs)
+            for product in self.session.query(model.Product)
+            .join(model.Batch)
+            .filter(orm.batches.c.reference.in_(chunk))
+            .options(*product_load_options(self.loading["get_many_by_batchrefs"]))
+        }
+        return by_batchref(products, batchrefs)
 
     @track_entity
     def get_by_batchref(self, batchref: str) -> model.Product:
@@ -69,5 +217,163 @@ class SqlAlchemyProductRepository:
             self.session.query(model.Product)
             .join(model.Batch)
             .filter(orm.batches.c.reference == batchref)
+            .options(*product_load_options(self.loading["get_by_batchref"]))
             .first()
         )
+
+    def iter_products(self, chunk_size: int = 500) -> Iterator[model.Product]:
+        """
+        Every product, in sku order, loaded chunk_size at a time (keyset pagination on
+        the sku, so each chunk is an index range scan however far along we are).
+
+        Memory stays bounded by a chunk: when the next one is fetched, the previous one is
+        flushed and detached from the session, and only its products with events still to
+        be collected stay tracked. Change a product before asking for the next one, changes
+        to a detached product aren't saved.
+        """
+        last_sku = None
+        while True:
+            query = self.session.query(model.Product)
+            if last_sku is not None:
+                query = query.filter(orm.products.c.sku > last_sku)
+            chunk = (
+                query.order_by(orm.products.c.sku)
+                .options(*product_load_options(self.loading["iter_products"]))
+                .limit(chunk_size)
+                .all()
+            )
+            if not chunk:
+                return
+            self.tracked.update(chunk)
+            yield from chunk
+            last_sku = chunk[-1].sku
+            self._release(chunk)
+
+    def _release(self, products: List[model.Product]):
+        self.session.flush()
+        for product in products:
+            # expunge doesn't cascade through the mappings, so the batches and lines go one by one
+            for batch in product.batches:
+                for line in batch._allocations:
+                    self.session.expunge(line)
+                self.session.expunge(batch)
+            self.session.expunge(product)
+            if not product.messages:
+                self.tracked.discard(product)
+
+
+class ProductCache:
+    """
+    Products kept, with their batches and allocations, between units of work, detached
+    from any session. A unit of work takes a product out (so no other thread can touch it
+    meanwhile) and gives it back after committing it, once its events were collected.
+    Holds up to maxsize products, the least recently used ones go first.
+    """
+
+    def __init__(self, maxsize: int = 100):
+        self.maxsize = maxsize
+        self._products = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._lock = threading.Lock()
+
+    def take(self, sku: str) -> Optional[model.Product]:
+        with self._lock:
+            return self._products.pop(sku, None)
+
+    def give_back(self, product: model.Product):
+        state = instance_state(product)
+        if product.messages or state.expired_attributes or state.modified:
+            # rolled back, expired by a commit, or not done with: it'd need reloading anyway
+            return
+        with self._lock:
+            cached = self._products.get(product.sku)
+            if cached is not None and cached.version_id_col > product.version_id_col:
+                return
+            self._products[product.sku] = product
+            self._products.move_to_end(product.sku)
+            while len(self._products) > self.maxsize:
+                self._products.popitem(last=False)
+
+    def __len__(self):
+        return len(self._products)
+
+
+class CachingProductRepository(SqlAlchemyProductRepository):
+    # get() reuses a cached product if its version is still the one in the database: one
+    # single-row query instead of loading the product, its batches and their allocations
+
+    def __init__(self, session, cache: ProductCache, loading: Optional[Dict[str, str]] = None):
+        super().__init__(session, loading)
+        self.cache = cache
+
+    @track_entity
+    def get(self, sku: str) -> model.Product:
+        product = self.cache.take(sku)
+        if product is None:
+            metrics.increment("product_cache_misses")
+        elif self._is_current(product):
+            metrics.increment("product_cache_hits")
+            self.session.add(product)
+            return product
+        else:
+            metrics.increment("product_cache_stale")
+        return super().get(sku)
+
+    def _is_current(self, product: model.Product) -> bool:
+        if self.session.identity_map.get(self.session.identity_key(model.Product, product.sku)) is not None:
+            return False  # this session already has its own copy
+        version = self.session.execute(
+            select(orm.products.c.version_id_col).where(orm.products.c.sku == product.sku)
+        ).scalar()
+        return version == product.version_id_col
+
+
+class AsyncSqlAlchemyProductRepository:
+    # AsyncSession can't lazy load, so batches and their allocations always come with the product
+    def __init__(self, session):
+        self.session = session
+        self.tracked = set()  # type: Set[model.Product]
+
+    @track_entity
+    async def add(self, product: model.Product):
+        self.session.add(product)
+
+    @track_entity
+    async def get(self, sku: str) -> model.Product:
+        result = await self.session.execute(
+            select(model.Product).filter_by(sku=sku).options(*product_load_options())
+        )
+        return result.scalars().first()
+
+    @track_entity
+    async def get_by_batchref(self, batchref: str) -> model.Product:
+        result = await self.session.execute(
+            select(model.Product)
+            .join(model.Batch)
+            .filter(orm.batches.c.reference == batchref)
+            .options(*product_load_options())
+        )
+        return result.scalars().first()
+
+    @track_entities
+    async def get_many(self, skus: Iterable[str]) -> List[model.Product]:
+        products = []
+        for chunk in chunks(skus):
+            result = await self.session.execute(
+                select(model.Product).filter(orm.products.c.sku.in_(chunk)).options(*product_load_options())
+            )
+            products.extend(result.scalars())
+        return products
+
+    @track_entities
+    async def get_many_by_batchrefs(self, batchrefs: Iterable[str]) -> Dict[str, model.Product]:
+        batchrefs = set(batchrefs)
+        products = set()
+        for chunk in chunks(batchrefs):
+            result = await self.session.execute(
+                select(model.Product)
+                .join(model.Batch)
+                .filter(orm.batches.c.reference.in_(chunk))
+                .options(*product_load_options())
+            )
+            products.update(result.unique().scalars())
+        return by_batchref(products, batchrefs)
@@ -0,0 +1,149 @@
+import heapq
+import itertools
+import json
+import threading
+from dataclasses import dataclass, asdict
+from typing import List, Optional, Protocol
+
+from sqlalchemy import select, delete, insert, update, or_
+
+from src.allocation.adapters import orm
+from src.allocation.domain import events
+
+
+@dataclass
+class FailedEvent:
+    event: events.Event
+    handler: str  # handler __name__, resolved again by the message bus
+    attempt: int  # attempts made so far
+    due_at: float = 0.0  # epoch seconds
+    error: str = ""
+    id: Optional[int] = None  # its row, while a scheduler holds it
+
+
+class AbstractRetryStore(Protocol):
+    def add(self, failed: FailedEvent):
+        ...
+
+    def claim_due(self, now: float, limit: int = 100, lease: float = 60.0) -> List[FailedEvent]:
+        ...
+
+    def done(self, failed: FailedEvent):
+        ...
+
+    def dead_letter(self, failed: FailedEvent):
+        ...
+
+
+class InMemoryRetryStore:
+    # a heap ordered by due time; lost on restart, see SqlAlchemyRetryStore for that
+    def __init__(self):
+        self._heap = []  # type: List
+        self._counter = itertools.count()  # tie breaker, events aren't comparable
+        self._lock = threading.Lock()
+        self.dead_letters = []  # type: List[FailedEvent]
+
+    def add(self, failed: FailedEvent):
+        with self._lock:
+            heapq.heappush(self._heap, (failed.due_at, next(self._counter), failed))
+
+    def claim_due(self, now: float, limit: int = 100, lease: float = 60.0) -> List[FailedEvent]:
+        # nothing outlives this process to take them over, so they just leave the heap
+        due = []  # type: List[FailedEvent]
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due) < limit:
+                due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def done(self, failed: FailedEvent):
+        pass
+
+    def dead_letter(self, failed: FailedEvent):
+        with self._lock:
+            self.dead_letters.append(failed)
+
+    def __len__(self):
+        return len(self._heap)
+
+
+def serialize_event(event: events.Event) -> str:
+    return json.dumps(asdict(event))
+
+
+def deserialize_event(event_type: str, payload: str) -> events.Event:
+    return getattr(events, event_type)(**json.loads(payload))
+
+
+class SqlAlchemyRetryStore:
+    # survives restarts and can be shared by several processes. A claimed row stays in the
+    # table until its handler succeeds, is rescheduled or is dead lettered: if the scheduler
+    # dies in between, another one claims it again once the lease runs out
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+
+    def add(self, failed: FailedEvent):
+        retries = orm.event_retries
+        with self.session_factory() as session:
+            if failed.id is None:
+                session.execute(insert(retries).values(
+                    handler=failed.handler,
+                    event_type=type(failed.event).__name__,
+                    payload=serialize_event(failed.event),
+                    attempt=failed.attempt,
+                    due_at=failed.due_at,
+                    last_error=failed.error,
+                ))
+            else:
+                session.execute(update(retries).where(retries.c.id == failed.id).values(
+                    attempt=failed.attempt,
+                    due_at=failed.due_at,
+                    last_error=failed.error,
+                    claimed_until=None,
+                ))
+            session.commit()
+
+    def claim_due(self, now: float, limit: int = 100, lease: float = 60.0) -> List[FailedEvent]:
+        retries = orm.event_retries
+        with self.session_factory() as session:
+            rows = session.execute(
+                select(retries)
+                .where(retries.c.due_at <= now)
+                .where(or_(retries.c.claimed_until.is_(None), retries.c.claimed_until <= now))
+                .order_by(retries.c.due_at)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if rows:
+                session.execute(
+                    update(retries).where(retries.c.id.in_([row.id for row in rows])).values(claimed_until=now + lease)
+                )
+            session.commit()
+        return [
+            FailedEvent(
+                event=deserialize_event(row.event_type, row.payload),
+                handler=row.handler,
+                attempt=row.attempt,
+                due_at=row.due_at,
+                error=row.last_error or "",
+                id=row.id,
+            )
+            for row in rows
+        ]
+
+    def done(self, failed: FailedEvent):
+        with self.session_factory() as session:
+            session.execute(delete(orm.event_retries).where(orm.event_retries.c.id == failed.id))
+            session.commit()
+
+    def dead_letter(self, failed: FailedEvent):
+        with self.session_factory() as session:
+            session.execute(insert(orm.dead_letters).values(
+                handler=failed.handler,
+                event_type=type(failed.event).__name__,
+                payload=serialize_event(failed.event),
+                attempts=failed.attempt,
+                last_error=failed.error,
+            ))
+            if failed.id is not None:
+                session.execute(delete(orm.event_retries).where(orm.event_retries.c.id == failed.id))
+            session.commit()
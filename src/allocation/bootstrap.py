@@ -1,12 +1,26 @@
+import functools
 import inspect
-from typing import Callable
+import threading
+from typing import Callable, Optional, Type, Union, cast, overload
 
-from src.allocation.adapters.notifications import EmailNotifications, NotificationsService
-from src.allocation.service_layer.unit_of_work import AbstractUnitOfWork, SqlAlchemyUnitOfWork
-from src.allocation.service_layer.messagebus import AbstractMessageBus, MessageBus
-from src.allocation.service_layer import handlers
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+from src.allocation.adapters.notifications import EmailNotifications, AsyncEmailNotifications, NotificationsService, \
+    AsyncNotificationsService
+from src.allocation.service_layer.unit_of_work import AbstractUnitOfWork, SqlAlchemyUnitOfWork, \
+    AbstractAsyncUnitOfWork, AsyncSqlAlchemyUnitOfWork, ReadOnlyUnitOfWork
+from src.allocation.service_layer.messagebus import MessageBus, AsyncMessageBus
+from src.allocation.service_layer import handlers, async_handlers
+from src.allocation.service_layer.retries import RetryScheduler, RetryPolicy
+from src.allocation.service_layer.shards import ShardedMessageBus, ShardRouterClient
+from src.allocation import config
 import src.allocation.adapters.orm as orm
-from src.allocation.adapters import redis_eventpublisher
+from src.allocation.adapters import database
+from src.allocation.adapters.repository import ProductCache
+from src.allocation.adapters.cache import AbstractCache, build_cache
+from src.allocation.adapters.retry_store import AbstractRetryStore, InMemoryRetryStore, SqlAlchemyRetryStore
+from src.allocation.views import views
 
 
 def inject_dependencies(handler, dependencies):
@@ -16,32 +30,153 @@ def inject_dependencies(handler, dependencies):
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
+    # update_wrapper keeps the handler's name (for logs) and lets the bus unwrap it to
+    # find out whether it is a coroutine function
+    return functools.update_wrapper(lambda message: handler(message, **deps), handler)
+
+
+@overload
+def bootstrap(start_orm: bool = ...,
+              uow: Optional[AbstractUnitOfWork] = ...,
+              notifications: Optional[NotificationsService] = ...,
+              messagebus_init: Type[MessageBus] = ...,
+              cache: Optional[AbstractCache] = ...,
+              engine: Optional[Engine] = ...,
+              retries: Optional[RetryScheduler] = ...) -> MessageBus:
+    ...
+
+
+@overload
+def bootstrap(start_orm: bool = ...,
+              uow: Optional[AbstractAsyncUnitOfWork] = ...,
+              notifications: Optional[AsyncNotificationsService] = ...,
+              *,
+              messagebus_init: Type[AsyncMessageBus],
+              cache: Optional[AbstractCache] = ...,
+              engine: Optional[Engine] = ...,
+              retries: Optional[RetryScheduler] = ...) -> AsyncMessageBus:
+    ...
 
 
 def bootstrap(start_orm: bool = True,
-              uow: AbstractUnitOfWork = SqlAlchemyUnitOfWork(),
-              notifications: NotificationsService = EmailNotifications(),
-              publish: Callable = redis_eventpublisher.publish,
-              messagebus_init: Callable = MessageBus) -> AbstractMessageBus:
+              uow: Optional[Union[AbstractUnitOfWork, AbstractAsyncUnitOfWork]] = None,
+              notifications: Optional[Union[NotificationsService, AsyncNotificationsService]] = None,
+              messagebus_init: Union[Type[MessageBus], Type[AsyncMessageBus]] = MessageBus,
+              cache: Optional[AbstractCache] = None,
+              engine: Optional[Engine] = None,
+              retries: Optional[RetryScheduler] = None) -> Union[MessageBus, AsyncMessageBus]:
+    # messagebus_init=AsyncMessageBus selects the async handlers, and the async adapters
+    # for whatever dependency isn't passed in
+    asynchronous = issubclass(messagebus_init, AsyncMessageBus)
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
+    if uow is None and asynchronous:
+        uow = AsyncSqlAlchemyUnitOfWork()
+    elif uow is None:
+        # the pool (DB_POOL_* settings) is shared by every bus bootstrapped in the process.
+        # committed products aren't expired so they can be cached, they're revalidated instead
+        uow = SqlAlchemyUnitOfWork(sessionmaker(bind=engine or database.default_engine(), expire_on_commit=False),
+                                   product_cache=build_product_cache())
+    if notifications is None:
+        notifications = AsyncEmailNotifications() if asynchronous else EmailNotifications()
+    if cache is None:
+        cache = build_cache(**config.get_views_cache_settings())
+    handlers_module = async_handlers if asynchronous else handlers
+
+    dependencies = {"uow": uow, "notifications": notifications, "cache": cache}
 
     injected_event_handlers = {
         event_type: [
             inject_dependencies(handler, dependencies)
             for handler in event_handlers
         ]
-        for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
+        for event_type, event_handlers in handlers_module.EVENT_HANDLERS.items()
     }
 
     injected_command_handlers = {
         command_type: inject_dependencies(handler, dependencies)
-        for command_type, handler in handlers.COMMAND_HANDLERS.items()
+        for command_type, handler in handlers_module.COMMAND_HANDLERS.items()
     }
 
+    conflicts = RetryPolicy(**config.get_conflict_retry_settings())
+    if issubclass(messagebus_init, AsyncMessageBus):
+        if retries is None:
+            # its own scheduler: retries run on the loop of the bus that scheduled them
+            retries = build_retry_scheduler(uow, engine)
+            retries.start()
+        return messagebus_init(uow=cast(AbstractAsyncUnitOfWork, uow),
+                               event_handlers=injected_event_handlers,
+                               command_handlers=injected_command_handlers,
+                               retries=retries,
+                               conflicts=conflicts)
+
+    uow = cast(AbstractUnitOfWork, uow)
+    if retries is None:
+        retries = process_retry_scheduler(uow)
     return messagebus_init(uow=uow,
                            event_handlers=injected_event_handlers,
-                           command_handlers=injected_command_handlers)
+                           command_handlers=injected_command_handlers,
+                           retries=retries,
+                           conflicts=conflicts)
+
+
+def shard_bus() -> Callable:
+    # what every shard runs: a whole bus of its own, built inside that process
+    return bootstrap().handle
+
+
+def bootstrap_sharded(shards: int, queue_size: int = 1000, timeout: Optional[float] = 30) -> ShardedMessageBus:
+    # for the shard router only, see shard_router_client for everyone else
+    if config.get_views_cache_settings()["backend"] == "memory":
+        raise ValueError("the shards can't invalidate other processes' memory: use VIEWS_CACHE=redis or none")
+    return ShardedMessageBus(shard_bus, shards=shards, queue_size=queue_size, timeout=timeout,
+                             sku_for_batchref=lambda ref: views.sku_for_batch(ref, ReadOnlyUnitOfWork()))
+
+
+def shard_router_settings() -> dict:
+    settings = config.get_shard_router_settings()
+    if not settings["authkey"]:
+        raise ValueError("the shard router runs what it unpickles: set SHARD_ROUTER_AUTHKEY")
+    return settings
+
+
+def shard_router_client() -> ShardRouterClient:
+    settings = shard_router_settings()
+    return ShardRouterClient((settings["host"], settings["port"]), settings["authkey"], settings["timeout"])
+
+
+def build_product_cache() -> Optional[ProductCache]:
+    size = config.get_product_cache_size()
+    return ProductCache(size) if size > 0 else None
+
+
+def build_retry_scheduler(uow: Union[AbstractUnitOfWork, AbstractAsyncUnitOfWork],
+                          engine: Optional[Engine] = None) -> RetryScheduler:
+    settings = config.get_event_retry_settings()
+    store = InMemoryRetryStore()  # type: AbstractRetryStore
+    if settings.pop("store") == "postgres":
+        if isinstance(uow, SqlAlchemyUnitOfWork):
+            store = SqlAlchemyRetryStore(uow.session_factory)
+        elif isinstance(uow, AsyncSqlAlchemyUnitOfWork):
+            # the store is written from the scheduler's thread, so it keeps a sync session
+            store = SqlAlchemyRetryStore(sessionmaker(bind=engine or database.default_engine()))
+        else:
+            raise ValueError("RETRY_STORE=postgres needs a SqlAlchemyUnitOfWork")
+    lease = settings.pop("lease")
+    return RetryScheduler(store, RetryPolicy(**settings), lease=lease)
+
+
+_retries = None  # type: Optional[RetryScheduler]
+_retries_lock = threading.Lock()
+
+
+def process_retry_scheduler(uow: AbstractUnitOfWork) -> RetryScheduler:
+    # one scheduler thread per process, started by the first bus bootstrapped there and
+    # shared by the rest (the consumer's workers): more would only poll the same store
+    global _retries
+    with _retries_lock:
+        if _retries is None:
+            _retries = build_retry_scheduler(uow)
+            _retries.start()
+        return _retries
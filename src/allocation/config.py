@@ -47,6 +47,32 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_replica_postgres_uri():
+    # DB_REPLICA_HOST sends the read-only queries (views) to a replica; without it they go to the primary
+    replica_host = os.environ.get("DB_REPLICA_HOST")
+    if not replica_host:
+        return get_postgres_uri()
+    password = os.environ.get("DB_PASSWORD", "abc123")
+    user, db_name = "allocation", "allocation"
+    return f"postgresql://{user}:{password}@{replica_host}:5432/{db_name}"
+
+
+def get_db_pool_settings():
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true",
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        # 0 keeps postgres' default (no timeout)
+        statement_timeout_ms=int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0)),
+    )
+
+
+def get_async_postgres_uri():
+    return get_postgres_uri().replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
@@ -59,8 +85,121 @@ def get_redis_host_and_port():
     return dict(host=host, port=port)
 
 
+def get_redis_pool_settings():
+    return dict(
+        max_connections=int(os.environ.get("REDIS_MAX_CONNECTIONS", 50)),
+        socket_timeout=float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5)),
+        health_check_interval=int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+    )
+
+
+def get_redis_publisher_settings():
+    return dict(
+        max_batch_size=int(os.environ.get("REDIS_PUBLISH_BATCH_SIZE", 100)),
+        max_delay=float(os.environ.get("REDIS_PUBLISH_MAX_DELAY", 0.05)),
+        # REDIS_TRANSPORT=streams writes to redis streams instead of pub/sub channels
+        streams=os.environ.get("REDIS_TRANSPORT", "pubsub") == "streams",
+        stream_maxlen=int(os.environ.get("REDIS_STREAM_MAXLEN", 100_000)),
+        # the consumers decode both, so publishers can move to binary one at a time
+        binary=os.environ.get("REDIS_WIRE_FORMAT", "json") == "binary",
+    )
+
+
+def get_conflict_retry_settings():
+    # commands that lose an optimistic concurrency race on a product are run again
+    return dict(
+        max_attempts=int(os.environ.get("CONFLICT_MAX_ATTEMPTS", 5)),
+        base_delay=float(os.environ.get("CONFLICT_BASE_DELAY", 0.005)),
+        max_delay=float(os.environ.get("CONFLICT_MAX_DELAY", 0.2)),
+        jitter=1.0,
+    )
+
+
+def get_consumer_settings():
+    # CONSUMER_WORKERS=0 handles every message inline, on the thread that reads them
+    return dict(
+        workers=int(os.environ.get("CONSUMER_WORKERS", 4)),
+        batch_size=int(os.environ.get("CONSUMER_BATCH_SIZE", 100)),
+        batch_timeout=float(os.environ.get("CONSUMER_BATCH_TIMEOUT", 0.1)),
+    )
+
+
+def get_shard_settings():
+    # read by the shard router only. With shards the views cache must be shared (VIEWS_CACHE=redis)
+    # or off: the shards can't invalidate another process' memory
+    return dict(
+        shards=int(os.environ.get("ALLOCATION_SHARDS", 4)),
+        queue_size=int(os.environ.get("SHARD_QUEUE_SIZE", 1000)),
+        timeout=float(os.environ.get("SHARD_TIMEOUT", 30)),
+    )
+
+
+def get_shard_router_settings():
+    # with SHARD_ROUTER_HOST set the api and the consumers send their commands to the (single)
+    # shard router instead of handling them themselves. The router unpickles what it receives,
+    # so there is no default authkey, and it only listens on SHARD_ROUTER_BIND
+    authkey = os.environ.get("SHARD_ROUTER_AUTHKEY")
+    return dict(
+        host=os.environ.get("SHARD_ROUTER_HOST"),
+        bind=os.environ.get("SHARD_ROUTER_BIND", "localhost"),
+        port=int(os.environ.get("SHARD_ROUTER_PORT", 5070)),
+        authkey=authkey.encode() if authkey else None,
+        timeout=float(os.environ.get("SHARD_TIMEOUT", 30)),
+    )
+
+
+def get_stream_consumer_settings():
+    return dict(
+        group=os.environ.get("STREAM_CONSUMER_GROUP", "allocation"),
+        batch_size=int(os.environ.get("STREAM_BATCH_SIZE", 100)),
+        block_ms=int(os.environ.get("STREAM_BLOCK_MS", 1000)),
+        # entries pending for longer than this belong to a consumer that is gone
+        claim_idle_ms=int(os.environ.get("STREAM_CLAIM_IDLE_MS", 60_000)),
+        # how often to look for them: every pass of the loop was an XPENDING and an XAUTOCLAIM per stream
+        reclaim_interval_ms=int(os.environ.get("STREAM_RECLAIM_INTERVAL_MS", 30_000)),
+        max_deliveries=int(os.environ.get("STREAM_MAX_DELIVERIES", 5)),
+    )
+
+
+def get_views_cache_settings():
+    # off unless configured. VIEWS_CACHE=redis is shared by every process that writes the read
+    # model (api, consumers); "memory" only suits a single process that both writes and reads it
+    return dict(
+        backend=os.environ.get("VIEWS_CACHE", "none"),
+        ttl=float(os.environ.get("VIEWS_CACHE_TTL", 10)),
+        maxsize=int(os.environ.get("VIEWS_CACHE_MAXSIZE", 10_000)),
+    )
+
+
+def get_product_cache_size():
+    # how many Product aggregates a process keeps between units of work, 0 to disable it
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 1000))
+
+
 def get_email_host_and_port():
     host = os.environ.get("EMAIL_HOST", "localhost")
     port = 11025 if host == "localhost" else 1025
     http_port = 18025 if host == "localhost" else 8025
     return dict(host=host, port=port, http_port=http_port)
+
+
+def get_event_retry_settings():
+    # RETRY_STORE=postgres keeps pending retries (and dead letters) in the database; RETRY_LEASE
+    # is how long a scheduler may take to run one before another scheduler runs it again
+    return dict(
+        store=os.environ.get("RETRY_STORE", "memory"),
+        lease=float(os.environ.get("RETRY_LEASE", 60)),
+        max_attempts=int(os.environ.get("RETRY_MAX_ATTEMPTS", 5)),
+        base_delay=float(os.environ.get("RETRY_BASE_DELAY", 1)),
+        max_delay=float(os.environ.get("RETRY_MAX_DELAY", 300)),
+        jitter=float(os.environ.get("RETRY_JITTER", 0.5)),
+    )
+
+
+def get_outbox_relay_settings():
+    return dict(
+        batch_size=int(os.environ.get("OUTBOX_BATCH_SIZE", 500)),
+        poll_interval=float(os.environ.get("OUTBOX_POLL_INTERVAL", 0.5)),
+        max_backoff=float(os.environ.get("OUTBOX_MAX_BACKOFF", 30)),  # seconds, after failing in a row
+        retention_hours=float(os.environ.get("OUTBOX_RETENTION_HOURS", 24)),
+    )
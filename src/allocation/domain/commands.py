@@ -1,20 +1,26 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import Optional, Tuple
 
 
 class Command:
-    pass
+    # lets the dataclasses below go without a __dict__
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Allocate(Command):
     orderid: str
     sku: str
     qty: int
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
+class AllocateMany(Command):
+    lines: Tuple[Allocate, ...]
+
+
+@dataclass(frozen=True, slots=True)
 class CreateBatch(Command):
     ref: str
     sku: str
@@ -22,7 +28,7 @@ class CreateBatch(Command):
     eta: Optional[date] = None
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
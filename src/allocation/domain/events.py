@@ -1,17 +1,18 @@
 from dataclasses import dataclass
 
 
-@dataclass
+# frozen and slotted: events are values, and a change_batch_quantity cascade can queue a lot of them
+@dataclass(frozen=True, slots=True)
 class Event:
     pass
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class OutOfStock(Event):
     sku: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Allocated(Event):
     orderid: str
     sku: str
@@ -19,7 +20,7 @@ class Allocated(Event):
     batchref: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Deallocated(Event):
     orderid: str
     sku: str
@@ -1,6 +1,8 @@
 from __future__ import annotations
+from bisect import insort
+from collections import deque
 from datetime import date
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Tuple, Set, Dict, Deque
 from dataclasses import dataclass
 
 from src.allocation.domain import events, commands
@@ -13,12 +15,54 @@ class Product:
         self.sku = sku
         self.batches = batches if batches else []
         self.version_id_col = version_id_col
-        self.messages = []  # type: List[Message]
+        self.messages = deque()  # type: Deque[Message]
+        self._batches_by_eta = None  # type: Optional[List[Batch]]
+        self._batches_by_line = None  # type: Optional[Dict[OrderLine, Set[Batch]]]
+        self._lines_by_order = None  # type: Optional[Dict[str, Set[OrderLine]]]
+
+    @property
+    def batches_by_eta(self) -> List[Batch]:
+        # kept sorted by add_stock, so allocate doesn't have to sort on every line.
+        # None means "not built yet" (new instance, or reloaded/expired by the ORM)
+        if self._batches_by_eta is None:
+            self._batches_by_eta = sorted(self.batches, key=eta_order)
+        return self._batches_by_eta
+
+    def _allocation_index(self) -> Tuple[Dict[OrderLine, Set[Batch]], Dict[str, Set[OrderLine]]]:
+        # secondary indexes (line -> batches, orderid -> lines), built lazily like batches_by_eta
+        # and then kept up to date by allocate, add_stock and change_batch_quantity. A line
+        # allocated again once its batch is full goes to another batch too, so it can have several
+        if self._batches_by_line is None or self._lines_by_order is None:
+            self._batches_by_line, self._lines_by_order = {}, {}
+            for batch in self.batches:
+                for line in batch._allocations:
+                    self._index_line(line, batch)
+        return self._batches_by_line, self._lines_by_order
+
+    def _index_line(self, line: OrderLine, batch: Batch):
+        batches_by_line, lines_by_order = self._allocation_index()
+        batches_by_line.setdefault(line, set()).add(batch)
+        lines_by_order.setdefault(line.orderid, set()).add(line)
+
+    def _unindex_line(self, line: OrderLine, batch: Batch):
+        batches_by_line, lines_by_order = self._allocation_index()
+        batches = batches_by_line.get(line)
+        if batches is None or batch not in batches:
+            return
+        batches.discard(batch)
+        if batches:  # still held by another batch
+            return
+        del batches_by_line[line]
+        order_lines = lines_by_order[line.orderid]
+        order_lines.discard(line)
+        if not order_lines:
+            del lines_by_order[line.orderid]
 
     def allocate(self, line: OrderLine):
         try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
+            batch = next(b for b in self.batches_by_eta if b.can_allocate(line))
             batch.allocate(line)
+            self._index_line(line, batch)
             self.version_id_col += 1
             self.messages.append(
                 events.Allocated(
@@ -34,21 +78,36 @@ class Product:
             return None
 
     def add_stock(self, batch: Batch):
+        insort(self.batches_by_eta, batch, key=eta_order)
+        for line in batch._allocations:
+            self._index_line(line, batch)
         self.batches.append(batch)
         self.version_id_col += 1
 
     def is_allocated_for_line(self, line: OrderLine) -> bool:
-        return len([batch for batch in self.batches if batch.is_allocated_for_line(line)]) > 0
+        batches_by_line, _ = self._allocation_index()
+        return line in batches_by_line
 
     def is_allocated_for_order(self, orderid: str) -> bool:
-        return len([batch for batch in self.batches if batch.is_allocated_for_order(orderid)]) > 0
+        _, lines_by_order = self._allocation_index()
+        return orderid in lines_by_order
+
+    def allocations_for_order(self, orderid: str) -> Dict[OrderLine, Set[str]]:
+        batches_by_line, lines_by_order = self._allocation_index()
+        return {
+            line: {batch.reference for batch in batches_by_line[line]}
+            for line in lines_by_order.get(orderid, ())
+        }
 
     def change_batch_quantity(self, ref: str, qty: int):
         # sanity check
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
+        # like allocate, so it loses the race to a concurrent allocation of the product
+        self.version_id_col += 1
         while batch.available_quantity < 0:
             line = batch.deallocate_one()
+            self._unindex_line(line, batch)
             self.messages.append(
                 events.Deallocated(line.orderid, line.sku, line.qty)
             )
@@ -66,6 +125,8 @@ class Product:
         return hash(self.sku)
 
 
+# OrderLine and Batch can't be slotted (nor frozen): the ORM keeps its state and the mapped
+# attributes in the instance __dict__, and needs to set them
 @dataclass(unsafe_hash=True)
 class OrderLine:
     orderid: str
@@ -79,31 +140,60 @@ class Batch:
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
-        self._allocations = set()
+        self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # type: Optional[int]
+        self._lines_by_order = {}  # type: Optional[Dict[str, Set[OrderLine]]]
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and not self.is_allocated_for_line(line):
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
+            self.lines_by_order.setdefault(line.orderid, set()).add(line)
 
     def deallocate(self, line: OrderLine):
         if self.is_allocated_for_line(line):
+            self._allocated_quantity = self.allocated_quantity - line.qty
             self._allocations.remove(line)
+            self._unindex_line(line)
 
     def is_allocated_for_line(self, line: OrderLine):
         return line in self._allocations
 
     def is_allocated_for_order(self, orderid: str):
-        return len([line for line in self._allocations if line.orderid == orderid]) > 0
+        return orderid in self.lines_by_order
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated_quantity = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated_quantity - line.qty
+        self._unindex_line(line)
+        return line
+
+    @property
+    def lines_by_order(self) -> Dict[str, Set[OrderLine]]:
+        # same lazy rebuild as allocated_quantity
+        if self._lines_by_order is None:
+            self._lines_by_order = {}
+            for line in self._allocations:
+                self._lines_by_order.setdefault(line.orderid, set()).add(line)
+        return self._lines_by_order
+
+    def _unindex_line(self, line: OrderLine):
+        order_lines = self.lines_by_order.get(line.orderid, set())
+        order_lines.discard(line)
+        if not order_lines:
+            self.lines_by_order.pop(line.orderid, None)
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # running total kept by allocate/deallocate. None means "not known yet"
+        # (the ORM loaded or expired _allocations), so it is summed once again
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -127,3 +217,8 @@ class Batch:
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
+
+
+def eta_order(batch: Batch) -> Tuple[bool, date, str]:
+    # warehouse stock (no eta) first, then shipments by eta, reference breaks ties
+    return batch.eta is not None, batch.eta or date.min, batch.reference
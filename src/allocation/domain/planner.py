@@ -0,0 +1,93 @@
+# What-if allocation: which batch every line would go to if they were allocated in order
+# right now, without touching the product (no allocations, no events, no version bump).
+#
+# Product.allocate gives each line, in turn, to the first batch by eta that still fits it.
+# Which lines a batch takes only depends on the lines that reach it, so the batches can be
+# filled one at a time, in eta order: each one goes through what the previous ones left
+# over, with cumulative sums over the quantities instead of a loop over the lines.
+from typing import Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+from src.allocation.domain import model
+
+
+def batch_arrays(product: model.Product):
+    # the product's batches in eta order: references, and what each has available
+    batches = product.batches
+    order = np.lexsort((
+        np.array([b.reference for b in batches]),
+        np.array([b.eta.toordinal() if b.eta else 0 for b in batches], dtype=np.int64),
+        np.array([b.eta is not None for b in batches]),
+    ))
+    available = np.array([b.available_quantity for b in batches], dtype=np.int64)[order]
+    return [batches[i] for i in order], available
+
+
+def plan_allocations(product: model.Product, lines: Sequence[model.OrderLine]) -> List[Optional[str]]:
+    """
+    The batch reference every line would be allocated to, None when it would be out of
+    stock: the same results as calling product.allocate(line) for each line in order.
+    """
+    batches, available = batch_arrays(product)
+    allocated = {}  # type: Dict[model.OrderLine, set]
+    for k, batch in enumerate(batches):
+        for line in batch._allocations:
+            allocated.setdefault(line, set()).add(k)
+
+    # a line already allocated to a batch doesn't take anything more from it if it goes there
+    # again, so the same line twice in a plan starts a new segment, planned after the first
+    segments = [(0, len(lines))]
+    if len(set(lines)) < len(lines):
+        segments, start = [], 0
+        seen = set()  # type: Set[model.OrderLine]
+        for end, line in enumerate(lines):
+            if line in seen:
+                segments.append((start, end))
+                start, seen = end, set()
+            seen.add(line)
+        segments.append((start, len(lines)))
+
+    assignment = np.full(len(lines), -1, dtype=np.int64)
+    for start, end in segments:
+        assignment[start:end] = _plan_segment(product.sku, lines[start:end], available, allocated,
+                                              last=end == len(lines))
+    refs = [batch.reference for batch in batches] + [None]  # -1, out of stock, is the last one
+    return [refs[k] for k in assignment.tolist()]
+
+
+def _plan_segment(sku: str, lines: Sequence[model.OrderLine], available: np.ndarray,
+                  allocated: Dict[model.OrderLine, set], last: bool) -> np.ndarray:
+    # plans lines that are all different, updating available (and allocated, if more lines
+    # come after these) as it goes
+    qty = np.fromiter((line.qty for line in lines), dtype=np.int64, count=len(lines))
+    assignment = np.full(len(lines), -1, dtype=np.int64)
+    waiting = np.fromiter((line.sku == sku for line in lines), dtype=bool, count=len(lines))
+    already = []  # type: List[tuple]
+    if allocated and not allocated.keys().isdisjoint(lines):
+        already = [(j, k) for j, line in enumerate(lines) for k in allocated.get(line, ())]
+
+    for k in range(len(available)):
+        cost = qty.copy()
+        cost[[j for j, batch in already if batch == k]] = 0
+        left = int(available[k])
+        positions = np.flatnonzero(waiting)
+        while positions.size:
+            positions = positions[qty[positions] <= left]
+            if not positions.size:
+                break
+            taken_before = np.cumsum(cost[positions]) - cost[positions]
+            fits = left - taken_before >= qty[positions]
+            # every line up to the first one that doesn't fit goes to this batch
+            first_miss = int(np.argmin(fits)) if not fits.all() else positions.size
+            taken = positions[:first_miss]
+            assignment[taken] = k
+            waiting[taken] = False
+            left -= int(cost[taken].sum())
+            positions = positions[first_miss + 1:]
+        available[k] = left
+
+    if not last:
+        for j in np.flatnonzero(assignment >= 0).tolist():
+            allocated.setdefault(lines[j], set()).add(int(assignment[j]))
+    return assignment
@@ -2,13 +2,21 @@ from datetime import datetime
 
 from flask import Flask, request, jsonify
 
-from src.allocation import bootstrap
+from src.allocation import bootstrap, config
+from src.allocation.adapters.cache import build_cache
+from src.allocation.adapters.metrics import metrics
 from src.allocation.domain import commands
 from src.allocation.service_layer import handlers, unit_of_work, messagebus
 from src.allocation.views import views
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+views_cache = build_cache(**config.get_views_cache_settings())
+if config.get_shard_router_settings()["host"]:
+    # the commands run on the shards, through the shard router
+    bus = bootstrap.shard_router_client()  # type: messagebus.CommandBus
+else:
+    # shared by every request thread: the bus' queue and the unit of work's session are per thread
+    bus = bootstrap.bootstrap(cache=views_cache)
 
 
 @app.route("/batch", methods=["PUT"])
@@ -42,10 +50,20 @@ def allocate_endpoint():
     return "OK", 202
 
 
+@app.route("/allocate/bulk", methods=["POST"])
+def allocate_bulk_endpoint():
+    command = commands.AllocateMany(tuple(
+        commands.Allocate(line["orderid"], line["sku"], line["qty"])
+        for line in request.json["lines"]
+    ))
+    [outcomes, *_] = bus.handle(command)
+    return jsonify(outcomes), 202
+
+
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    uow = unit_of_work.SqlAlchemyUnitOfWork()
-    result = views.allocations(orderid, uow)
+    uow = unit_of_work.ReadOnlyUnitOfWork()
+    result = views.allocations(orderid, uow, views_cache)
     if not result:
         return "not found", 404
     return jsonify(result), 200
@@ -53,8 +71,13 @@ def allocations_view_endpoint(orderid):
 
 @app.route("/allocations/<orderid>/<sku>", methods=["GET"])
 def allocation_view_endpoint(orderid, sku):
-    uow = unit_of_work.SqlAlchemyUnitOfWork()
-    result = views.allocation(orderid, sku, uow)
+    uow = unit_of_work.ReadOnlyUnitOfWork()
+    result = views.allocation(orderid, sku, uow, views_cache)
     if not result:
         return "not found", 404
     return jsonify(result), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return jsonify(metrics.snapshot()), 200
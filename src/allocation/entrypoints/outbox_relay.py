@@ -0,0 +1,48 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import logging
+from src.allocation import config
+from src.allocation.adapters import redis_eventpublisher
+from src.allocation.adapters.outbox import OutboxRelay
+from src.allocation.service_layer import unit_of_work
+from src.allocation.service_layer.retries import RetryPolicy
+
+logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    level=os.environ.get('LOGLEVEL', 'INFO').upper()
+)
+
+
+def main():
+    settings = config.get_outbox_relay_settings()
+    publisher = redis_eventpublisher.BatchingPublisher(**config.get_redis_publisher_settings())
+    relay = OutboxRelay(unit_of_work.default_session_factory(), publisher, batch_size=settings["batch_size"])
+    retention = timedelta(hours=settings["retention_hours"])
+    last_prune = datetime.min
+    # postgres or redis going away only pauses the relay: unrelayed rows stay in the outbox
+    backoff = RetryPolicy(base_delay=settings["poll_interval"], max_delay=settings["max_backoff"])
+    failures = 0
+
+    while True:
+        try:
+            relayed = relay.relay_once()
+            if datetime.now() - last_prune > timedelta(hours=1):
+                relay.prune(datetime.now() - retention)
+                last_prune = datetime.now()
+        except Exception:
+            failures += 1
+            logger.exception("Relaying the outbox failed (%s in a row), backing off", failures)
+            time.sleep(backoff.delay(failures))
+            continue
+        failures = 0
+        if relayed < settings["batch_size"]:
+            # caught up: wait for new rows instead of hammering the table
+            time.sleep(settings["poll_interval"])
+
+
+if __name__ == "__main__":
+    logger.info("Starting Outbox Relay")
+    main()
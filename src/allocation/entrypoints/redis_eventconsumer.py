@@ -1,10 +1,17 @@
-import json
 import os
+import signal
+import threading
+import time
+from typing import Dict, List, Optional
 
 import redis
 import logging
 from src.allocation import config, bootstrap
+from src.allocation.adapters import codecs
 from src.allocation.domain import commands
+from src.allocation.service_layer.unit_of_work import ReadOnlyUnitOfWork
+from src.allocation.service_layer.workers import PartitionedWorkerPool
+from src.allocation.views import views
 
 r = redis.Redis(**config.get_redis_host_and_port())
 
@@ -15,29 +22,121 @@ logging.basicConfig(
 )
 
 
-commands_mappers = {
-    'change_batch_quantity': lambda data: commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"]),
-    'allocate_line': lambda data: commands.Allocate(orderid=data["orderid"], sku=data["sku"], qty=data["qty"])
+_skus_by_batchref = {}  # type: Dict[str, str]
 
+
+def sku_for_batchref(ref: str) -> Optional[str]:
+    # a batch never changes sku, so whatever was found is kept
+    if ref not in _skus_by_batchref:
+        try:
+            sku = views.sku_for_batch(ref, ReadOnlyUnitOfWork())
+        except Exception as e:
+            logger.warning(f"No sku for batch {ref}, partitioned by its reference: {e!r}")
+            return None
+        if sku is not None:
+            _skus_by_batchref[ref] = sku
+    return _skus_by_batchref.get(ref)
+
+
+# the key that keeps messages about the same product in order
+partition_keys = {
+    commands.ChangeBatchQuantity: lambda command: sku_for_batchref(command.ref) or command.ref,
+    commands.Allocate: lambda command: command.sku,
 }
 
 
+def read_batch(pubsub, batch_size, timeout):
+    # waits up to timeout for the first message, then takes whatever else is already there
+    batch = []  # type: List[dict]
+    deadline = time.monotonic() + timeout
+    while len(batch) < batch_size:
+        m = pubsub.get_message(timeout=max(0.0, deadline - time.monotonic()) if not batch else 0)
+        if m is None:
+            break
+        batch.append(m)
+    return batch
+
+
+def to_command(m):
+    channel_name = m["channel"].decode()
+    try:
+        command = codecs.decode(channel_name, m["data"])
+    except codecs.UnknownMessage as e:  # MalformedMessage included
+        logger.warning(f"Message incoming from {channel_name} was ignored: {e}")
+        return None, None
+    if type(command) not in partition_keys:
+        logger.warning(f"Message incoming from {channel_name} was ignored")
+        return None, None
+    return partition_keys[type(command)](command), command
+
+
 def main():
+    settings = config.get_consumer_settings()
+    if config.get_shard_router_settings()["host"]:
+        return main_sharded()
+    if settings["workers"] == 0:
+        return main_inline()
+
+    bus = bootstrap.bootstrap()
+    # the mappers are started above; every worker gets its own bus and unit of work but
+    # they share the process' retry scheduler
+    pool = PartitionedWorkerPool(
+        lambda: bootstrap.bootstrap(start_orm=False).handle,
+        workers=settings["workers"],
+    )
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("change_batch_quantity", "allocate_line")
+    while not stopping.is_set():
+        for m in read_batch(pubsub, settings["batch_size"], settings["batch_timeout"]):
+            logger.debug("handling %s", m)
+            key, cmd = to_command(m)
+            if cmd is not None:
+                pool.submit(key, cmd)
+
+    logger.info("Stopping, waiting for the workers to finish")
+    pubsub.close()
+    pool.shutdown(wait=True)
+    if bus.retries is not None:
+        bus.retries.stop()
+
+
+def main_sharded():
+    # every command goes through the shard router to the shard that owns its sku, without
+    # waiting for it
+    settings = config.get_consumer_settings()
+    bus = bootstrap.shard_router_client()
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("change_batch_quantity", "allocate_line")
+    while not stopping.is_set():
+        for m in read_batch(pubsub, settings["batch_size"], settings["batch_timeout"]):
+            logger.debug("handling %s", m)
+            _, cmd = to_command(m)
+            if cmd is not None:
+                bus.submit(cmd)
+
+    logger.info("Stopping")
+    pubsub.close()
+
+
+def main_inline():
     bus = bootstrap.bootstrap()
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe("change_batch_quantity", "allocate_line")
 
     for m in pubsub.listen():
         logger.debug("handling %s", m)
-        channel_name = m["channel"].decode()
-        if channel_name in commands_mappers:
-            data = json.loads(m["data"])
-            cmd = commands_mappers.get(channel_name)(data)
+        _, cmd = to_command(m)
+        if cmd is not None:
             bus.handle(cmd)
 
-        else:
-            logger.warning(f"Message incoming from {channel_name} was ignored")
-
 
 if __name__ == "__main__":
     logger.info("Starting Event Listener")
@@ -0,0 +1,166 @@
+# Same commands as redis_eventconsumer, read from redis streams through a consumer group:
+# entries wait in the stream while no consumer is running, and N consumers in the same group
+# split them between themselves instead of each one handling all of them.
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Optional
+
+import redis
+import logging
+from src.allocation import config, bootstrap
+from src.allocation.adapters import codecs
+
+r = redis.Redis(**config.get_redis_host_and_port())
+
+logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    level=os.environ.get('LOGLEVEL', 'INFO').upper()
+)
+
+STREAMS = ("change_batch_quantity", "allocate_line")
+
+
+class StreamConsumer:
+    """
+    Reads at most batch_size entries at a time and only asks for more once all of them
+    were handled, so a slow consumer isn't handed more than it can take (the rest waits
+    in redis, for this or another consumer). An entry is acked after bus.handle returns;
+    if it raises, or the process dies, the entry stays pending, and after claim_idle_ms
+    any consumer of the group claims it (poll() looks for those every reclaim_interval_ms).
+    Entries delivered max_deliveries times are moved to "<stream>:dead" and acked, so a
+    poison message doesn't loop forever; entries that don't decode are moved right away.
+    """
+
+    def __init__(self, client: redis.Redis, handle, group: str, name: str, streams=STREAMS,
+                 batch_size: int = 100, block_ms: int = 1000, claim_idle_ms: int = 60_000,
+                 max_deliveries: int = 5, reclaim_interval_ms: int = 30_000):
+        self.client = client
+        self.handle = handle
+        self.group = group
+        self.name = name
+        self.streams = streams
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.reclaim_interval_ms = reclaim_interval_ms
+        self._next_reclaim = 0.0  # monotonic seconds, the first poll reclaims
+
+    def create_groups(self):
+        for stream in self.streams:
+            try:
+                self.client.xgroup_create(stream, self.group, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def poll(self, now: Optional[float] = None) -> int:
+        # what dead consumers left behind, when it's time to look again, then new entries
+        now = time.monotonic() if now is None else now
+        handled = 0
+        if now >= self._next_reclaim:
+            self._next_reclaim = now + self.reclaim_interval_ms / 1000
+            handled += self.reclaim()
+        return handled + self.read_once()
+
+    def read_once(self) -> int:
+        response = self.client.xreadgroup(
+            self.group, self.name, {stream: ">" for stream in self.streams},
+            count=self.batch_size, block=self.block_ms,
+        )
+        # [stream, entries] pairs, or a dict of them over RESP3
+        streams = response.items() if isinstance(response, dict) else response or []
+        handled = 0
+        for stream, entries in streams:
+            handled += self.handle_entries(_decode(stream), entries)
+        return handled
+
+    def reclaim(self) -> int:
+        handled = 0
+        for stream in self.streams:
+            self.dead_letter_exhausted(stream)
+            _, entries, *_ = self.client.xautoclaim(
+                stream, self.group, self.name, min_idle_time=self.claim_idle_ms, count=self.batch_size,
+            )
+            handled += self.handle_entries(stream, entries)
+        return handled
+
+    def dead_letter_exhausted(self, stream: str):
+        pending = self.client.xpending_range(
+            stream, self.group, min="-", max="+", count=self.batch_size, idle=self.claim_idle_ms,
+        )
+        for entry in pending:
+            if int(entry["times_delivered"]) < self.max_deliveries:
+                continue
+            entry_id = entry["message_id"]
+            for _, fields in self.client.xrange(stream, min=entry_id, max=entry_id) or []:
+                if fields is not None:
+                    self._dead_letter(stream, fields)
+            self.client.xack(stream, self.group, entry_id)
+            logger.error("Gave up on %s %s after %s deliveries", stream, _decode(entry_id), entry["times_delivered"])
+
+    def handle_entries(self, stream: str, entries) -> int:
+        acks = []
+        for entry_id, fields in entries:
+            if fields is None:  # trimmed from the stream while pending
+                acks.append(entry_id)
+                continue
+            logger.debug("handling %s %s", stream, fields)
+            try:
+                message = codecs.decode(stream, fields[b"data"])
+            except (codecs.UnknownMessage, KeyError) as e:
+                # it won't decode any better next time
+                logger.error("Can't decode %s %s (%s), moving it to %s:dead", stream, fields, e, stream)
+                self._dead_letter(stream, fields)
+                acks.append(entry_id)
+                continue
+            try:
+                self.handle(message)
+            except Exception:
+                logger.exception("Exception handling %s %s, leaving it pending", stream, fields)
+                continue
+            acks.append(entry_id)
+        if acks:
+            self.client.xack(stream, self.group, *acks)
+        return len(acks)
+
+    def _dead_letter(self, stream: str, fields):
+        self.client.xadd(f"{stream}:dead", fields)
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def main():
+    settings = config.get_stream_consumer_settings()
+    bus = bootstrap.bootstrap()
+    consumer = StreamConsumer(
+        r, bus.handle,
+        group=settings["group"],
+        name=f"{socket.gethostname()}-{os.getpid()}",
+        batch_size=settings["batch_size"],
+        block_ms=settings["block_ms"],
+        claim_idle_ms=settings["claim_idle_ms"],
+        max_deliveries=settings["max_deliveries"],
+        reclaim_interval_ms=settings["reclaim_interval_ms"],
+    )
+    consumer.create_groups()
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    while not stopping.is_set():
+        consumer.poll()
+    # the batch being handled finishes and is acked before we leave
+    if bus.retries is not None:
+        bus.retries.stop()
+
+
+if __name__ == "__main__":
+    logger.info("Starting Stream Consumer")
+    main()
@@ -0,0 +1,35 @@
+# The one process that starts the shards (ALLOCATION_SHARDS of them) and routes commands to
+# them, for the api and the consumers (SHARD_ROUTER_HOST pointing here). Run a single one:
+# a second router would mean a second set of shards, and two writers per sku.
+import logging
+import os
+import signal
+from multiprocessing.connection import Listener
+
+from src.allocation import bootstrap, config
+from src.allocation.service_layer.shards import serve_router
+
+logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    level=os.environ.get('LOGLEVEL', 'INFO').upper()
+)
+
+
+def main():
+    router = bootstrap.shard_router_settings()
+    bus = bootstrap.bootstrap_sharded(**config.get_shard_settings())
+    # binding the port also keeps a second router from starting on the same host
+    listener = Listener((router["bind"], router["port"]), authkey=router["authkey"])
+    signal.signal(signal.SIGTERM, lambda *_: listener.close())
+    signal.signal(signal.SIGINT, lambda *_: listener.close())
+
+    logger.info("Routing to %s shards on %s:%s", bus.shards, router["bind"], router["port"])
+    serve_router(bus, listener)
+
+    logger.info("Stopping, waiting for the shards to finish")
+    bus.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    main()
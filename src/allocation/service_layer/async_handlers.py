@@ -0,0 +1,124 @@
+# Same use cases as handlers.py, for the AsyncMessageBus: they await the async unit of work,
+# notifications and publisher instead of blocking on them. The domain model is shared.
+from dataclasses import asdict
+from typing import List, Dict, Type, Callable
+
+from sqlalchemy import text
+
+from src.allocation.adapters.cache import AbstractCache
+from src.allocation.views import views
+from src.allocation.adapters.notifications import AsyncNotificationsService
+from src.allocation.domain import model, events, commands
+from src.allocation.service_layer.handlers import InvalidSku
+from src.allocation.service_layer.unit_of_work import AbstractAsyncUnitOfWork, AsyncSqlAlchemyUnitOfWork
+
+
+async def allocate(command: commands.Allocate, uow: AbstractAsyncUnitOfWork):
+    line = model.OrderLine(
+        command.orderid, command.sku, command.qty
+    )
+    async with uow:
+        product = await uow.products.get(sku=line.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        product.allocate(line)
+        await uow.commit()
+
+
+async def allocate_many(command: commands.AllocateMany, uow: AbstractAsyncUnitOfWork) -> List[Dict]:
+    positions_by_sku = {}  # type: Dict[str, List[int]]
+    for position, line_command in enumerate(command.lines):
+        positions_by_sku.setdefault(line_command.sku, []).append(position)
+
+    outcomes = [{} for _ in command.lines]  # type: List[Dict]
+    async with uow:
+        products = {product.sku: product for product in await uow.products.get_many(positions_by_sku)}
+        for sku, positions in positions_by_sku.items():
+            product = products.get(sku)
+            for position in positions:
+                line_command = command.lines[position]
+                outcome = dict(orderid=line_command.orderid, sku=sku, qty=line_command.qty,
+                               batchref=None, status="invalid_sku")
+                if product is not None:
+                    outcome["batchref"] = product.allocate(
+                        model.OrderLine(line_command.orderid, sku, line_command.qty)
+                    )
+                    outcome["status"] = "allocated" if outcome["batchref"] else "out_of_stock"
+                outcomes[position] = outcome
+        if products:
+            await uow.commit()
+    return outcomes
+
+
+async def add_batch(command: commands.CreateBatch, uow: AbstractAsyncUnitOfWork):
+    async with uow:
+        product = await uow.products.get(sku=command.sku)
+        if product is None:
+            product = model.Product(command.sku)
+            await uow.products.add(product)
+        product.add_stock(model.Batch(command.ref, command.sku, command.qty, command.eta))
+        await uow.commit()
+
+
+async def send_out_of_stock_notification(event: events.OutOfStock, notifications: AsyncNotificationsService):
+    await notifications.send(
+        "stock@made.com",
+        f"Out of stock for {event.sku}",
+    )
+
+
+async def change_batch_quantity(command: commands.ChangeBatchQuantity, uow: AbstractAsyncUnitOfWork):
+    async with uow:
+        product = await uow.products.get_by_batchref(batchref=command.ref)
+        product.change_batch_quantity(ref=command.ref, qty=command.qty)
+        await uow.commit()
+
+
+async def reallocate(event: events.Deallocated, uow: AbstractAsyncUnitOfWork):
+    async with uow:
+        product = await uow.products.get(sku=event.sku)
+        product.messages.append(commands.Allocate(**asdict(event)))
+        await uow.commit()
+
+
+async def add_allocation_to_read_model(event: events.Allocated, uow: AsyncSqlAlchemyUnitOfWork,
+                                       cache: AbstractCache):
+    async with uow:
+        await uow.session.execute(text(
+            """
+            INSERT INTO allocations_view (orderid, sku, batchref)
+            VALUES (:orderid, :sku, :batchref)
+            ON CONFLICT (orderid, sku) DO UPDATE SET batchref = excluded.batchref
+            """),
+            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
+        )
+        await uow.commit()
+    cache.invalidate(views.cache_key(event.orderid))
+
+
+async def remove_allocation_from_read_model(event: events.Deallocated, uow: AsyncSqlAlchemyUnitOfWork,
+                                            cache: AbstractCache):
+    async with uow:
+        await uow.session.execute(text(
+            """
+            DELETE FROM allocations_view
+            WHERE orderid = :orderid AND sku = :sku
+            """),
+            dict(orderid=event.orderid, sku=event.sku),
+        )
+        await uow.commit()
+    cache.invalidate(views.cache_key(event.orderid))
+
+
+EVENT_HANDLERS = {
+    events.Allocated: [add_allocation_to_read_model],
+    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.OutOfStock: [send_out_of_stock_notification],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
+COMMAND_HANDLERS = {
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.CreateBatch: add_batch,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+}  # type: Dict[Type[commands.Command], Callable]
@@ -3,7 +3,8 @@ from typing import List, Dict, Type, Callable
 
 from sqlalchemy import text
 
-from src.allocation.adapters import redis_eventpublisher
+from src.allocation.adapters.cache import AbstractCache
+from src.allocation.views import views
 from src.allocation.adapters.notifications import NotificationsService
 from src.allocation.domain import model, events, commands
 from src.allocation.service_layer.unit_of_work import AbstractUnitOfWork, SqlAlchemyUnitOfWork
@@ -29,6 +30,35 @@ def allocate(command: commands.Allocate, uow: AbstractUnitOfWork):
         uow.commit()
 
 
+def allocate_many(command: commands.AllocateMany, uow: AbstractUnitOfWork) -> List[Dict]:
+    # one query for all the products and one commit instead of one of each per line. A single
+    # commit also keeps it all or nothing, so the bus can run it again after a conflict.
+    # lines keep their relative order inside a sku, so the product emits exactly the
+    # events that the same lines sent as single Allocate commands would.
+    positions_by_sku = {}  # type: Dict[str, List[int]]
+    for position, line_command in enumerate(command.lines):
+        positions_by_sku.setdefault(line_command.sku, []).append(position)
+
+    outcomes = [{} for _ in command.lines]  # type: List[Dict]
+    with uow:
+        products = {product.sku: product for product in uow.products.get_many(positions_by_sku)}
+        for sku, positions in positions_by_sku.items():
+            product = products.get(sku)
+            for position in positions:
+                line_command = command.lines[position]
+                outcome = dict(orderid=line_command.orderid, sku=sku, qty=line_command.qty,
+                               batchref=None, status="invalid_sku")
+                if product is not None:
+                    outcome["batchref"] = product.allocate(
+                        model.OrderLine(line_command.orderid, sku, line_command.qty)
+                    )
+                    outcome["status"] = "allocated" if outcome["batchref"] else "out_of_stock"
+                outcomes[position] = outcome
+        if products:
+            uow.commit()
+    return outcomes
+
+
 def add_batch(command: commands.CreateBatch, uow: AbstractUnitOfWork):
     with uow:
         product = uow.products.get(sku=command.sku)
@@ -60,28 +90,24 @@ def reallocate(event: events.Deallocated, uow: AbstractUnitOfWork):
         uow.commit()
 
 
-def publish_allocated_event(
-        event: events.Allocated,
-        uow: AbstractUnitOfWork,
-):
-    redis_eventpublisher.publish("line_allocated", event)
-
-
-def add_allocation_to_read_model(event: events.Allocated, uow: SqlAlchemyUnitOfWork):
+def add_allocation_to_read_model(event: events.Allocated, uow: SqlAlchemyUnitOfWork, cache: AbstractCache):
     with uow:
         uow.session.execute(text(
             """
             INSERT INTO allocations_view (orderid, sku, batchref)
             VALUES (:orderid, :sku, :batchref)
+            ON CONFLICT (orderid, sku) DO UPDATE SET batchref = excluded.batchref
             """),
             dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
         )
         uow.commit()
+    cache.invalidate(views.cache_key(event.orderid))
 
 
 def remove_allocation_from_read_model(
         event: events.Deallocated,
         uow: SqlAlchemyUnitOfWork,
+        cache: AbstractCache,
 ):
     with uow:
         uow.session.execute(text(
@@ -92,16 +118,19 @@ def remove_allocation_from_read_model(
             dict(orderid=event.orderid, sku=event.sku),
         )
         uow.commit()
+    cache.invalidate(views.cache_key(event.orderid))
 
 
 EVENT_HANDLERS = {
-    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
+    # Allocated also goes out to redis, through the outbox (see adapters/outbox.py)
+    events.Allocated: [add_allocation_to_read_model],
     events.Deallocated: [remove_allocation_from_read_model, reallocate],
     events.OutOfStock: [send_out_of_stock_notification],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
@@ -1,13 +1,23 @@
 from __future__ import annotations
+import asyncio
+import contextvars
+import inspect
 import logging
-from typing import Dict, List, Callable, Type, Protocol, Union, TYPE_CHECKING
-from tenacity import Retrying, RetryError, stop_after_attempt, wait_exponential
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Deque, Callable, Type, Protocol, Union, Any, Optional, TYPE_CHECKING
 
+from src.allocation.adapters.metrics import metrics
 from src.allocation.domain import events, commands
 from src.allocation.domain.model import Message
+from src.allocation.service_layer.retries import RetryPolicy
+from src.allocation.service_layer.unit_of_work import ConcurrencyConflict
 
 if TYPE_CHECKING:
     from . import unit_of_work
+    from .retries import RetryScheduler
+    from ..adapters.retry_store import FailedEvent
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +27,22 @@ class AbstractMessageBus(Protocol):
     COMMAND_HANDLERS: Dict[Type[commands.Command], Callable]
     uow: unit_of_work.AbstractUnitOfWork
 
-    def handle(self, message: Message):
+    def handle(self, message: Message) -> List[Any]:
+        ...
+
+
+class AbstractAsyncMessageBus(Protocol):
+    EVENT_HANDLERS: Dict[Type[events.Event], List[Callable]]
+    COMMAND_HANDLERS: Dict[Type[commands.Command], Callable]
+    uow: unit_of_work.AbstractAsyncUnitOfWork
+
+    async def handle(self, message: Message) -> List[Any]:
+        ...
+
+
+class CommandBus(Protocol):
+    # what the entrypoints hand their commands to: a MessageBus, the shards, or the shard router
+    def handle(self, command: commands.Command) -> List[Any]:
         ...
 
 
@@ -27,48 +52,222 @@ class MessageBus:
             self,
             uow: unit_of_work.AbstractUnitOfWork,
             event_handlers: Dict[Type[events.Event], List[Callable]],
-            command_handlers: Dict[Type[commands.Command], Callable]
+            command_handlers: Dict[Type[commands.Command], Callable],
+            retries: Optional[RetryScheduler] = None,
+            conflicts: Optional[RetryPolicy] = None,
     ):
-        self.queue = []
         self.EVENT_HANDLERS = event_handlers
         self.COMMAND_HANDLERS = command_handlers
         self.uow = uow
+        # failed event handlers go to the scheduler; without one they are only logged
+        self.retries = retries
+        if retries is not None and retries.dispatch is None:
+            # a scheduler shared by several buses (the consumer's workers) keeps the first one's
+            retries.dispatch = self.handle_retry
+        # a command whose commit lost a race with another one on the same product runs again
+        self.conflicts = conflicts or conflict_policy()
+        # one bus serves every thread (the api's requests, the retries' thread), so each
+        # thread gets its own queue; the uow keeps its session per thread as well
+        self._local = threading.local()
+
+    @property
+    def queue(self) -> Deque[Message]:
+        if not hasattr(self._local, "queue"):
+            self._local.queue = deque()
+        return self._local.queue
+
+    def handle(self, message: Message) -> List[Any]:
+        self.queue.append(message)
+        return self.process_queue()
 
-    def handle(self, message: Message):
-        self.queue.append(message) # Not thread safe?
+    def handle_retry(self, failed: FailedEvent):
+        # raises if the handler fails again, so the scheduler can reschedule it
+        handler = next(
+            h for h in self.EVENT_HANDLERS[type(failed.event)] if h.__name__ == failed.handler
+        )
+        logger.debug("retrying event %s with handler %s (attempt %s)", failed.event, handler, failed.attempt + 1)
+        handler(failed.event)
+        self.queue.extend(self.uow.collect_new_events())
+        self.process_queue()
+
+    def process_queue(self) -> List[Any]:
+        # returns what the command handlers returned, the first one being the result of
+        # the message that was handed in (most handlers return None)
+        results = []
         while self.queue:
-            message = self.queue.pop(0)
+            message = self.queue.popleft()
             if isinstance(message, events.Event):
                 self.handle_event(message)
             elif isinstance(message, commands.Command):
-                self.handle_command(message)
+                results.append(self.handle_command(message))
             else:
                 raise Exception(f"{message} was not an Event or Command")
+        return results
 
-    def handle_command(self, command: commands.Command):
+    def handle_command(self, command: commands.Command) -> Any:
         logger.debug("handling command %s", command)
+        attempt = 1
         try:
             handler = self.COMMAND_HANDLERS[type(command)]
-            handler(command)
+            while True:
+                try:
+                    result = handler(command)
+                    break
+                except ConcurrencyConflict:
+                    if attempt >= self.conflicts.max_attempts:
+                        raise
+                    # the handler opens a new unit of work, so it reads the product again
+                    metrics.increment("command_conflict_retries")
+                    time.sleep(self.conflicts.delay(attempt))
+                    attempt += 1
             self.queue.extend(self.uow.collect_new_events())
+            return result
         except Exception as e:
-            logger.exception("Exception %s  while handling command %s", e, command)
+            logger.exception("Exception %s  while handling command %s (attempt %s)", e, command, attempt)
             raise
 
     def handle_event(self, event: events.Event):
         for handler in self.EVENT_HANDLERS[type(event)]:
             try:
-                for attempt in Retrying(
-                    stop=stop_after_attempt(3),
-                    wait=wait_exponential()
-                ):
-                    with attempt:
-                        logger.debug("handling event %s with handler %s", event, handler)
-                        handler(event)
-                        self.queue.extend(self.uow.collect_new_events())  # only collected if has not failed
-            except RetryError as retry_failure:
-                logger.error(
-                    "Failed to handle event %s times, giving up!",
-                    retry_failure.last_attempt.attempt_number
-                )
-                continue
+                logger.debug("handling event %s with handler %s", event, handler)
+                handler(event)
+                self.queue.extend(self.uow.collect_new_events())  # only collected if has not failed
+            except Exception as e:
+                if self.retries is None:
+                    logger.exception("Failed to handle event %s with handler %s, giving up!", event, handler)
+                    continue
+                logger.warning("Failed to handle event %s with handler %s, retrying later: %r", event, handler, e)
+                self.retries.schedule(event, handler.__name__, attempt=1, error=repr(e))
+
+
+def conflict_policy() -> RetryPolicy:
+    # conflicts clear up in milliseconds; the jitter (up to the delay itself) spreads the
+    # losers out so they don't collide again
+    return RetryPolicy(max_attempts=5, base_delay=0.005, max_delay=0.2, jitter=1.0)
+
+
+async def run_handler(handler: Callable, message: Message) -> Any:
+    # coroutine handlers are awaited, plain (blocking) ones go to a worker thread
+    if inspect.iscoroutinefunction(inspect.unwrap(handler)):
+        return await handler(message)
+    return await asyncio.to_thread(handler, message)
+
+
+class AsyncMessageBus:
+    """
+    Same contract as MessageBus, but the handlers of one event run concurrently: they
+    don't depend on each other (updating the read model and reallocating, for instance),
+    so their round trips overlap instead of adding up.
+    Commands, and the messages they raise, are still handled strictly one after another,
+    and an event's follow-up messages are only queued once all of its handlers are done.
+    Every handle() call has its own queue, so concurrent callers never run (or get back)
+    each other's messages.
+    """
+
+    def __init__(
+            self,
+            uow: unit_of_work.AbstractAsyncUnitOfWork,
+            event_handlers: Dict[Type[events.Event], List[Callable]],
+            command_handlers: Dict[Type[commands.Command], Callable],
+            retries: Optional[RetryScheduler] = None,
+            conflicts: Optional[RetryPolicy] = None,
+    ):
+        self.EVENT_HANDLERS = event_handlers
+        self.COMMAND_HANDLERS = command_handlers
+        self.uow = uow
+        # failed event handlers go to the scheduler, like on the MessageBus
+        self.retries = retries
+        if retries is not None and retries.dispatch is None:
+            retries.dispatch = self.handle_retry
+        self.conflicts = conflicts or conflict_policy()
+        # the loop handle() last ran on, where the scheduler's thread sends the retries
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        # the queue of the handle() call running in this context, like the async uow's session
+        self._queue = contextvars.ContextVar(
+            f"async_bus_queue_{id(self)}", default=None
+        )  # type: contextvars.ContextVar[Optional[Deque[Message]]]
+
+    @property
+    def queue(self) -> Deque[Message]:
+        queue = self._queue.get()
+        if queue is None:
+            raise RuntimeError("the bus' queue is only there while handle() runs")
+        return queue
+
+    async def handle(self, message: Message) -> List[Any]:
+        self._loop = asyncio.get_running_loop()
+        return await self.process_queue(deque([message]))
+
+    def handle_retry(self, failed: FailedEvent):
+        # runs on the scheduler's thread: the handler goes to the bus' loop, where its
+        # connections live, and a failure is raised here so the scheduler reschedules it
+        if self._loop is None:
+            raise RuntimeError("the bus has no loop to retry on before it handled anything")
+        asyncio.run_coroutine_threadsafe(self.retry(failed), self._loop).result()
+
+    async def retry(self, failed: FailedEvent):
+        handler = next(
+            h for h in self.EVENT_HANDLERS[type(failed.event)] if h.__name__ == failed.handler
+        )
+        logger.debug("retrying event %s with handler %s (attempt %s)", failed.event, handler, failed.attempt + 1)
+        await run_handler(handler, failed.event)
+        await self.process_queue(deque(self.uow.collect_new_events()))
+
+    async def process_queue(self, queue: Deque[Message]) -> List[Any]:
+        results = []
+        token = self._queue.set(queue)
+        try:
+            while queue:
+                message = queue.popleft()
+                if isinstance(message, events.Event):
+                    await self.handle_event(message)
+                elif isinstance(message, commands.Command):
+                    results.append(await self.handle_command(message))
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+        finally:
+            self._queue.reset(token)
+        return results
+
+    async def handle_command(self, command: commands.Command) -> Any:
+        logger.debug("handling command %s", command)
+        attempt = 1
+        try:
+            handler = self.COMMAND_HANDLERS[type(command)]
+            while True:
+                try:
+                    result = await run_handler(handler, command)
+                    break
+                except ConcurrencyConflict:
+                    if attempt >= self.conflicts.max_attempts:
+                        raise
+                    metrics.increment("command_conflict_retries")
+                    await asyncio.sleep(self.conflicts.delay(attempt))
+                    attempt += 1
+            self.queue.extend(self.uow.collect_new_events())
+            return result
+        except Exception as e:
+            logger.exception("Exception %s  while handling command %s (attempt %s)", e, command, attempt)
+            raise
+
+    async def handle_event(self, event: events.Event):
+        new_messages = await asyncio.gather(
+            *(self.run_event_handler(handler, event) for handler in self.EVENT_HANDLERS[type(event)])
+        )
+        for messages in new_messages:
+            self.queue.extend(messages)
+
+    async def run_event_handler(self, handler: Callable, event: events.Event) -> List[Message]:
+        try:
+            logger.debug("handling event %s with handler %s", event, handler)
+            await run_handler(handler, event)
+            # collected inside this handler's own task, so it only sees what it raised
+            return list(self.uow.collect_new_events())
+        except Exception as e:
+            if self.retries is None:
+                logger.exception("Failed to handle event %s with handler %s, giving up!", event, handler)
+                return []
+            logger.warning("Failed to handle event %s with handler %s, retrying later: %r", event, handler, e)
+            # the store may be the database, so it is written off the loop
+            await asyncio.to_thread(self.retries.schedule, event, handler.__name__, attempt=1, error=repr(e))
+        return []
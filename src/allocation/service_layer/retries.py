@@ -0,0 +1,83 @@
+# Event handlers that fail aren't retried in place any more (backing off there kept the
+# request thread, and so the command's response, waiting on redis/smtp). The bus hands
+# them to a RetryScheduler instead, which runs them again later on its own thread.
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from src.allocation.adapters.retry_store import AbstractRetryStore, FailedEvent
+from src.allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 5
+    base_delay: float = 1.0  # seconds, doubled on every attempt
+    max_delay: float = 300.0
+    jitter: float = 0.5  # up to this fraction of the delay is added at random
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay + random.uniform(0, self.jitter * delay)
+
+
+class RetryScheduler:
+    def __init__(self, store: AbstractRetryStore, policy: Optional[RetryPolicy] = None, poll_interval: float = 0.5,
+                 lease: float = 60.0):
+        self.store = store
+        self.policy = policy or RetryPolicy()
+        self.poll_interval = poll_interval
+        self.lease = lease  # seconds a claimed retry is left to this scheduler before another takes it
+        self.dispatch = None  # type: Optional[Callable[[FailedEvent], None]]
+        self._stopped = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def schedule(self, event: events.Event, handler: str, attempt: int, error: str):
+        self._retry_later(FailedEvent(event=event, handler=handler, attempt=attempt, error=error))
+
+    def run_pending(self, now: Optional[float] = None) -> int:
+        assert self.dispatch is not None, "no message bus to run the retries on"
+        due = self.store.claim_due(now if now is not None else time.time(), lease=self.lease)
+        for failed in due:
+            try:
+                self.dispatch(failed)
+            except Exception as e:
+                logger.warning("retry %s of %s for %s failed: %r", failed.attempt, failed.handler, failed.event, e)
+                failed.attempt += 1
+                failed.error = repr(e)
+                self._retry_later(failed)
+            else:
+                self.store.done(failed)
+        return len(due)
+
+    def _retry_later(self, failed: FailedEvent):
+        if failed.attempt >= self.policy.max_attempts:
+            logger.error("handler %s failed %s times for %s, dead lettering it",
+                         failed.handler, failed.attempt, failed.event)
+            self.store.dead_letter(failed)
+            return
+        failed.due_at = time.time() + self.policy.delay(failed.attempt)
+        self.store.add(failed)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="event-retries", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_pending()
+            except Exception:
+                logger.exception("retry scheduler failed, carrying on")
+            self._stopped.wait(self.poll_interval)
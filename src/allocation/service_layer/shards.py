@@ -0,0 +1,249 @@
+# Runs the write side on several processes, each one owning the products whose sku hashes to
+# it: commands for different skus run on different cores (each process has its own GIL), while
+# every product still has a single writer, which also keeps its product cache warm.
+#
+# Only one process may start the shards, the router (entrypoints/shard_router.py): two sets of
+# shards would be two writers per sku again. The api and the consumers reach it over a socket
+# through ShardRouterClient.
+import logging
+import multiprocessing
+import pickle
+import threading
+from concurrent import futures
+from concurrent.futures import Future
+from itertools import count
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.allocation.domain import commands
+from src.allocation.service_layer.workers import partition_of
+
+logger = logging.getLogger(__name__)
+
+_STOP = None
+
+
+def _picklable(error: Exception) -> Exception:
+    try:
+        return pickle.loads(pickle.dumps(error))
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+def _serve(bus_factory: Callable[[], Callable[[Any], Any]], requests, results):
+    # runs inside every shard: its own bus, unit of work, pools and caches
+    handle = bus_factory()
+    while True:
+        request = requests.get()
+        if request is _STOP:
+            return
+        request_id, message = request
+        try:
+            outcome = (request_id, True, handle(message))
+        except Exception as e:
+            if request_id is None:
+                logger.exception("Exception handling %s", message)
+                continue
+            outcome = (request_id, False, _picklable(e))
+        if request_id is not None:
+            results.put(outcome)
+
+
+class ShardedMessageBus:
+    """
+    Hands every command to the process that owns its sku, over multiprocessing queues.
+    handle() waits for the owner's result (and raises what it raised), submit() doesn't.
+
+    bus_factory runs once inside every shard, so it has to be picklable (a module level
+    function). ChangeBatchQuantity only has a batch reference: sku_for_batchref finds out
+    its sku, if it can't the command goes by reference and the version check on the
+    product still keeps the two writers from overwriting each other.
+    """
+
+    def __init__(self, bus_factory: Callable[[], Callable[[Any], Any]], shards: int = 4,
+                 queue_size: int = 1000, timeout: Optional[float] = 30,
+                 sku_for_batchref: Optional[Callable[[str], Optional[str]]] = None,
+                 start_method: str = "spawn"):
+        # spawn: nothing (engines, pools, threads) is inherited from this process
+        context = multiprocessing.get_context(start_method)  # type: Any  # only the concrete contexts type Process
+        self.shards = shards
+        self.timeout = timeout
+        self.sku_for_batchref = sku_for_batchref
+        self._skus_by_batchref = {}  # type: Dict[str, str]
+        self._requests = [context.Queue(maxsize=queue_size) for _ in range(shards)]
+        self._results = context.Queue()
+        self._pending = {}  # type: Dict[int, Future]
+        self._ids = count()
+        self._lock = threading.Lock()
+        self._processes = [
+            context.Process(target=_serve, args=(bus_factory, q, self._results), name=f"shard-{i}", daemon=True)
+            for i, q in enumerate(self._requests)
+        ]
+        for process in self._processes:
+            process.start()
+        self._collector = threading.Thread(target=self._collect, name="shard-results", daemon=True)
+        self._collector.start()
+
+    def shard(self, command: commands.Command) -> int:
+        return partition_of(self.key(command), len(self._requests))
+
+    def key(self, command: commands.Command) -> str:
+        if isinstance(command, commands.ChangeBatchQuantity):
+            return self._sku_for(command.ref) or command.ref
+        if isinstance(command, (commands.Allocate, commands.CreateBatch)):
+            return command.sku
+        raise ValueError(f"no shard key for {type(command).__name__}")
+
+    def handle(self, command: commands.Command) -> List[Any]:
+        if isinstance(command, commands.AllocateMany):
+            return [self._allocate_many(command)]
+        return self._wait(*self._send(self.shard(command), command))
+
+    def submit(self, command: commands.Command):
+        if isinstance(command, commands.AllocateMany):
+            for shard, (_, part) in self._split(command).items():
+                self._requests[shard].put((None, part))
+        else:
+            self._requests[self.shard(command)].put((None, command))
+
+    def shutdown(self, wait: bool = True):
+        # the sentinel goes behind whatever is queued, so in-flight work still finishes
+        for q in self._requests:
+            q.put(_STOP)
+        if wait:
+            for process in self._processes:
+                process.join()
+            self._results.put(_STOP)
+            self._collector.join()
+
+    def _allocate_many(self, command: commands.AllocateMany) -> List[Dict]:
+        # every shard allocates its own lines (one commit each), the outcomes go back in order
+        parts = {
+            shard: (positions, self._send(shard, part))
+            for shard, (positions, part) in self._split(command).items()
+        }
+        outcomes = [{} for _ in command.lines]  # type: List[Dict]
+        for positions, sent in parts.values():
+            [part_outcomes, *_] = self._wait(*sent)
+            for position, outcome in zip(positions, part_outcomes):
+                outcomes[position] = outcome
+        return outcomes
+
+    def _split(self, command: commands.AllocateMany) -> Dict[int, tuple]:
+        positions_by_shard = {}  # type: Dict[int, List[int]]
+        for position, line in enumerate(command.lines):
+            positions_by_shard.setdefault(self.shard(line), []).append(position)
+        return {
+            shard: (positions, commands.AllocateMany(tuple(command.lines[p] for p in positions)))
+            for shard, positions in positions_by_shard.items()
+        }
+
+    def _sku_for(self, ref: str) -> Optional[str]:
+        # a batch never changes sku, so whatever was found is kept
+        if ref not in self._skus_by_batchref and self.sku_for_batchref is not None:
+            sku = self.sku_for_batchref(ref)
+            if sku is not None:
+                self._skus_by_batchref[ref] = sku
+        return self._skus_by_batchref.get(ref)
+
+    def _send(self, shard: int, command: commands.Command) -> Tuple[int, Future]:
+        future = Future()  # type: Future
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        self._requests[shard].put((request_id, command))
+        return request_id, future
+
+    def _wait(self, request_id: int, future: Future) -> Any:
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            # nobody waits for it any more: its result is dropped when (if) it comes
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise
+
+    def _collect(self):
+        while True:
+            result = self._results.get()
+            if result is _STOP:
+                return
+            request_id, ok, value = result
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+def serve_router(bus: ShardedMessageBus, listener: Listener):
+    # until the listener is closed: a thread per connection (a request thread of the api, a
+    # consumer), each waiting for its own results
+    while True:
+        try:
+            connection = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=_route, args=(bus, connection), name="shard-router", daemon=True).start()
+
+
+def _route(bus: ShardedMessageBus, connection: Connection):
+    with connection:
+        while True:
+            try:
+                kind, command = connection.recv()
+            except (EOFError, OSError):
+                return
+            if kind == "submit":
+                bus.submit(command)
+                continue
+            try:
+                reply = (True, bus.handle(command))  # type: Tuple[bool, Any]
+            except Exception as e:
+                reply = (False, _picklable(e))
+            try:
+                connection.send(reply)
+            except OSError:
+                return  # the client timed out and went away
+
+
+class ShardRouterClient:
+    """
+    What the api and the consumers hold instead of a bus when the commands run on the shards:
+    handle() sends a command to the router and waits for the owning shard's result, submit()
+    doesn't wait. One connection per thread, opened on first use.
+    """
+
+    def __init__(self, address: Tuple[str, int], authkey: bytes, timeout: Optional[float] = 30):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def handle(self, command: commands.Command) -> List[Any]:
+        connection = self._connection()
+        connection.send(("handle", command))
+        if not connection.poll(self.timeout):
+            # its reply would be taken for the next command's, so that connection is done
+            self._close()
+            raise TimeoutError(f"no reply from the shard router for {command}")
+        ok, value = connection.recv()
+        if not ok:
+            raise value
+        return value
+
+    def submit(self, command: commands.Command):
+        self._connection().send(("submit", command))
+
+    def _connection(self) -> Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = Client(self.address, authkey=self.authkey)
+        return connection
+
+    def _close(self):
+        self._local.connection.close()
+        self._local.connection = None
@@ -1,9 +1,34 @@
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from src.allocation import config
-from src.allocation.adapters import repository
+import contextvars
+import functools
+import threading
+from dataclasses import dataclass, field
+from typing import Optional, Set, Iterable, List, Dict
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm.exc import StaleDataError
+from src.allocation.adapters import repository, orm, outbox, database
+from src.allocation.domain import model
+
+
+class ConcurrencyConflict(Exception):
+    # someone else changed the same product since we read it: the whole use case can be
+    # run again over a fresh copy of it
+    pass
+
+
+# serialization_failure (a concurrent update under REPEATABLE READ) and deadlock_detected
+SERIALIZATION_ERRORS = {"40001", "40P01"}
+
+
+def is_concurrency_conflict(error: Exception) -> bool:
+    if isinstance(error, StaleDataError):
+        return True
+    return isinstance(error, DBAPIError) and getattr(error.orig, "pgcode", None) in SERIALIZATION_ERRORS
 
 
 class AbstractUnitOfWork(abc.ABC):
@@ -18,7 +43,7 @@ class AbstractUnitOfWork(abc.ABC):
     def collect_new_events(self):
         for product in self.products.tracked:
             while product.messages:
-                yield product.messages.pop(0)
+                yield product.messages.popleft()
 
     @abc.abstractmethod
     def commit(self):
@@ -29,29 +54,214 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-    )
-)
+def new_outbox_rows(products: Iterable[model.Product], written: Set[int]) -> List[Dict]:
+    # events still waiting in the aggregates that the outbox hasn't seen in this unit of work
+    # (a handler may commit more than once before its events are collected)
+    new_events = [
+        message
+        for product in products
+        for message in product.messages
+        if outbox.is_published(message) and id(message) not in written
+    ]
+    written.update(id(message) for message in new_events)
+    return outbox.rows_for(new_events)
+
+
+@functools.lru_cache(maxsize=None)
+def default_session_factory() -> sessionmaker:
+    # built on first use: importing this module doesn't connect anywhere, and bootstrap
+    # can hand in a session factory over its own engine instead
+    return sessionmaker(bind=database.default_engine())
+
+
+@functools.lru_cache(maxsize=None)
+def default_read_session_factory() -> sessionmaker:
+    return sessionmaker(bind=database.default_read_engine())
+
+
+class ReadOnlyUnitOfWork:
+    # for the views: a session over the read engine (READ COMMITTED, read only, maybe a
+    # replica) and nothing else, no repository, no events, no commit
+    def __init__(self, session_factory: Optional[sessionmaker] = None):
+        self.session_factory = session_factory or default_read_session_factory()
+
+    def __enter__(self) -> ReadOnlyUnitOfWork:
+        self.session = self.session_factory()
+        return self
+
+    def __exit__(self, *args):
+        self.session.close()
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
-        self.session_factory = session_factory
+    # bootstrap gives the same instance to every handler and the bus is used by many threads,
+    # so the session (a scoped_session) and the repository belong to the thread that opened them
+    def __init__(self, session_factory: Optional[sessionmaker] = None,
+                 product_cache: Optional[repository.ProductCache] = None):
+        self.session_factory = session_factory or default_session_factory()
+        self._sessions = scoped_session(self.session_factory)
+        self._local = threading.local()
+        # committed products are only reused if the session factory has expire_on_commit=False
+        self.product_cache = product_cache
+
+    @property
+    def session(self):
+        return self._sessions()
+
+    @property
+    def products(self) -> repository.AbstractProductRepository:
+        return self._local.products
+
+    @products.setter
+    def products(self, products: repository.AbstractProductRepository):
+        self._local.products = products
+
+    @property
+    def outboxed(self) -> Set[int]:
+        return self._local.outboxed
 
     def __enter__(self):
-        self.session = self.session_factory()
-        self.products = repository.SqlAlchemyProductRepository(self.session)
+        self._give_back_committed()
+        if self.product_cache is not None:
+            self.products = repository.CachingProductRepository(self.session, self.product_cache)
+        else:
+            self.products = repository.SqlAlchemyProductRepository(self.session)
+        self._local.outboxed = set()
+        self._local.committed = set()
         return super().__enter__()
 
-    def __exit(self, *args):
-        super().__exit__(*args)
-        self.session.close()
+    def __exit__(self, *args):
+        try:
+            super().__exit__(*args)
+        finally:
+            # closes the session and gives its connection back to the pool right away;
+            # the products stay tracked (detached) until the bus collects their events
+            self._sessions.remove()
+
+    def collect_new_events(self):
+        if not hasattr(self._local, "products"):  # this thread hasn't opened it yet
+            return
+        yield from super().collect_new_events()
+        self._give_back_committed()
+
+    def _give_back_committed(self):
+        if self.product_cache is None:
+            return
+        # from here on another thread may take them out, so this one stops tracking them
+        for product in getattr(self._local, "committed", ()):
+            self.products.tracked.discard(product)
+            self.product_cache.give_back(product)
+        self._local.committed = set()
 
     def commit(self):
-        self.session.commit()
+        try:
+            rows = new_outbox_rows(self.products.tracked, self.outboxed)
+            if rows:
+                self.session.execute(insert(orm.outbox), rows)
+            self.session.commit()
+        except Exception as e:
+            if is_concurrency_conflict(e):
+                raise ConcurrencyConflict(str(e)) from e
+            raise
+        self._local.committed.update(self.products.tracked)
 
     def rollback(self):
         self.session.rollback()
+
+
+class AbstractAsyncUnitOfWork(abc.ABC):
+    products: repository.AbstractAsyncProductRepository
+
+    async def __aenter__(self) -> AbstractAsyncUnitOfWork:
+        return self
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+
+    def collect_new_events(self):
+        for product in self.products.tracked:
+            while product.messages:
+                yield product.messages.popleft()
+
+    @abc.abstractmethod
+    async def commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+@functools.lru_cache(maxsize=None)
+def default_async_session_factory() -> async_sessionmaker:
+    # built on first use, so importing this module doesn't need the async driver installed
+    return async_sessionmaker(
+        bind=database.default_async_engine(),
+        expire_on_commit=False,  # no implicit (and so blocking) reloads after commit
+    )
+
+
+@dataclass
+class AsyncUnitOfWorkState:
+    session: AsyncSession
+    products: repository.AbstractAsyncProductRepository
+    outboxed: Set[int] = field(default_factory=set)
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+    # The AsyncMessageBus runs the handlers of an event concurrently and they all share this
+    # instance, so the session and the repository live in a context variable: every asyncio
+    # task sees the ones it opened itself.
+    def __init__(self, session_factory: Optional[async_sessionmaker] = None):
+        self.session_factory = session_factory
+        self._current = contextvars.ContextVar(
+            f"async_uow_{id(self)}", default=None
+        )  # type: contextvars.ContextVar[Optional[AsyncUnitOfWorkState]]
+
+    @property
+    def session(self) -> AsyncSession:
+        return self._current_state().session
+
+    @property
+    def products(self) -> repository.AbstractAsyncProductRepository:
+        return self._current_state().products
+
+    @products.setter
+    def products(self, products: repository.AbstractAsyncProductRepository):
+        self._current_state().products = products
+
+    def _current_state(self) -> AsyncUnitOfWorkState:
+        state = self._current.get()
+        if state is None:
+            raise RuntimeError("unit of work used outside of an 'async with' block")
+        return state
+
+    async def __aenter__(self):
+        if self.session_factory is None:
+            self.session_factory = default_async_session_factory()
+        session = self.session_factory()
+        self._current.set(AsyncUnitOfWorkState(session, repository.AsyncSqlAlchemyProductRepository(session)))
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        await self.session.close()
+
+    def collect_new_events(self):
+        if self._current.get() is None:
+            return iter(())
+        return super().collect_new_events()
+
+    async def commit(self):
+        try:
+            rows = new_outbox_rows(self.products.tracked, self._current_state().outboxed)
+            if rows:
+                await self.session.execute(insert(orm.outbox), rows)
+            await self.session.commit()
+        except Exception as e:
+            if is_concurrency_conflict(e):
+                raise ConcurrencyConflict(str(e)) from e
+            raise
+
+    async def rollback(self):
+        await self.session.rollback()
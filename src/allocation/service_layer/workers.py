@@ -0,0 +1,59 @@
+# Runs messages on a fixed set of threads, partitioned by key: everything with the same key
+# (a sku, say) goes to the same worker and is handled in arrival order, while different keys
+# are handled in parallel.
+import logging
+import queue
+import threading
+import zlib
+from typing import Any, Callable, List
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def partition_of(key: str, partitions: int) -> int:
+    # crc32 instead of hash(): str hashes change between processes
+    return zlib.crc32(key.encode()) % partitions
+
+
+class PartitionedWorkerPool:
+
+    def __init__(self, handler_factory: Callable[[], Callable[[Any], Any]], workers: int = 4,
+                 queue_size: int = 1000):
+        # handler_factory runs once inside every worker, so each one gets its own message
+        # bus and unit of work
+        self.handler_factory = handler_factory
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]  # type: List[queue.Queue]
+        self._threads = [
+            threading.Thread(target=self._work, args=(q,), name=f"worker-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def partition(self, key: str) -> int:
+        return partition_of(key, len(self._queues))
+
+    def submit(self, key: str, message):
+        # blocks when that worker is queue_size messages behind, which slows the reader down
+        self._queues[self.partition(key)].put(message)
+
+    def shutdown(self, wait: bool = True):
+        # the sentinel goes behind whatever is queued, so in-flight work still finishes
+        for q in self._queues:
+            q.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _work(self, messages: queue.Queue):
+        handle = self.handler_factory()
+        while True:
+            message = messages.get()
+            if message is _STOP:
+                return
+            try:
+                handle(message)
+            except Exception:
+                logger.exception("Exception handling %s", message)
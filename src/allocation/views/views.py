@@ -1,9 +1,22 @@
+from typing import Optional, List, Dict
+
 from sqlalchemy import text
 
+from src.allocation.adapters.cache import AbstractCache
 from src.allocation.service_layer import unit_of_work
 
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def cache_key(orderid: str) -> str:
+    # one entry per order: the read model handlers invalidate it whenever one of its lines changes
+    return f"allocations:{orderid}"
+
+
+def allocations(orderid: str, uow: unit_of_work.ReadOnlyUnitOfWork,
+                cache: Optional[AbstractCache] = None) -> List[Dict]:
+    if cache is not None:
+        cached = cache.get(cache_key(orderid))
+        if cached is not None:
+            return cached
     with uow:
         results = uow.session.execute(text(
             """
@@ -11,15 +24,22 @@ def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
             """),
             dict(orderid=orderid),
         )
-    return [{"sku": sku, "batchref": batchref} for sku, batchref in results]
+        rows = [{"sku": sku, "batchref": batchref} for sku, batchref in results]
+    # an order not found (yet) isn't cached: its lines may be allocated by another process
+    # any moment now, and nothing would invalidate the empty entry in this one
+    if cache is not None and rows:
+        cache.set(cache_key(orderid), rows)
+    return rows
+
+
+def allocation(orderid: str, sku: str, uow: unit_of_work.ReadOnlyUnitOfWork,
+               cache: Optional[AbstractCache] = None) -> Optional[Dict]:
+    # served from the order's cached rows, so it doesn't need entries (nor invalidations) of its own
+    return next((row for row in allocations(orderid, uow, cache) if row["sku"] == sku), None)
 
 
-def allocation(orderid: str, sku: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def sku_for_batch(ref: str, uow: unit_of_work.ReadOnlyUnitOfWork) -> Optional[str]:
     with uow:
-        results = uow.session.execute(text(
-            """
-                SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid AND sku = :sku
-            """),
-            dict(orderid=orderid, sku=sku),
-        )
-        return dict(results.mappings().one_or_none())
+        return uow.session.execute(
+            text("SELECT sku FROM batches WHERE reference = :ref"), dict(ref=ref)
+        ).scalar()
@@ -0,0 +1,49 @@
+# Microbenchmark: Product.allocate latency against the number of batches of a sku.
+# Not collected by pytest, run it with:
+#   python -m tests.benchmarks.bench_allocate
+import random
+import time
+from datetime import date, timedelta
+
+from src.allocation.domain.model import Product, Batch, OrderLine
+
+SKU = "HOT-SKU"
+BATCH_COUNTS = [10, 100, 1_000, 5_000]
+LINES = 500
+
+
+def build_product(n_batches: int) -> Product:
+    rnd = random.Random(n_batches)
+    product = Product(SKU)
+    for i in range(n_batches):
+        eta = None if i % 10 == 0 else date.today() + timedelta(days=rnd.randint(1, 365))
+        product.add_stock(Batch(f"batch-{i}", SKU, rnd.randint(1, 50), eta))
+    return product
+
+
+def naive_allocate(product: Product, line: OrderLine):
+    # what Product.allocate used to do: sort every batch on every line
+    batch = next((b for b in sorted(product.batches) if b.can_allocate(line)), None)
+    if batch:
+        batch.allocate(line)
+
+
+def time_per_line(allocate, n_batches: int) -> float:
+    product = build_product(n_batches)
+    lines = [OrderLine(f"order-{i}", SKU, 1) for i in range(LINES)]
+    start = time.perf_counter()
+    for line in lines:
+        allocate(product, line)
+    return (time.perf_counter() - start) / LINES
+
+
+def main():
+    print(f"{'batches':>8} {'sorted() us/line':>18} {'eta-ordered us/line':>20}")
+    for n_batches in BATCH_COUNTS:
+        naive = time_per_line(naive_allocate, n_batches)
+        ordered = time_per_line(Product.allocate, n_batches)
+        print(f"{n_batches:>8} {naive * 1e6:>18.1f} {ordered * 1e6:>20.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Messages per second through the redis wire: json.dumps(asdict(...)) and the hand-written
+# consumer mappers it replaced, against the generated codecs, JSON and binary.
+# Not collected by pytest, run it with:
+#   python -m tests.benchmarks.bench_codecs
+import json
+import time
+from dataclasses import asdict
+from datetime import date
+
+from src.allocation.adapters import codecs
+from src.allocation.domain import commands, events
+
+N = 200_000
+
+
+def old_decode(channel, payload):
+    # redis_eventconsumer's commands_mappers
+    data = json.loads(payload)
+    if channel == "change_batch_quantity":
+        return commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
+    return commands.Allocate(orderid=data["orderid"], sku=data["sku"], qty=data["qty"])
+
+
+def per_second(function, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(N):
+        function(*args)
+    return N / (time.perf_counter() - start)
+
+
+def main():
+    print(f"{'':>26} {'asdict+json/s':>14} {'codec json/s':>13} {'codec binary/s':>15} {'bytes j/b':>10}")
+    for message in [events.Allocated("order-1234", "RED-CHAIR", 3, "batch-0001"),
+                    commands.CreateBatch("batch-0001", "RED-CHAIR", 100, date(2026, 5, 17))]:
+        old = per_second(lambda m: json.dumps(asdict(m), default=str), message)
+        new = per_second(codecs.encode, message)
+        binary = per_second(codecs.encode, message, True)
+        sizes = f"{len(codecs.encode(message))}/{len(codecs.encode(message, True))}"
+        print(f"{'encode ' + type(message).__name__:>26} {old:>14.0f} {new:>13.0f} {binary:>15.0f} {sizes:>10}")
+
+    message = commands.Allocate("order-1234", "RED-CHAIR", 3)
+    as_json = codecs.encode(message).encode()
+    as_binary = codecs.encode(message, True)
+    old = per_second(old_decode, "allocate_line", as_json)
+    new = per_second(codecs.decode, "allocate_line", as_json)
+    binary = per_second(codecs.decode, "allocate_line", as_binary)
+    print(f"{'decode Allocate':>26} {old:>14.0f} {new:>13.0f} {binary:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
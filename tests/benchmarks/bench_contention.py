@@ -0,0 +1,68 @@
+# Many threads allocating the same sku through one bus: throughput, how many commands had
+# to be run again after a version conflict, how many gave up, and the latency percentiles.
+# Needs the postgres from config (make up), or a database url in BENCH_DB_URI:
+#   python -m tests.benchmarks.bench_contention
+import os
+import statistics
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine
+
+from src.allocation import bootstrap, config
+from src.allocation.adapters import orm
+from src.allocation.adapters.metrics import metrics
+from src.allocation.domain import commands
+from src.allocation.service_layer.unit_of_work import ConcurrencyConflict
+
+THREAD_COUNTS = [1, 4, 16, 32]
+ALLOCATIONS_PER_THREAD = 50
+
+
+def run(bus, n_threads: int):
+    sku = f"HOT-{uuid.uuid4().hex[:6]}"
+    bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 1_000_000, None))
+    latencies, gave_up = [], []
+
+    def client(n):
+        for i in range(ALLOCATIONS_PER_THREAD):
+            start = time.perf_counter()
+            try:
+                bus.handle(commands.Allocate(f"order-{sku}-{n}-{i}", sku, 1))
+            except ConcurrencyConflict:
+                gave_up.append(1)
+            latencies.append(time.perf_counter() - start)
+
+    metrics.reset()
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    retries = metrics.snapshot()["counters"].get("command_conflict_retries", 0)
+    return len(latencies) / elapsed, retries, len(gave_up), percentiles[49] * 1000, percentiles[98] * 1000
+
+
+def main():
+    uri = os.environ.get("BENCH_DB_URI", config.get_postgres_uri())
+    if uri.startswith("postgresql"):
+        options = dict(isolation_level="REPEATABLE READ")
+    else:
+        options = dict(connect_args={"check_same_thread": False, "timeout": 60})
+    engine = create_engine(uri, pool_size=max(THREAD_COUNTS), **options)
+    orm.metadata.create_all(engine)
+    bus = bootstrap.bootstrap(engine=engine)
+    print(f"{'threads':>8} {'allocations/s':>14} {'retries':>8} {'gave up':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for n_threads in THREAD_COUNTS:
+        throughput, retries, gave_up, p50, p99 = run(bus, n_threads)
+        print(f"{n_threads:>8} {throughput:>14.0f} {retries:>8} {gave_up:>8} {p50:>8.1f} {p99:>8.1f}")
+    bus.retries.stop()
+
+
+if __name__ == "__main__":
+    main()
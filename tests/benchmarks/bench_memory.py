@@ -0,0 +1,53 @@
+# Bytes per message (events and commands) with the old plain dataclasses against the current
+# frozen, slotted ones, and bytes per order line, which the ORM mapping keeps as it is.
+# Not collected by pytest, run it with:
+#   python -m tests.benchmarks.bench_memory
+import tracemalloc
+from dataclasses import dataclass
+
+from src.allocation.domain import commands, events
+from src.allocation.domain.model import OrderLine
+
+N = 100_000
+
+
+@dataclass
+class PlainDeallocated:
+    # events.Deallocated as it was
+    orderid: str
+    sku: str
+    qty: int
+
+
+@dataclass
+class PlainAllocate:
+    orderid: str
+    sku: str
+    qty: int
+
+
+def bytes_per_instance(build) -> float:
+    # the orderids are built beforehand, so only the instances are counted
+    orderids = [f"order-{i}" for i in range(N)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [build(orderid, "RED-CHAIR", 1) for orderid in orderids]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del instances
+    # minus the list holding them
+    return (after - before) / N - 8
+
+
+def main():
+    print(f"{'':>12} {'plain B':>8} {'slotted B':>10}")
+    for name, plain, slotted in [
+        ("event", PlainDeallocated, events.Deallocated),
+        ("command", PlainAllocate, commands.Allocate),
+    ]:
+        print(f"{name:>12} {bytes_per_instance(plain):>8.0f} {bytes_per_instance(slotted):>10.0f}")
+    print(f"{'order line':>12} {bytes_per_instance(OrderLine):>8.0f} {'(mapped)':>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Benchmark: MessageBus throughput (messages/sec) for wide fan-out cascades, against the
+# in-memory FakeUnitOfWork. Not collected by pytest, run it with:
+#   python -m tests.benchmarks.bench_messagebus
+import time
+
+from src.allocation.domain import commands, events
+from src.allocation.service_layer import handlers
+from src.allocation.service_layer.messagebus import MessageBus
+from tests.unit.test_handlers import FakeUnitOfWork
+
+SKU = "FAN-OUT-TABLE"
+FAN_OUTS = [100, 1_000, 5_000, 20_000]
+
+
+class CountingMessageBus(MessageBus):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handled = 0
+
+    def handle_event(self, event: events.Event):
+        self.handled += 1
+        super().handle_event(event)
+
+    def handle_command(self, command: commands.Command):
+        self.handled += 1
+        return super().handle_command(command)
+
+
+def build_bus() -> CountingMessageBus:
+    uow = FakeUnitOfWork()
+    return CountingMessageBus(
+        uow=uow,
+        event_handlers={
+            events.Allocated: [lambda e: None],
+            events.Deallocated: [lambda e: handlers.reallocate(e, uow)],
+            events.OutOfStock: [lambda e: None],
+        },
+        command_handlers={
+            commands.Allocate: lambda c: handlers.allocate(c, uow),
+            commands.CreateBatch: lambda c: handlers.add_batch(c, uow),
+            commands.ChangeBatchQuantity: lambda c: handlers.change_batch_quantity(c, uow),
+        },
+    )
+
+
+def run_cascade(fan_out: int):
+    # every line sits on "batch1"; emptying it deallocates all of them, and each
+    # Deallocated turns into a reallocate -> Allocate -> Allocated chain on "batch2"
+    bus = build_bus()
+    bus.handle(commands.CreateBatch("batch1", SKU, fan_out, None))
+    bus.handle(commands.CreateBatch("batch2", SKU, fan_out, None))
+    for i in range(fan_out):
+        bus.handle(commands.Allocate(f"order-{i}", SKU, 1))
+
+    bus.handled = 0
+    start = time.perf_counter()
+    bus.handle(commands.ChangeBatchQuantity("batch1", 0))
+    elapsed = time.perf_counter() - start
+    return bus.handled, elapsed
+
+
+def main():
+    print(f"{'fan-out':>8} {'messages':>10} {'seconds':>9} {'messages/sec':>14}")
+    for fan_out in FAN_OUTS:
+        handled, elapsed = run_cascade(fan_out)
+        print(f"{fan_out:>8} {handled:>10} {elapsed:>9.3f} {handled / elapsed:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
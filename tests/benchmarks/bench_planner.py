@@ -0,0 +1,47 @@
+# What-if runs: Product.allocate over every line against the numpy planner, on a copy of the
+# same product each time. Not collected by pytest, run it with:
+#   python -m tests.benchmarks.bench_planner
+import random
+import time
+from datetime import date, timedelta
+
+from src.allocation.domain.model import Product, Batch, OrderLine
+from src.allocation.domain.planner import plan_allocations
+
+SKU = "HOT-SKU"
+BATCHES = 50
+LINE_COUNTS = [1_000, 10_000, 100_000]
+
+
+def build_product(n_lines: int) -> Product:
+    # about as much stock as the lines ask for, so some of them run out
+    rnd = random.Random(n_lines)
+    product = Product(SKU)
+    for i in range(BATCHES):
+        eta = None if i % 10 == 0 else date.today() + timedelta(days=rnd.randint(1, 365))
+        product.add_stock(Batch(f"batch-{i}", SKU, n_lines * 5 // BATCHES, eta))
+    return product
+
+
+def main():
+    print(f"{'lines':>8} {'allocate() ms':>14} {'planner ms':>11} {'speedup':>8}")
+    for n_lines in LINE_COUNTS:
+        rnd = random.Random(0)
+        lines = [OrderLine(f"order-{i}", SKU, rnd.randint(1, 10)) for i in range(n_lines)]
+
+        product = build_product(n_lines)
+        start = time.perf_counter()
+        planned = plan_allocations(product, lines)
+        planner = time.perf_counter() - start
+
+        product = build_product(n_lines)
+        start = time.perf_counter()
+        allocated = [product.allocate(line) for line in lines]
+        one_by_one = time.perf_counter() - start
+
+        assert planned == allocated
+        print(f"{n_lines:>8} {one_by_one * 1e3:>14.1f} {planner * 1e3:>11.1f} {one_by_one / planner:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Allocations per second through one shared bus, against the number of client threads,
+# and the connections still checked out afterwards (should be 0). Needs the postgres from
+# config (make up), or a database url in BENCH_DB_URI:
+#   python -m tests.benchmarks.bench_sessions
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine
+
+from src.allocation import bootstrap, config
+from src.allocation.adapters import orm
+from src.allocation.domain import commands
+
+THREAD_COUNTS = [1, 2, 4, 8, 16]
+ALLOCATIONS_PER_THREAD = 200
+
+
+def run(bus, n_threads: int) -> float:
+    run_id = uuid.uuid4().hex[:6]
+    for n in range(n_threads):
+        bus.handle(commands.CreateBatch(f"bench-{run_id}-{n}", f"BENCH-{run_id}-{n}", 1_000_000, None))
+
+    def client(n):
+        for i in range(ALLOCATIONS_PER_THREAD):
+            bus.handle(commands.Allocate(f"order-{run_id}-{n}-{i}", f"BENCH-{run_id}-{n}", 1))
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return n_threads * ALLOCATIONS_PER_THREAD / (time.perf_counter() - start)
+
+
+def main():
+    uri = os.environ.get("BENCH_DB_URI", config.get_postgres_uri())
+    if uri.startswith("postgresql"):
+        options = dict(isolation_level="REPEATABLE READ")
+    else:  # sqlite has a single writer: threads queue on its lock instead of scaling
+        options = dict(connect_args={"check_same_thread": False, "timeout": 60})
+    engine = create_engine(uri, pool_size=max(THREAD_COUNTS), **options)
+    orm.metadata.create_all(engine)
+    bus = bootstrap.bootstrap(engine=engine)
+    print(f"{'threads':>8} {'allocations/s':>14} {'checked out after':>18}")
+    for n_threads in THREAD_COUNTS:
+        throughput = run(bus, n_threads)
+        print(f"{n_threads:>8} {throughput:>14.0f} {engine.pool.checkedout():>18}")
+    bus.retries.stop()
+
+
+if __name__ == "__main__":
+    main()
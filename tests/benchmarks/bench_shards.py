@@ -0,0 +1,73 @@
+# Allocations per second over many skus as the number of shard processes grows, with the
+# same client threads sending commands to a ShardedMessageBus.
+# Needs the postgres from config (make up), or a database url in BENCH_DB_URI (sqlite takes
+# a single writer at a time, so it won't scale there):
+#   python -m tests.benchmarks.bench_shards
+import functools
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine
+
+from src.allocation import bootstrap, config
+from src.allocation.adapters import orm
+from src.allocation.domain import commands
+from src.allocation.service_layer.shards import ShardedMessageBus
+
+SHARD_COUNTS = [1, 2, 4, 8]
+CLIENT_THREADS = 32
+SKUS = 64
+ALLOCATIONS_PER_THREAD = 50
+
+
+def build_engine(uri: str):
+    if uri.startswith("postgresql"):
+        options = dict(isolation_level="REPEATABLE READ")
+    else:
+        options = dict(connect_args={"check_same_thread": False, "timeout": 60})
+    return create_engine(uri, **options)
+
+
+def bench_bus(uri: str):
+    # runs inside every shard
+    return bootstrap.bootstrap(engine=build_engine(uri)).handle
+
+
+def run(uri: str, n_shards: int):
+    prefix = uuid.uuid4().hex[:6]
+    skus = [f"SKU-{prefix}-{n}" for n in range(SKUS)]
+    bus = ShardedMessageBus(functools.partial(bench_bus, uri), shards=n_shards, timeout=None)
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 1_000_000, None))
+
+    def client(n):
+        for i in range(ALLOCATIONS_PER_THREAD):
+            sku = skus[(n * ALLOCATIONS_PER_THREAD + i) % SKUS]
+            bus.handle(commands.Allocate(f"order-{prefix}-{n}-{i}", sku, 1))
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(CLIENT_THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    bus.shutdown(wait=True)
+    return CLIENT_THREADS * ALLOCATIONS_PER_THREAD / elapsed
+
+
+def main():
+    uri = os.environ.get("BENCH_DB_URI", config.get_postgres_uri())
+    orm.metadata.create_all(build_engine(uri))
+    print(f"{'shards':>7} {'allocations/s':>14} {'speedup':>8}")
+    baseline = None
+    for n_shards in SHARD_COUNTS:
+        throughput = run(uri, n_shards)
+        baseline = baseline or throughput
+        print(f"{n_shards:>7} {throughput:>14.0f} {throughput / baseline:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ import redis
 import requests
 from requests.exceptions import ConnectionError
 from sqlalchemy.exc import OperationalError
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, event
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from pathlib import Path
 
@@ -13,9 +13,12 @@ from tenacity import retry, stop_after_delay
 
 import src.allocation.config as config
 from src.allocation import bootstrap
+from src.allocation.adapters.cache import LRUCache
 from src.allocation.adapters.notifications import EmailNotifications
 from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.adapters.retry_store import InMemoryRetryStore
 from src.allocation.service_layer import unit_of_work
+from src.allocation.service_layer.retries import RetryScheduler
 
 
 @pytest.fixture
@@ -32,6 +35,19 @@ def session_factory(in_memory_db):
     clear_mappers()
 
 
+@pytest.fixture
+def queries(in_memory_db):
+    # every statement sent to the in memory db while the test runs
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(in_memory_db, "before_cursor_execute", record)
+    yield statements
+    event.remove(in_memory_db, "before_cursor_execute", record)
+
+
 @pytest.fixture
 def session(session_factory):
     return session_factory()
@@ -73,12 +89,18 @@ def postgres_session(postgres_session_factory):
 
 
 @pytest.fixture
-def sqlite_bus(session_without_mapping):
+def views_cache():
+    return LRUCache()
+
+
+@pytest.fixture
+def sqlite_bus(session_without_mapping, views_cache):
     bus = bootstrap.bootstrap(
         start_orm=True,
         uow=unit_of_work.SqlAlchemyUnitOfWork(session_without_mapping),
         notifications=EmailNotifications(),
-        publish=lambda *args: None,
+        cache=views_cache,
+        retries=RetryScheduler(InMemoryRetryStore()),
     )
     yield bus
     clear_mappers()
@@ -25,6 +25,16 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_allocate_bulk(lines):
+    url = config.get_api_url()
+    r = requests.post(
+        f"{url}/allocate/bulk",
+        json={"lines": [{"orderid": orderid, "sku": sku, "qty": qty} for orderid, sku, qty in lines]},
+    )
+    assert r.status_code == 202
+    return r
+
+
 def get_allocation(orderid, sku):
     url = config.get_api_url()
     return requests.get(f"{url}/allocations/{orderid}/{sku}")
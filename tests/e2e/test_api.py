@@ -1,7 +1,7 @@
 import pytest
 
 from tests.random_refs import random_sku, random_batchref, random_orderid
-from api_client import put_to_add_batch, post_to_allocate, get_allocations, get_allocation
+from api_client import put_to_add_batch, post_to_allocate, post_to_allocate_bulk, get_allocations, get_allocation
 
 
 @pytest.mark.usefixtures("postgres_db")
@@ -34,3 +34,20 @@ def test_unhappy_path_returns_400_and_error_message():
     r = get_allocations(orderid)
     assert r.status_code == 404
 
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocation_reports_outcome_per_line():
+    sku, unknown_sku = random_sku(), random_sku("unknown")
+    order1, order2, order3 = random_orderid(1), random_orderid(2), random_orderid(3)
+    batch = random_batchref()
+    put_to_add_batch(batch, sku, 10, None)
+
+    r = post_to_allocate_bulk([(order1, sku, 8), (order2, sku, 8), (order3, unknown_sku, 1)])
+
+    assert [(line["orderid"], line["batchref"], line["status"]) for line in r.json()] == [
+        (order1, batch, "allocated"),
+        (order2, None, "out_of_stock"),
+        (order3, None, "invalid_sku"),
+    ]
+    assert get_allocation(order1, sku).json() == {"sku": sku, "batchref": batch}
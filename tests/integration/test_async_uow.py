@@ -0,0 +1,73 @@
+import asyncio
+import pytest
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from src.allocation import config
+from src.allocation.domain import model
+from src.allocation.service_layer import unit_of_work
+from tests.integration.test_uow import insert_batch, get_allocated_batch_ref
+from tests.random_refs import random_sku, random_batchref, random_orderid
+
+pytest.importorskip("asyncpg")
+
+
+@pytest.fixture
+def async_session_factory(postgres_session_factory):
+    engine = create_async_engine(config.get_async_postgres_uri())
+    yield async_sessionmaker(engine, expire_on_commit=False)
+    asyncio.run(engine.dispose())
+
+
+def test_concurrent_tasks_each_get_their_own_session(postgres_session_factory, async_session_factory):
+    session = postgres_session_factory()
+    skus = [random_sku(str(i)) for i in range(3)]
+    batchrefs = {sku: random_batchref(sku) for sku in skus}
+    for sku in skus:
+        insert_batch(session, batchrefs[sku], sku, 100, None)
+    session.commit()
+
+    uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+    orderids = {sku: random_orderid(sku) for sku in skus}
+
+    async def allocate(sku):
+        async with uow:
+            product = await uow.products.get(sku=sku)
+            await asyncio.sleep(0.01)  # the other tasks open their units of work meanwhile
+            product.allocate(model.OrderLine(orderids[sku], sku, 10))
+            await uow.commit()
+            return uow.session
+
+    async def scenario():
+        return await asyncio.gather(*(allocate(sku) for sku in skus))
+
+    sessions = asyncio.run(scenario())
+
+    assert len({id(s) for s in sessions}) == len(skus)
+    for sku in skus:
+        assert get_allocated_batch_ref(session, orderids[sku], sku) == batchrefs[sku]
+
+
+def test_products_come_with_their_batches_and_allocations(postgres_session_factory, async_session_factory):
+    session = postgres_session_factory()
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+    insert_batch(session, batchref, sku, 100, None)
+    session.commit()
+
+    uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+
+    async def allocate_then_reload():
+        async with uow:
+            product = await uow.products.get(sku=sku)
+            product.allocate(model.OrderLine(orderid, sku, 10))
+            await uow.commit()
+        async with uow:
+            return await uow.products.get_by_batchref(batchref)
+
+    product = asyncio.run(allocate_then_reload())
+
+    # the session is closed, so anything not loaded eagerly would raise here
+    [batch] = product.batches
+    assert batch.reference == batchref
+    assert batch.available_quantity == 90
+    assert model.OrderLine(orderid, sku, 10) in batch._allocations
@@ -0,0 +1,48 @@
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from src.allocation import bootstrap
+from src.allocation.adapters import orm
+from src.allocation.adapters.retry_store import InMemoryRetryStore
+from src.allocation.domain import commands
+from src.allocation.service_layer import unit_of_work
+from src.allocation.service_layer.retries import RetryScheduler
+from src.allocation.views import views
+
+THREADS = 8
+ORDERS_PER_THREAD = 10
+
+
+def test_concurrent_requests_share_a_bus_without_leaking_connections(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/allocation.db", pool_size=THREADS, max_overflow=0,
+                           connect_args={"check_same_thread": False, "timeout": 30})
+    orm.metadata.create_all(engine)
+    bus = bootstrap.bootstrap(start_orm=True, engine=engine, retries=RetryScheduler(InMemoryRetryStore()))
+    try:
+        for n in range(THREADS):
+            bus.handle(commands.CreateBatch(f"batch-{n}", f"SKU-{n}", 100, None))
+        errors = []
+
+        def client(n):
+            try:
+                for i in range(ORDERS_PER_THREAD):
+                    bus.handle(commands.Allocate(f"order-{n}-{i}", f"SKU-{n}", 1))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert engine.pool.checkedout() == 0
+        read_uow = unit_of_work.ReadOnlyUnitOfWork(sessionmaker(bind=engine))
+        for n in range(THREADS):
+            for i in range(ORDERS_PER_THREAD):
+                assert views.allocations(f"order-{n}-{i}", read_uow) == [{"sku": f"SKU-{n}", "batchref": f"batch-{n}"}]
+    finally:
+        clear_mappers()
@@ -0,0 +1,47 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import exc, text
+
+from src.allocation.adapters import database
+from src.allocation.adapters.metrics import metrics
+
+
+def settings(**overrides):
+    return dict(dict(pool_size=1, max_overflow=0, pool_timeout=1, pool_pre_ping=True, pool_recycle=-1,
+                     statement_timeout_ms=0), **overrides)
+
+
+def test_pool_reports_checkout_waits_and_connections_in_use(tmp_path):
+    metrics.reset()
+    engine = database.build_engine(f"sqlite:///{tmp_path}/pool.db", settings(), isolation_level="SERIALIZABLE")
+
+    def hold_connection():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            time.sleep(0.2)
+
+    holder = threading.Thread(target=hold_connection)
+    holder.start()
+    time.sleep(0.05)
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    holder.join()
+
+    summaries = metrics.snapshot()["summaries"]
+    assert summaries["db_pool_checkout_wait_seconds"]["count"] >= 2
+    assert summaries["db_pool_checkout_wait_seconds"]["max"] >= 0.1
+    assert summaries["db_pool_in_use"]["max"] == 1
+
+
+def test_pool_counts_checkout_timeouts(tmp_path):
+    metrics.reset()
+    engine = database.build_engine(f"sqlite:///{tmp_path}/pool.db", settings(pool_timeout=0.05),
+                                   isolation_level="SERIALIZABLE")
+
+    with engine.connect():
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+
+    assert metrics.snapshot()["counters"]["db_pool_checkout_timeouts"] == 1
@@ -0,0 +1,84 @@
+from sqlalchemy import create_engine, inspect, text
+
+from src.allocation import config
+from src.allocation.adapters import migrations
+
+
+def old_schema_engine():
+    engine = create_engine("sqlite:///:memory:")
+    create_old_schema(engine)
+    return engine
+
+
+def create_old_schema(engine):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE products (sku VARCHAR(255) PRIMARY KEY, version_id_col INTEGER NOT NULL)"))
+        conn.execute(text(
+            "CREATE TABLE batches (id INTEGER PRIMARY KEY, reference VARCHAR(255), sku VARCHAR(255),"
+            " _purchased_quantity INTEGER NOT NULL, eta DATE)"
+        ))
+        conn.execute(text("CREATE TABLE order_lines (id INTEGER PRIMARY KEY, sku VARCHAR(255), qty INTEGER, orderid VARCHAR(255))"))
+        conn.execute(text("CREATE TABLE allocations (id INTEGER PRIMARY KEY, orderline_id INTEGER, batch_id INTEGER)"))
+        conn.execute(text("CREATE TABLE allocations_view (orderid VARCHAR(255), sku VARCHAR(255), batchref VARCHAR(255))"))
+        conn.execute(text(
+            "INSERT INTO allocations_view VALUES"
+            " ('o1', 'RED-CHAIR', 'b1'), ('o1', 'RED-CHAIR', 'b2'), ('o1', 'BLUE-LAMP', 'b3')"
+        ))
+
+
+def test_upgrade_adds_the_indexes_and_deduplicates_the_view():
+    engine = old_schema_engine()
+
+    migrations.upgrade(engine)
+    migrations.upgrade(engine)  # nothing left to do the second time
+
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT orderid, sku, batchref FROM allocations_view ORDER BY sku")).all()
+        indexes = {index["name"] for table in ("batches", "order_lines", "allocations", "allocations_view")
+                   for index in inspect(conn).get_indexes(table)}
+        tables = set(inspect(conn).get_table_names())
+    assert rows == [("o1", "BLUE-LAMP", "b3"), ("o1", "RED-CHAIR", "b2")]
+    assert set(migrations.INDEXES) | {migrations.VIEW_KEY} <= indexes
+    assert {"outbox", "event_retries", "dead_letters"} <= tables
+
+
+def test_upgrade_adds_the_retry_lease_column():
+    engine = old_schema_engine()
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE event_retries (id INTEGER PRIMARY KEY, handler VARCHAR(255) NOT NULL,"
+            " event_type VARCHAR(255) NOT NULL, payload TEXT NOT NULL, attempt INTEGER NOT NULL,"
+            " due_at FLOAT NOT NULL, last_error TEXT)"
+        ))
+
+    migrations.upgrade(engine)
+    migrations.upgrade(engine)
+
+    with engine.connect() as conn:
+        columns = {column["name"] for column in inspect(conn).get_columns("event_retries")}
+    assert "claimed_until" in columns
+
+
+def test_upgrade_makes_the_view_key_not_null_on_postgres(postgres_db):
+    # in a schema of its own, the old tables would clash with the ones the other tests use
+    with postgres_db.begin() as conn:
+        conn.execute(text("DROP SCHEMA IF EXISTS old_schema CASCADE"))
+        conn.execute(text("CREATE SCHEMA old_schema"))
+    engine = create_engine(config.get_postgres_uri(), connect_args={"options": "-csearch_path=old_schema"})
+    try:
+        create_old_schema(engine)
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO allocations_view VALUES ('o2', NULL, 'b4'), (NULL, 'RED-CHAIR', 'b5')"))
+
+        migrations.upgrade(engine)
+        migrations.upgrade(engine)
+
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT orderid, sku, batchref FROM allocations_view ORDER BY sku")).all()
+            nullable = {column["name"]: column["nullable"] for column in inspect(conn).get_columns("allocations_view")}
+    finally:
+        engine.dispose()
+        with postgres_db.begin() as conn:
+            conn.execute(text("DROP SCHEMA old_schema CASCADE"))
+    assert rows == [("o1", "BLUE-LAMP", "b3"), ("o1", "RED-CHAIR", "b2")]
+    assert nullable["orderid"] is nullable["sku"] is False
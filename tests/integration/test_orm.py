@@ -67,3 +67,58 @@ def test_product_mapper_updates_products_version(session):
 
     product_row = session.query(model.Product).first()
     assert product_row.version_id_col == 1
+
+
+def test_loaded_product_allocates_to_earliest_batch(session):
+    session.execute(text(
+        "INSERT INTO products (sku, version_id_col) VALUES ('RED-CHAIR', 0)"
+    ))
+    session.execute(text(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta) VALUES "
+        "('later-batch', 'RED-CHAIR', 10, '2011-01-02'),"
+        "('in-stock-batch', 'RED-CHAIR', 10, null),"
+        "('earlier-batch', 'RED-CHAIR', 10, '2011-01-01')"
+    ))
+    product = session.query(model.Product).first()
+
+    assert [b.reference for b in product.batches_by_eta] == ["in-stock-batch", "earlier-batch", "later-batch"]
+    assert product.allocate(model.OrderLine("order1", "RED-CHAIR", 5)) == "in-stock-batch"
+
+
+def test_loaded_batch_recomputes_allocated_quantity(session):
+    batch = model.Batch("batch-001", "RED-CHAIR", 100, eta=None)
+    batch.allocate(model.OrderLine("order1", "RED-CHAIR", 12))
+    batch.allocate(model.OrderLine("order2", "RED-CHAIR", 13))
+    session.add(model.Product("RED-CHAIR", [batch]))
+    session.commit()
+    session.close()
+
+    loaded = session.query(model.Batch).one()
+    assert loaded.allocated_quantity == 25
+    assert loaded.available_quantity == 75
+
+
+def test_rolled_back_allocation_is_not_counted(session):
+    session.add(model.Product("RED-CHAIR", [model.Batch("batch-001", "RED-CHAIR", 100, eta=None)]))
+    session.commit()
+
+    batch = session.query(model.Batch).one()
+    batch.allocate(model.OrderLine("order1", "RED-CHAIR", 12))
+    assert batch.available_quantity == 88
+    session.rollback()
+
+    assert batch.available_quantity == 100
+
+
+def test_loaded_product_knows_its_allocations_per_order(session):
+    batch = model.Batch("batch-001", "RED-CHAIR", 100, eta=None)
+    line = model.OrderLine("order1", "RED-CHAIR", 12)
+    batch.allocate(line)
+    session.add(model.Product("RED-CHAIR", [batch]))
+    session.commit()
+    session.close()
+
+    product = session.query(model.Product).one()
+    assert product.is_allocated_for_order("order1")
+    assert product.allocations_for_order("order1") == {model.OrderLine("order1", "RED-CHAIR", 12): {"batch-001"}}
+    assert product.batches[0].is_allocated_for_order("order1")
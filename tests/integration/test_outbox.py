@@ -0,0 +1,55 @@
+import json
+
+from sqlalchemy import text
+
+from src.allocation.adapters.outbox import OutboxRelay
+from src.allocation.domain import model
+from src.allocation.service_layer import unit_of_work
+
+
+def allocate_with_two_commits(session_factory):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = model.Product("RETRO-CLOCK", batches=[model.Batch("b1", "RETRO-CLOCK", 100, None)])
+        uow.products.add(product)
+        product.allocate(model.OrderLine("o1", "RETRO-CLOCK", 10))
+        uow.commit()
+        product.allocate(model.OrderLine("o2", "RETRO-CLOCK", 5))
+        uow.commit()
+
+
+def test_commit_writes_outbox_rows_once(session_factory):
+    allocate_with_two_commits(session_factory)
+
+    rows = list(session_factory().execute(text("SELECT channel, payload FROM outbox ORDER BY id")))
+    assert [channel for channel, _ in rows] == ["line_allocated", "line_allocated"]
+    assert [json.loads(payload) for _, payload in rows] == [
+        dict(orderid="o1", sku="RETRO-CLOCK", qty=10, batchref="b1"),
+        dict(orderid="o2", sku="RETRO-CLOCK", qty=5, batchref="b1"),
+    ]
+
+
+class FakePublisher:
+    def __init__(self):
+        self.buffer = []
+        self.flushed = []
+
+    def publish(self, channel, message):
+        self.buffer.append((channel, message))
+
+    def flush(self):
+        self.flushed.append(self.buffer)
+        self.buffer = []
+
+
+def test_relay_marks_rows_published_and_does_not_resend_them(session_factory):
+    allocate_with_two_commits(session_factory)
+    publisher = FakePublisher()
+    relay = OutboxRelay(session_factory, publisher, batch_size=1)
+
+    assert relay.relay_once() == 1
+    assert relay.relay_once() == 1
+    assert relay.relay_once() == 0
+
+    assert [[channel for channel, _ in batch] for batch in publisher.flushed] == [["line_allocated"], ["line_allocated"]]
+    [[unpublished]] = session_factory().execute(text("SELECT count(*) FROM outbox WHERE published_at IS NULL"))
+    assert unpublished == 0
@@ -0,0 +1,104 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from src.allocation.adapters import repository
+from src.allocation.adapters.metrics import metrics
+from src.allocation.domain import model
+from src.allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def cached_uow(in_memory_db, session_factory):
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        sessionmaker(bind=in_memory_db, expire_on_commit=False), product_cache=repository.ProductCache(maxsize=2)
+    )
+
+
+def allocate(uow, sku, orderid, qty=1):
+    with uow:
+        product = uow.products.get(sku=sku)
+        batchref = product.allocate(model.OrderLine(orderid, sku, qty))
+        uow.commit()
+    list(uow.collect_new_events())
+    return batchref
+
+
+def add_product(uow, sku, qty=100):
+    with uow:
+        uow.products.add(model.Product(sku, batches=[model.Batch(f"{sku}-batch", sku, qty, None)]))
+        uow.commit()
+    list(uow.collect_new_events())
+
+
+def test_committed_product_is_reused_after_checking_its_version(cached_uow, queries):
+    add_product(cached_uow, "LAMP")
+    allocate(cached_uow, "LAMP", "order1")
+    metrics.reset()
+
+    queries.clear()
+    with cached_uow:
+        product = cached_uow.products.get(sku="LAMP")
+        selects = [q for q in queries if q.lstrip().upper().startswith("SELECT")]
+        assert product.available_quantity == 99
+    assert len(selects) == 1
+    assert metrics.snapshot()["counters"] == {"product_cache_hits": 1}
+
+
+def test_product_changed_elsewhere_is_reloaded(cached_uow, session_factory):
+    add_product(cached_uow, "LAMP")
+    allocate(cached_uow, "LAMP", "order1")
+    # another process changes it behind the cache
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        uow.products.get(sku="LAMP").change_batch_quantity("LAMP-batch", 50)
+        uow.commit()
+    metrics.reset()
+
+    with cached_uow:
+        product = cached_uow.products.get(sku="LAMP")
+        assert product.available_quantity == 49
+    assert metrics.snapshot()["counters"] == {"product_cache_stale": 1}
+
+
+def test_rolled_back_product_is_not_cached(cached_uow):
+    add_product(cached_uow, "LAMP")
+    cache = cached_uow.product_cache
+    cache.take("LAMP")
+
+    with cached_uow:
+        cached_uow.products.get(sku="LAMP").allocate(model.OrderLine("order1", "LAMP", 1))
+    list(cached_uow.collect_new_events())
+
+    assert len(cache) == 0
+    with cached_uow:
+        assert cached_uow.products.get(sku="LAMP").available_quantity == 100
+
+
+def test_products_are_checked_out_one_owner_at_a_time(cached_uow):
+    add_product(cached_uow, "LAMP")
+    cache = cached_uow.product_cache
+
+    product = cache.take("LAMP")
+    assert product is not None
+    assert cache.take("LAMP") is None
+
+    cache.give_back(product)
+    assert cache.take("LAMP") is product
+
+
+def test_least_recently_used_products_are_evicted(cached_uow):
+    for sku in ("LAMP", "CHAIR", "TABLE"):
+        add_product(cached_uow, sku)
+
+    assert len(cached_uow.product_cache) == 2
+    assert cached_uow.product_cache.take("LAMP") is None
+
+
+def test_the_newest_version_is_kept(cached_uow):
+    add_product(cached_uow, "LAMP")
+    cache = cached_uow.product_cache
+    old = cache.take("LAMP")
+    allocate(cached_uow, "LAMP", "order1")
+
+    cache.give_back(old)
+
+    assert cache.take("LAMP").version_id_col == 1
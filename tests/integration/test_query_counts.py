@@ -0,0 +1,106 @@
+import pytest
+
+from src.allocation.adapters import repository
+from src.allocation.domain import model
+from src.allocation.service_layer import unit_of_work
+
+
+def add_product(session_factory, sku, n_batches):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = model.Product(sku, batches=[model.Batch(f"{sku}-{i}", sku, 10, None) for i in range(n_batches)])
+        # some allocations in every batch, so there is something to load
+        for i in range(n_batches):
+            product.allocate(model.OrderLine(f"order-{i}", sku, 5))
+        uow.products.add(product)
+        uow.commit()
+
+
+def queries_to_allocate(session_factory, queries, sku):
+    queries.clear()
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get(sku=sku)
+        product.allocate(model.OrderLine("new-order", sku, 1))
+        uow.commit()
+    return len(queries)
+
+
+def test_allocate_runs_the_same_queries_whatever_the_number_of_batches(session_factory, queries):
+    counts = []
+    for n_batches in (1, 10, 50):
+        add_product(session_factory, f"SKU-{n_batches}", n_batches)
+        counts.append(queries_to_allocate(session_factory, queries, f"SKU-{n_batches}"))
+
+    assert counts[0] == counts[1] == counts[2]
+
+
+@pytest.mark.parametrize("strategy", ["selectin", "joined"])
+def test_eager_strategies_load_the_product_in_constant_queries(session_factory, queries, strategy):
+    add_product(session_factory, "BIG-SKU", 20)
+    session = session_factory()
+    repo = repository.SqlAlchemyProductRepository(session, loading={"get": strategy})
+
+    queries.clear()
+    product = repo.get("BIG-SKU")
+    assert product.available_quantity == 20 * 5
+    eager = len(queries)
+
+    session.close()
+    session = session_factory()
+    repo = repository.SqlAlchemyProductRepository(session, loading={"get": "lazy"})
+    queries.clear()
+    product = repo.get("BIG-SKU")
+    assert product.available_quantity == 20 * 5
+    lazy = len(queries)
+
+    assert eager <= 3
+    assert lazy > 20
+
+
+def test_get_many_loads_every_product_in_constant_queries(session_factory, queries):
+    for n in range(30):
+        add_product(session_factory, f"SKU-{n}", 2)
+    session = session_factory()
+    repo = repository.SqlAlchemyProductRepository(session)
+
+    queries.clear()
+    products = repo.get_many([f"SKU-{n}" for n in range(30)] + ["SKU-0", "NO-SUCH-SKU"])
+    assert sum(p.available_quantity for p in products) == 30 * 2 * 5
+
+    assert len(queries) <= 3
+    assert sorted(p.sku for p in products) == sorted(f"SKU-{n}" for n in range(30))
+    assert repo.tracked == set(products)
+
+
+def test_get_many_by_batchrefs_maps_each_ref_to_its_product(session_factory):
+    add_product(session_factory, "RED-CHAIR", 2)
+    add_product(session_factory, "BLUE-LAMP", 1)
+    repo = repository.SqlAlchemyProductRepository(session_factory())
+
+    products = repo.get_many_by_batchrefs(["RED-CHAIR-0", "RED-CHAIR-1", "BLUE-LAMP-0", "NO-SUCH-REF"])
+
+    assert {ref: p.sku for ref, p in products.items()} == {
+        "RED-CHAIR-0": "RED-CHAIR", "RED-CHAIR-1": "RED-CHAIR", "BLUE-LAMP-0": "BLUE-LAMP",
+    }
+    assert {p.sku for p in repo.tracked} == {"RED-CHAIR", "BLUE-LAMP"}
+
+
+def test_iter_products_streams_in_chunks_and_releases_them(session_factory, queries):
+    for n in range(25):
+        add_product(session_factory, f"SKU-{n:02}", 1)
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        seen, largest_identity_map = [], 0
+        queries.clear()
+        for product in uow.products.iter_products(chunk_size=10):
+            seen.append(product.sku)
+            largest_identity_map = max(largest_identity_map, len(uow.session.identity_map))
+            if product.sku == "SKU-03":
+                product.allocate(model.OrderLine("late-order", product.sku, 5))
+        assert len(uow.products.tracked) == 1
+        uow.commit()
+
+    assert seen == [f"SKU-{n:02}" for n in range(25)]
+    # a chunk of products, batches and lines: 10 + 10 + 10
+    assert largest_identity_map <= 30
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        assert uow.products.get("SKU-03").available_quantity == 0
@@ -0,0 +1,51 @@
+import time
+
+from sqlalchemy import text
+
+from src.allocation.adapters.retry_store import SqlAlchemyRetryStore, FailedEvent
+from src.allocation.domain import events
+
+
+def test_retry_store_returns_only_due_events(session_factory):
+    store = SqlAlchemyRetryStore(session_factory)
+    now = time.time()
+    due = FailedEvent(events.Allocated("o1", "RED-CHAIR", 10, "b1"), "publish_allocated_event", 1, now - 1, "boom")
+    later = FailedEvent(events.OutOfStock("RED-CHAIR"), "send_out_of_stock_notification", 2, now + 60)
+    store.add(later)
+    store.add(due)
+
+    [claimed] = store.claim_due(now)
+    assert (claimed.event, claimed.attempt) == (due.event, 1)
+    store.done(claimed)
+    assert store.claim_due(now) == []
+    assert [f.event for f in store.claim_due(now + 120)] == [later.event]
+
+
+def test_claimed_retries_are_kept_until_done(session_factory):
+    store = SqlAlchemyRetryStore(session_factory)
+    now = time.time()
+    store.add(FailedEvent(events.OutOfStock("RED-CHAIR"), "send_out_of_stock_notification", 1, now - 1))
+
+    [claimed] = store.claim_due(now, lease=30)
+    assert store.claim_due(now + 10) == []  # another scheduler leaves it alone while it's held
+    # the first scheduler died without finishing it
+    [again] = store.claim_due(now + 31)
+    assert again.id == claimed.id
+
+    again.attempt, again.due_at, again.error = 2, now + 60, "smtp down"
+    store.add(again)
+    assert store.claim_due(now + 31) == []
+    [rescheduled] = store.claim_due(now + 61)
+    assert (rescheduled.id, rescheduled.attempt, rescheduled.error) == (claimed.id, 2, "smtp down")
+
+    store.dead_letter(rescheduled)
+    assert store.claim_due(now + 10_000) == []
+
+
+def test_retry_store_keeps_dead_letters(session_factory):
+    store = SqlAlchemyRetryStore(session_factory)
+
+    store.dead_letter(FailedEvent(events.OutOfStock("RED-CHAIR"), "send_out_of_stock_notification", 5, 0, "smtp down"))
+
+    rows = list(session_factory().execute(text("SELECT handler, event_type, payload, attempts, last_error FROM dead_letters")))
+    assert rows == [("send_out_of_stock_notification", "OutOfStock", '{"sku": "RED-CHAIR"}', 5, "smtp down")]
@@ -169,3 +169,30 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
         dict(sku=sku),
     )
     assert orders.rowcount == 1
+
+
+def test_commit_turns_a_stale_version_into_a_concurrency_conflict(session_factory):
+    uow_add_batch("HOT-SKU", "batch1", session_factory)
+    first = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    second = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    with first:
+        product = first.products.get(sku="HOT-SKU")
+        product.allocate(model.OrderLine("order1", "HOT-SKU", 10))
+        # someone else allocates in the meantime (and bumps the version)
+        uow_allocate("HOT-SKU", model.OrderLine("order2", "HOT-SKU", 10), session_factory)
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            first.commit()
+
+
+def test_a_batch_quantity_change_conflicts_with_a_concurrent_allocation(session_factory):
+    uow_add_batch("HOT-SKU", "batch1", session_factory)
+    first = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    with first:
+        product = first.products.get(sku="HOT-SKU")
+        product.change_batch_quantity("batch1", 5)
+        # the allocation it would have to deallocate is committed in the meantime
+        uow_allocate("HOT-SKU", model.OrderLine("order2", "HOT-SKU", 10), session_factory)
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            first.commit()
@@ -1,6 +1,9 @@
 from datetime import date
 
-from src.allocation.domain import commands
+from sqlalchemy import text
+
+from src.allocation.domain import commands, events
+from src.allocation.service_layer import unit_of_work
 from src.allocation.views import views
 
 today = date.today()
@@ -31,3 +34,65 @@ def test_allocation_view(sqlite_bus):
 
     assert views.allocation("order1", "sku1", sqlite_bus.uow) == {"sku": "sku1", "batchref": "sku1batch"}
     assert views.allocation("otherorder", "sku1", sqlite_bus.uow) == {"sku": "sku1", "batchref": "sku1batch"}
+
+
+def test_bulk_allocation_view(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, today))
+
+    [outcomes] = sqlite_bus.handle(commands.AllocateMany((
+        commands.Allocate("order1", "sku1", 20),
+        commands.Allocate("order1", "sku2", 20),
+        commands.Allocate("otherorder", "sku1", 40),
+    )))
+
+    assert [o["status"] for o in outcomes] == ["allocated", "allocated", "out_of_stock"]
+    assert sorted(views.allocations("order1", sqlite_bus.uow), key=lambda row: row["sku"]) == [
+        {"sku": "sku1", "batchref": "sku1batch"},
+        {"sku": "sku2", "batchref": "sku2batch"},
+    ]
+
+
+def test_cached_view_follows_reallocation(sqlite_bus, views_cache):
+    sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("sku1batch-later", "sku1", 50, today))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
+    assert views.allocations("order1", sqlite_bus.uow, views_cache) == [{"sku": "sku1", "batchref": "sku1batch"}]
+    assert views.allocation("order1", "sku2", sqlite_bus.uow, views_cache) is None
+
+    sqlite_bus.handle(commands.ChangeBatchQuantity("sku1batch", 10))
+
+    assert views.allocations("order1", sqlite_bus.uow, views_cache) == [
+        {"sku": "sku1", "batchref": "sku1batch-later"}
+    ]
+
+
+def test_allocated_event_handled_twice_keeps_one_row(sqlite_bus):
+    sqlite_bus.handle(events.Allocated("order1", "sku1", 10, "sku1batch"))
+    sqlite_bus.handle(events.Allocated("order1", "sku1", 10, "sku1batch-later"))
+
+    assert views.allocations("order1", sqlite_bus.uow) == [{"sku": "sku1", "batchref": "sku1batch-later"}]
+
+
+def test_views_read_through_a_read_only_unit_of_work(sqlite_bus, session_without_mapping):
+    sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
+
+    uow = unit_of_work.ReadOnlyUnitOfWork(session_without_mapping)
+
+    assert views.allocations("order1", uow) == [{"sku": "sku1", "batchref": "sku1batch"}]
+    assert views.allocation("order1", "sku1", uow) == {"sku": "sku1", "batchref": "sku1batch"}
+    assert not hasattr(uow, "products")
+
+
+def test_an_order_not_found_yet_is_not_cached(sqlite_bus, views_cache, session_without_mapping):
+    assert views.allocations("order1", sqlite_bus.uow, views_cache) == []
+
+    # written by another process, which can't invalidate this one's cache
+    with session_without_mapping() as session:
+        session.execute(text(
+            "INSERT INTO allocations_view (orderid, sku, batchref) VALUES ('order1', 'sku1', 'sku1batch')"
+        ))
+        session.commit()
+
+    assert views.allocations("order1", sqlite_bus.uow, views_cache) == [{"sku": "sku1", "batchref": "sku1batch"}]
@@ -0,0 +1,217 @@
+import asyncio
+from collections import defaultdict
+from typing import Dict, List
+
+from src.allocation import bootstrap
+from src.allocation.adapters.retry_store import InMemoryRetryStore
+from src.allocation.adapters.repository import track_entity, track_entities
+from src.allocation.domain import events, commands
+from src.allocation.domain.model import Product
+from src.allocation.service_layer import unit_of_work
+from src.allocation.service_layer.messagebus import AsyncMessageBus
+from src.allocation.service_layer.retries import RetryScheduler
+from tests.unit.test_retries import FAR_FUTURE
+
+
+class FakeAsyncProductRepository:
+
+    def __init__(self, products):
+        self._products = set(products)
+        self.tracked = set()
+
+    @track_entity
+    async def add(self, product):
+        self._products.add(product)
+
+    @track_entity
+    async def get(self, sku: str):
+        return next((p for p in self._products if p.sku == sku), None)
+
+    @track_entity
+    async def get_by_batchref(self, batchref: str):
+        return next(
+            (p for p in self._products for b in p.batches if b.reference == batchref),
+            None
+        )
+
+    @track_entities
+    async def get_many(self, skus):
+        skus = set(skus)
+        return [p for p in self._products if p.sku in skus]
+
+    @track_entities
+    async def get_many_by_batchrefs(self, batchrefs):
+        batchrefs = set(batchrefs)
+        return {b.reference: p for p in self._products for b in p.batches if b.reference in batchrefs}
+
+
+class FakeAsyncUnitOfWork(unit_of_work.AbstractAsyncUnitOfWork):
+    def __init__(self):
+        self.products = FakeAsyncProductRepository([])
+        self.committed = False
+
+    async def commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+
+class FakeAsyncNotifications:
+    def __init__(self):
+        self.sent = defaultdict(list)  # type: Dict[str, List[str]]
+
+    async def send(self, destination, message):
+        self.sent[destination].append(message)
+
+
+def bootstrap_test_bus(uow, notifications=None):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=notifications or FakeAsyncNotifications(),
+        messagebus_init=AsyncMessageBus,
+        retries=RetryScheduler(InMemoryRetryStore()),
+    )
+
+
+def test_allocates_through_the_async_handlers():
+    uow = FakeAsyncUnitOfWork()
+    bus = bootstrap_test_bus(uow)
+
+    async def scenario():
+        await bus.handle(commands.CreateBatch("b1", "COMPLICATED-LAMP", 100, None))
+        await bus.handle(commands.Allocate("o1", "COMPLICATED-LAMP", 10))
+
+    asyncio.run(scenario())
+
+    assert uow.committed
+    [product] = uow.products._products
+    [batch] = product.batches
+    assert batch.available_quantity == 90
+
+
+def test_sends_email_on_out_of_stock_error():
+    notifications = FakeAsyncNotifications()
+    bus = bootstrap_test_bus(FakeAsyncUnitOfWork(), notifications=notifications)
+
+    async def scenario():
+        await bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        await bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+
+    asyncio.run(scenario())
+
+    assert notifications.sent["stock@made.com"] == ["Out of stock for POPULAR-CURTAINS"]
+
+
+def test_handlers_of_the_same_event_run_concurrently():
+    # each handler waits for the other one to start: run one after the other they'd time out
+    started = {"first": asyncio.Event(), "second": asyncio.Event()}
+
+    def waits_for(me, other):
+        async def handler(event):
+            started[me].set()
+            await asyncio.wait_for(started[other].wait(), timeout=1)
+        return handler
+
+    finished = []
+    bus = AsyncMessageBus(
+        uow=FakeAsyncUnitOfWork(),
+        event_handlers={events.OutOfStock: [
+            waits_for("first", "second"),
+            waits_for("second", "first"),
+            finished.append,
+        ]},
+        command_handlers={},
+    )
+
+    asyncio.run(bus.handle(events.OutOfStock("SMALL-FORK")))
+
+    assert finished == [events.OutOfStock("SMALL-FORK")]
+    assert all(event.is_set() for event in started.values())
+
+
+def test_commands_are_handled_one_after_another():
+    running, overlaps = [], []
+
+    async def slow_command_handler(command):
+        if running:
+            overlaps.append(command)
+        running.append(command)
+        await asyncio.sleep(0.01)
+        running.remove(command)
+
+    async def raise_commands(event):
+        uow.products.tracked.add(product_with_messages)
+
+    product_with_messages = Product("SMALL-FORK")
+    product_with_messages.messages.extend(
+        commands.Allocate(f"o{i}", "SMALL-FORK", 1) for i in range(3)
+    )
+    uow = FakeAsyncUnitOfWork()
+    bus = AsyncMessageBus(
+        uow=uow,
+        event_handlers={events.OutOfStock: [raise_commands]},
+        command_handlers={commands.Allocate: slow_command_handler},
+    )
+
+    results = asyncio.run(bus.handle(events.OutOfStock("SMALL-FORK")))
+
+    assert results == [None, None, None]
+    assert overlaps == []
+
+
+def test_concurrent_callers_only_handle_their_own_messages():
+    uow = FakeAsyncUnitOfWork()
+
+    async def allocate(command):
+        if command.orderid == "B":
+            # raises its follow-ups right away, A is still in its own handler
+            product = Product("SMALL-FORK")
+            product.messages.extend(commands.Allocate(f"B-follow{i}", "SMALL-FORK", 1) for i in range(3))
+            uow.products.tracked.add(product)
+        else:
+            await asyncio.sleep(0.01)
+        return command.orderid
+
+    bus = AsyncMessageBus(uow=uow, event_handlers={}, command_handlers={commands.Allocate: allocate})
+
+    async def scenario():
+        return await asyncio.gather(
+            bus.handle(commands.Allocate("A", "SMALL-FORK", 1)),
+            bus.handle(commands.Allocate("B", "SMALL-FORK", 1)),
+        )
+
+    a, b = asyncio.run(scenario())
+
+    assert a == ["A"]
+    assert b == ["B", "B-follow0", "B-follow1", "B-follow2"]
+
+
+def test_failed_event_handler_is_retried_later_on_the_bus_loop():
+    failures, handled = [ConnectionError("redis is down")], []
+
+    async def flaky_publish(event):
+        if failures:
+            raise failures.pop()
+        handled.append((event, asyncio.get_running_loop()))
+
+    scheduler = RetryScheduler(InMemoryRetryStore())
+    bus = AsyncMessageBus(
+        uow=FakeAsyncUnitOfWork(),
+        event_handlers={events.OutOfStock: [flaky_publish]},
+        command_handlers={},
+        retries=scheduler,
+    )
+
+    async def scenario():
+        await bus.handle(events.OutOfStock("SMALL-FORK"))
+        assert handled == [] and len(scheduler.store) == 1
+        # the scheduler's thread hands the retry back to this loop
+        assert await asyncio.to_thread(scheduler.run_pending, FAR_FUTURE) == 1
+        return asyncio.get_running_loop()
+
+    loop = asyncio.run(scenario())
+
+    assert handled == [(events.OutOfStock("SMALL-FORK"), loop)]
+    assert len(scheduler.store) == 0
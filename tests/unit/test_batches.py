@@ -1,6 +1,9 @@
+import random
 from datetime import date
 
-from src.allocation.domain.model import Batch, OrderLine
+import pytest
+
+from src.allocation.domain.model import Batch, OrderLine, Product
 
 
 def create_sample_batch_and_line(sku, batch_qty, line_qty):
@@ -58,3 +61,56 @@ def test_can_only_deallocate_allocated_lines():
     batch, unallocated_line = create_sample_batch_and_line("DECORATIVE-TRINKET", 20, 2)
     batch.deallocate(unallocated_line)
     assert batch.available_quantity == 20
+
+
+def naive_allocated_quantity(batch):
+    return sum(line.qty for line in batch._allocations)
+
+
+@pytest.mark.parametrize("seed", range(25))
+def test_allocated_quantity_matches_naive_sum_after_random_operations(seed):
+    rnd = random.Random(seed)
+    batch = Batch("batch-001", "RANDOM-LAMP", qty=rnd.randint(0, 100), eta=None)
+    lines = [OrderLine(f"order-{i}", "RANDOM-LAMP", rnd.randint(1, 20)) for i in range(15)]
+
+    for _ in range(200):
+        operation = rnd.choice(["allocate", "deallocate", "deallocate_one"])
+        if operation == "deallocate_one":
+            if batch._allocations:
+                batch.deallocate_one()
+        else:
+            getattr(batch, operation)(rnd.choice(lines))
+
+        assert batch.allocated_quantity == naive_allocated_quantity(batch)
+        assert batch.available_quantity == batch._purchased_quantity - naive_allocated_quantity(batch)
+
+
+@pytest.mark.parametrize("seed", range(25))
+def test_change_batch_quantity_keeps_counters_consistent(seed):
+    rnd = random.Random(seed)
+    batches = [Batch(f"batch-{i}", "RANDOM-LAMP", rnd.randint(10, 100), eta=None) for i in range(3)]
+    product = Product("RANDOM-LAMP", batches)
+    for i in range(40):
+        product.allocate(OrderLine(f"order-{i}", "RANDOM-LAMP", rnd.randint(1, 10)))
+
+    for batch in batches:
+        product.change_batch_quantity(batch.reference, rnd.randint(0, 50))
+
+        assert batch.allocated_quantity == naive_allocated_quantity(batch)
+        assert batch.available_quantity >= 0
+    assert product.available_quantity == sum(
+        b._purchased_quantity - naive_allocated_quantity(b) for b in batches
+    )
+
+
+def test_is_allocated_for_order_follows_deallocation():
+    batch, line = create_sample_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+    other_line = OrderLine(line.orderid, "DECORATIVE-TRINKET", 3)
+    batch.allocate(line)
+    batch.allocate(other_line)
+
+    batch.deallocate(line)
+    assert batch.is_allocated_for_order(line.orderid)
+
+    batch.deallocate_one()
+    assert batch.is_allocated_for_order(line.orderid) is False
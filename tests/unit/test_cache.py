@@ -0,0 +1,39 @@
+import time
+
+from src.allocation.adapters.cache import LRUCache
+from src.allocation.adapters.metrics import metrics
+
+
+def test_lru_cache_evicts_the_least_recently_used_entry():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_entries_expire():
+    cache = LRUCache(ttl=0.01)
+    cache.set("a", [])
+    assert cache.get("a") == []
+
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_counts_hits_and_misses():
+    metrics.reset()
+    cache = LRUCache()
+    cache.get("a")
+    cache.set("a", 1)
+    cache.get("a")
+    cache.invalidate("a")
+    cache.get("a")
+
+    assert metrics.snapshot()["counters"] == {"views_cache_hits": 1, "views_cache_misses": 2}
@@ -0,0 +1,135 @@
+import json
+from dataclasses import asdict, dataclass
+from datetime import date
+
+import pytest
+
+from src.allocation.adapters import codecs
+from src.allocation.domain import commands, events
+
+MESSAGES = [
+    events.Allocated("o1", "RED-CHAIR", 3, "b1"),
+    events.Deallocated("o1", "RED-CHAIR", 3),
+    events.OutOfStock("SOFÁ-VERDE"),
+    commands.Allocate("o1", "RED-CHAIR", 3),
+    commands.CreateBatch("b1", "RED-CHAIR", 100, date(2026, 5, 17)),
+    commands.CreateBatch("b1", "RED-CHAIR", 100),
+    commands.ChangeBatchQuantity("b1", 50),
+    commands.AllocateMany((commands.Allocate("o1", "RED-CHAIR", 3), commands.Allocate("o2", "BLUE-LAMP", 1))),
+]
+
+
+@pytest.mark.parametrize("message", MESSAGES, ids=lambda m: type(m).__name__)
+def test_binary_round_trip(message):
+    payload = codecs.encode(message, binary=True)
+
+    assert payload[:1] == bytes([codecs.FORMAT_VERSION])
+    assert codecs.decode("whatever", payload) == message
+
+
+def test_allocate_many_decodes_to_a_hashable_command():
+    registry = codecs.CodecRegistry()
+    registry.register(commands.Allocate, tag=1)
+    registry.register(commands.AllocateMany, tag=2, channel="allocate_many")
+    message = commands.AllocateMany((commands.Allocate("o1", "RED-CHAIR", 3),))
+
+    from_json = registry.decode("allocate_many", registry.encode(message))
+    from_binary = registry.decode("whatever", registry.encode(message, binary=True))
+
+    assert hash(from_json) == hash(from_binary) == hash(message)
+
+
+def test_json_is_what_asdict_gave_with_dates_as_iso_strings():
+    allocated = events.Allocated("o1", "RED-CHAIR", 3, "b1")
+    batch = commands.CreateBatch("b1", "RED-CHAIR", 100, date(2026, 5, 17))
+
+    assert json.loads(codecs.encode(allocated)) == asdict(allocated)
+    assert json.loads(codecs.encode(batch)) == dict(ref="b1", sku="RED-CHAIR", qty=100, eta="2026-05-17")
+    assert codecs.decode("line_allocated", codecs.encode(allocated)) == allocated
+
+
+def test_channels_decode_json_with_their_own_field_names():
+    assert codecs.decode("change_batch_quantity", b'{"batchref": "b1", "qty": 50}') == \
+        commands.ChangeBatchQuantity("b1", 50)
+    assert json.loads(codecs.encode(commands.ChangeBatchQuantity("b1", 50))) == dict(batchref="b1", qty=50)
+    assert codecs.decode("allocate_line", '{"orderid": "o1", "sku": "RED-CHAIR", "qty": 3}') == \
+        commands.Allocate("o1", "RED-CHAIR", 3)
+
+
+@pytest.mark.parametrize("channel, payload", [
+    ("no_such_channel", b'{"sku": "RED-CHAIR"}'),
+    ("allocate_line", b"\x01\xff"),
+    ("allocate_line", b"\x09\x10"),
+])
+def test_unknown_messages_are_rejected(channel, payload):
+    with pytest.raises(codecs.UnknownMessage):
+        codecs.decode(channel, payload)
+
+
+@pytest.mark.parametrize("channel, payload", [
+    ("allocate_line", b"\x01"),
+    ("allocate_line", b"\x01\x10abc"),
+    ("allocate_line", codecs.encode(commands.Allocate("o1", "RED-CHAIR", 3), binary=True)[:-2]),
+    ("allocate_line", codecs.encode(commands.Allocate("o1", "RED-CHAIR", 3), binary=True) + b"x"),
+    ("allocate_line", b'{"orderid": "o1", "sku": "RED-CHAIR"}'),
+    ("allocate_line", b"not json"),
+    ("allocate_line", b"[1, 2]"),
+    ("allocate_line", b"\xff\xfe"),
+])
+def test_malformed_messages_are_rejected(channel, payload):
+    with pytest.raises(codecs.MalformedMessage):
+        codecs.decode(channel, payload)
+
+
+def test_json_may_start_with_whitespace():
+    assert codecs.decode("allocate_line", b'\n {"orderid": "o1", "sku": "RED-CHAIR", "qty": 3}') == \
+        commands.Allocate("o1", "RED-CHAIR", 3)
+
+
+def test_types_it_cant_encode_are_rejected_at_registration():
+    @dataclass
+    class Odd:
+        weights: dict
+
+    with pytest.raises(TypeError):
+        codecs.CodecRegistry().register(Odd, tag=1)
+    with pytest.raises(codecs.UnknownMessage):
+        codecs.encode(Odd({}))
+
+
+def test_the_consumer_ignores_what_isnt_one_of_its_commands(monkeypatch):
+    from src.allocation.entrypoints import redis_eventconsumer
+    from src.allocation.entrypoints.redis_eventconsumer import to_command
+    monkeypatch.setattr(redis_eventconsumer, "sku_for_batchref", lambda ref: None)
+
+    allocated = codecs.encode(events.Allocated("o1", "RED-CHAIR", 3, "b1"), binary=True)
+    change = codecs.encode(commands.ChangeBatchQuantity("b1", 50), binary=True)
+
+    assert to_command(dict(channel=b"allocate_line", data=allocated)) == (None, None)
+    assert to_command(dict(channel=b"no_such_channel", data=b"{}")) == (None, None)
+    assert to_command(dict(channel=b"change_batch_quantity", data=change[:-1])) == (None, None)
+    assert to_command(dict(channel=b"change_batch_quantity", data=change)) == \
+        ("b1", commands.ChangeBatchQuantity("b1", 50))
+
+
+def test_the_consumer_partitions_batch_changes_by_their_sku(monkeypatch):
+    from src.allocation.entrypoints import redis_eventconsumer
+    from src.allocation.entrypoints.redis_eventconsumer import to_command
+    lookups = []
+
+    def sku_for_batch(ref, uow):
+        lookups.append(ref)
+        if ref == "gone":
+            raise ConnectionError("no database")
+        return "RED-CHAIR"
+
+    monkeypatch.setattr(redis_eventconsumer.views, "sku_for_batch", sku_for_batch)
+    monkeypatch.setattr(redis_eventconsumer, "_skus_by_batchref", {})
+    change = dict(channel=b"change_batch_quantity", data=codecs.encode(commands.ChangeBatchQuantity("b1", 50)))
+    allocate = dict(channel=b"allocate_line", data=codecs.encode(commands.Allocate("o1", "RED-CHAIR", 3)))
+    gone = dict(channel=b"change_batch_quantity", data=codecs.encode(commands.ChangeBatchQuantity("gone", 5)))
+
+    assert to_command(change)[0] == to_command(allocate)[0] == "RED-CHAIR"
+    assert to_command(change)[0] == "RED-CHAIR"
+    assert to_command(gone)[0] == "gone"
+    assert lookups == ["b1", "gone"]
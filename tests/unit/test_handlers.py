@@ -4,10 +4,11 @@ import pytest
 from datetime import date
 from typing import Dict, List
 
-from src.allocation.adapters.repository import track_entity
+from src.allocation.adapters.repository import track_entity, track_entities
 from src.allocation.domain import events, commands
 from src.allocation.service_layer import unit_of_work, messagebus
 from src.allocation.service_layer import handlers
+from src.allocation.service_layer.retries import RetryPolicy
 
 
 class FakeProductRepository:
@@ -35,6 +36,21 @@ class FakeProductRepository:
             None
         )
 
+    @track_entities
+    def get_many(self, skus):
+        skus = set(skus)
+        return [p for p in self._products if p.sku in skus]
+
+    @track_entities
+    def get_many_by_batchrefs(self, batchrefs):
+        batchrefs = set(batchrefs)
+        return {b.reference: p for p in self._products for b in p.batches if b.reference in batchrefs}
+
+    def iter_products(self, chunk_size=500):
+        for product in sorted(self._products, key=lambda p: p.sku):
+            self.tracked.add(product)
+            yield product
+
 
 # spy?
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
@@ -70,6 +86,7 @@ class FakeMessageBus:
         }
         self.COMMAND_HANDLERS = {
             commands.Allocate: lambda message: handlers.allocate(message, self.uow),
+            commands.AllocateMany: lambda message: handlers.allocate_many(message, self.uow),
             commands.CreateBatch: lambda message: handlers.add_batch(message, self.uow),
             commands.ChangeBatchQuantity: lambda message: handlers.change_batch_quantity(message, self.uow)
         }
@@ -79,14 +96,16 @@ class FakeMessageBus:
             handler(event)
 
     def handle(self, message: messagebus.Message):
+        result = None
         if isinstance(message, events.Event):
             self._handle_event(message)
         if isinstance(message, commands.Command):
-            self.COMMAND_HANDLERS[type(message)](message)
+            result = self.COMMAND_HANDLERS[type(message)](message)
 
         for product in self.uow.products.tracked:
             while product.messages:
-                self._handle_event(product.messages.pop(0))
+                self._handle_event(product.messages.popleft())
+        return result
 
 
 class TestAddBatch:
@@ -151,6 +170,65 @@ class TestAllocate:
         ]
 
 
+class TestAllocateMany:
+    def test_reports_outcome_for_each_line(self):
+        msbus = FakeMessageBus(FakeUnitOfWork())
+        msbus.handle(commands.CreateBatch("b1", "COMPLICATED-LAMP", 10, None))
+        msbus.handle(commands.CreateBatch("b2", "GARISH-RUG", 10, None))
+
+        outcomes = msbus.handle(commands.AllocateMany((
+            commands.Allocate("o1", "COMPLICATED-LAMP", 8),
+            commands.Allocate("o2", "GARISH-RUG", 5),
+            commands.Allocate("o3", "COMPLICATED-LAMP", 8),
+            commands.Allocate("o4", "NONEXISTENTSKU", 1),
+        )))
+
+        assert [(o["orderid"], o["batchref"], o["status"]) for o in outcomes] == [
+            ("o1", "b1", "allocated"),
+            ("o2", "b2", "allocated"),
+            ("o3", None, "out_of_stock"),
+            ("o4", None, "invalid_sku"),
+        ]
+
+    def test_loads_and_commits_all_products_at_once(self):
+        uow = FakeUnitOfWork()
+        msbus = FakeMessageBus(uow)
+        msbus.handle(commands.CreateBatch("b1", "COMPLICATED-LAMP", 100, None))
+        msbus.handle(commands.CreateBatch("b2", "TASTELESS-RUG", 100, None))
+        product = uow.products.get("COMPLICATED-LAMP")
+        commits, loads = [], []
+        uow.commit = lambda: commits.append(True)
+        original_get_many = uow.products.get_many
+        uow.products.get_many = lambda skus: loads.append(sorted(skus)) or original_get_many(skus)
+
+        msbus.handle(commands.AllocateMany(
+            tuple(commands.Allocate(f"o{i}", "COMPLICATED-LAMP", 1) for i in range(10))
+            + (commands.Allocate("o10", "TASTELESS-RUG", 1),)
+        ))
+
+        assert loads == [["COMPLICATED-LAMP", "TASTELESS-RUG"]]
+        assert len(commits) == 1
+        assert product.available_quantity == 90
+
+    def test_emits_the_same_events_as_single_allocations(self):
+        lines = (
+            commands.Allocate("o1", "POPULAR-CURTAINS", 6),
+            commands.Allocate("o2", "OMINOUS-MIRROR", 3),
+            commands.Allocate("o3", "POPULAR-CURTAINS", 6),
+        )
+        single_bus, bulk_bus = FakeMessageBus(FakeUnitOfWork()), FakeMessageBus(FakeUnitOfWork())
+        for bus in single_bus, bulk_bus:
+            bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+            bus.handle(commands.CreateBatch("b2", "OMINOUS-MIRROR", 9, None))
+
+        for line in lines:
+            single_bus.handle(line)
+        bulk_bus.handle(commands.AllocateMany(lines))
+
+        assert sorted(map(repr, bulk_bus.messages_published)) == sorted(map(repr, single_bus.messages_published))
+        assert bulk_bus.fake_notifs.sent == single_bus.fake_notifs.sent
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         uow = FakeUnitOfWork()
@@ -260,3 +338,75 @@ def test_deallocating_for_a_orderid_clear_all_orderlines():
     assert product.available_quantity == 200
 
 '''
+
+
+class TestMessageBus:
+    def test_reallocation_cascade_is_handled_in_order(self):
+        uow = FakeUnitOfWork()
+        handled = []
+        bus = messagebus.MessageBus(
+            uow=uow,
+            event_handlers={
+                events.Allocated: [handled.append],
+                events.Deallocated: [handled.append, lambda e: handlers.reallocate(e, uow)],
+                events.OutOfStock: [handled.append],
+            },
+            command_handlers={
+                commands.Allocate: lambda c: handlers.allocate(c, uow),
+                commands.CreateBatch: lambda c: handlers.add_batch(c, uow),
+                commands.ChangeBatchQuantity: lambda c: handlers.change_batch_quantity(c, uow),
+            },
+        )
+        bus.handle(commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None))
+        bus.handle(commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()))
+        for i in range(5):
+            bus.handle(commands.Allocate(f"order{i}", "INDIFFERENT-TABLE", 10))
+        handled.clear()
+
+        bus.handle(commands.ChangeBatchQuantity("batch1", 25))
+
+        assert [type(e) for e in handled] == [events.Deallocated] * 3 + [events.Allocated] * 3
+        assert [e.batchref for e in handled[3:]] == ["batch2"] * 3
+        [batch1, batch2] = uow.products.get(sku="INDIFFERENT-TABLE").batches
+        assert batch1.available_quantity == 5
+        assert batch2.available_quantity == 20
+
+    @staticmethod
+    def bus_with_conflicts(conflicts_before_success, max_attempts=3):
+        uow = FakeUnitOfWork()
+        attempts = []
+
+        def allocate_after_conflicts(command):
+            attempts.append(command)
+            if len(attempts) <= conflicts_before_success:
+                raise unit_of_work.ConcurrencyConflict("version_id_col changed")
+            return handlers.allocate(command, uow)
+
+        bus = messagebus.MessageBus(
+            uow=uow,
+            event_handlers={events.Allocated: [], events.OutOfStock: []},
+            command_handlers={
+                commands.Allocate: allocate_after_conflicts,
+                commands.CreateBatch: lambda c: handlers.add_batch(c, uow),
+            },
+            conflicts=RetryPolicy(max_attempts=max_attempts, base_delay=0, jitter=0),
+        )
+        bus.handle(commands.CreateBatch("batch1", "HOT-SKU", 50, None))
+        return bus, uow, attempts
+
+    def test_command_is_run_again_after_a_concurrency_conflict(self):
+        bus, uow, attempts = self.bus_with_conflicts(conflicts_before_success=2)
+
+        bus.handle(commands.Allocate("order1", "HOT-SKU", 10))
+
+        assert len(attempts) == 3
+        assert uow.products.get(sku="HOT-SKU").available_quantity == 40
+
+    def test_conflict_reaches_the_caller_once_attempts_run_out(self):
+        bus, uow, attempts = self.bus_with_conflicts(conflicts_before_success=5)
+
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            bus.handle(commands.Allocate("order1", "HOT-SKU", 10))
+
+        assert len(attempts) == 3
+        assert uow.products.get(sku="HOT-SKU").available_quantity == 50
@@ -0,0 +1,25 @@
+import dataclasses
+import pickle
+
+import pytest
+
+from src.allocation.domain import commands, events
+
+
+@pytest.mark.parametrize("message", [
+    events.Deallocated("o1", "RED-CHAIR", 1),
+    commands.Allocate("o1", "RED-CHAIR", 1),
+])
+def test_messages_are_slotted_values(message):
+    assert not hasattr(message, "__dict__")
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        message.sku = "BLUE-LAMP"
+    # what the publishers, the outbox and the shards do with them
+    assert type(message)(**dataclasses.asdict(message)) == message
+    assert pickle.loads(pickle.dumps(message)) == message
+
+
+def test_reallocate_builds_an_allocate_from_a_deallocated():
+    event = events.Deallocated("o1", "RED-CHAIR", 1)
+
+    assert commands.Allocate(**dataclasses.asdict(event)) == commands.Allocate("o1", "RED-CHAIR", 1)
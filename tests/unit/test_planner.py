@@ -0,0 +1,70 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from src.allocation.domain import model
+from src.allocation.domain.planner import plan_allocations
+
+today = date.today()
+
+
+def make_product(batches, allocations=()):
+    product = model.Product("LAMP", [model.Batch(ref, "LAMP", qty, eta) for ref, qty, eta in batches])
+    for line in allocations:
+        product.allocate(line)
+    return product
+
+
+def allocated_one_by_one(batches, allocations, lines):
+    product = make_product(batches, allocations)
+    return [product.allocate(line) for line in lines]
+
+
+def assert_same_as_the_model(batches, lines, allocations=()):
+    product = make_product(batches, allocations)
+    before = (product.version_id_col, product.available_quantity, len(product.messages))
+
+    assert plan_allocations(product, lines) == allocated_one_by_one(batches, allocations, lines)
+    assert (product.version_id_col, product.available_quantity, len(product.messages)) == before
+
+
+def test_prefers_warehouse_stock_then_earliest_eta():
+    batches = [("shipment-2", 10, today + timedelta(days=2)), ("warehouse", 5, None),
+               ("shipment-1", 10, today + timedelta(days=1))]
+    lines = [model.OrderLine(f"o{n}", "LAMP", 4) for n in range(7)]
+
+    assert plan_allocations(make_product(batches), lines) == [
+        "warehouse", "shipment-1", "shipment-1", "shipment-2", "shipment-2", None, None
+    ]
+
+
+def test_smaller_lines_still_fit_where_a_bigger_one_did_not():
+    batches = [("warehouse", 10, None), ("shipment", 100, today)]
+    lines = [model.OrderLine("o1", "LAMP", 8), model.OrderLine("o2", "LAMP", 5),
+             model.OrderLine("o3", "LAMP", 2), model.OrderLine("o4", "LAMP", 1)]
+
+    assert plan_allocations(make_product(batches), lines) == ["warehouse", "shipment", "warehouse", "shipment"]
+
+
+def test_other_skus_and_repeated_lines_behave_like_the_model():
+    batches = [("warehouse", 10, None), ("shipment", 10, today)]
+    line = model.OrderLine("o1", "LAMP", 6)
+    lines = [line, model.OrderLine("o2", "CHAIR", 1), line, line, model.OrderLine("o3", "LAMP", 4)]
+
+    assert_same_as_the_model(batches, lines, allocations=[model.OrderLine("o0", "LAMP", 3)])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_plans_match_allocating_one_line_at_a_time(seed):
+    rng = random.Random(seed)
+    batches = [
+        (f"batch-{n}", rng.randint(0, 60), rng.choice([None, today + timedelta(days=rng.randint(0, 5))]))
+        for n in range(rng.randint(0, 8))
+    ]
+    orders = [model.OrderLine(f"order-{n}", rng.choice(["LAMP", "LAMP", "LAMP", "CHAIR"]), rng.randint(1, 15))
+              for n in range(rng.randint(0, 80))]
+    allocations = [line for line in orders[:10] if line.sku == "LAMP"]
+    lines = [rng.choice(orders) if rng.random() < 0.1 else line for line in orders[10:]]
+
+    assert_same_as_the_model(batches, lines, allocations)
@@ -88,3 +88,108 @@ def test_increments_version_number():
     product.version_id_col = 7
     product.allocate(line)
     assert product.version_id_col == 8
+
+
+def test_changing_a_batch_quantity_increments_version_number():
+    # so it conflicts with an allocation of the same product committed concurrently
+    product = Product(sku="SCANDI-PEN", batches=[Batch("b1", "SCANDI-PEN", 100, eta=None)])
+    product.version_id_col = 7
+    product.change_batch_quantity("b1", 50)
+    assert product.version_id_col == 8
+
+
+def test_add_stock_keeps_batches_in_eta_order():
+    later_batch = Batch("slow-batch", "MINIMALIST-SPOON", 100, eta=later)
+    product = Product(sku="MINIMALIST-SPOON", batches=[later_batch])
+
+    product.add_stock(Batch("normal-batch", "MINIMALIST-SPOON", 100, eta=tomorrow))
+    product.add_stock(Batch("in-stock-batch", "MINIMALIST-SPOON", 100, eta=None))
+    product.add_stock(Batch("speedy-batch", "MINIMALIST-SPOON", 100, eta=today))
+
+    assert [b.reference for b in product.batches_by_eta] == [
+        "in-stock-batch", "speedy-batch", "normal-batch", "slow-batch"
+    ]
+
+
+def test_batches_with_same_eta_are_ordered_by_reference():
+    product = Product(sku="RETRO-CLOCK", batches=[
+        Batch("batch-b", "RETRO-CLOCK", 100, eta=today),
+        Batch("batch-a", "RETRO-CLOCK", 100, eta=today),
+    ])
+    product.add_stock(Batch("batch-0", "RETRO-CLOCK", 100, eta=today))
+
+    assert product.allocate(OrderLine("oref", "RETRO-CLOCK", 10)) == "batch-0"
+    assert [b.reference for b in product.batches_by_eta] == ["batch-0", "batch-a", "batch-b"]
+
+
+def test_allocates_to_later_batch_when_earlier_is_full():
+    earliest = Batch("speedy-batch", "MINIMALIST-SPOON", 5, eta=today)
+    product = Product(sku="MINIMALIST-SPOON", batches=[earliest])
+    product.add_stock(Batch("normal-batch", "MINIMALIST-SPOON", 100, eta=tomorrow))
+
+    assert product.allocate(OrderLine("order1", "MINIMALIST-SPOON", 10)) == "normal-batch"
+    assert earliest.available_quantity == 5
+
+
+def test_allocations_for_order_returns_lines_and_batchrefs():
+    in_stock_batch = Batch("in-stock-batch", "RETRO-CLOCK", 10, eta=None)
+    shipment_batch = Batch("shipment-batch", "RETRO-CLOCK", 100, eta=tomorrow)
+    product = Product(sku="RETRO-CLOCK", batches=[in_stock_batch, shipment_batch])
+    small_line = OrderLine("oref", "RETRO-CLOCK", 5)
+    big_line = OrderLine("oref", "RETRO-CLOCK", 20)
+
+    product.allocate(small_line)
+    product.allocate(big_line)
+    product.allocate(OrderLine("other-oref", "RETRO-CLOCK", 1))
+
+    assert product.allocations_for_order("oref") == {
+        small_line: {"in-stock-batch"},
+        big_line: {"shipment-batch"},
+    }
+    assert product.allocations_for_order("unknown-oref") == {}
+
+
+def test_order_index_follows_change_batch_quantity():
+    batch = Batch("batch1", "INDIFFERENT-TABLE", 50, eta=None)
+    product = Product(sku="INDIFFERENT-TABLE", batches=[batch])
+    line = OrderLine("order1", "INDIFFERENT-TABLE", 20)
+    product.allocate(line)
+    assert product.is_allocated_for_order("order1")
+    assert batch.is_allocated_for_order("order1")
+
+    product.change_batch_quantity("batch1", 10)
+
+    assert product.is_allocated_for_line(line) is False
+    assert product.is_allocated_for_order("order1") is False
+    assert batch.is_allocated_for_order("order1") is False
+    assert product.allocations_for_order("order1") == {}
+
+
+def test_order_index_includes_allocations_of_added_stock():
+    batch, line = create_sample_batch_and_line("ANGULAR-DESK", 20, 2)
+    batch.allocate(line)
+    product = Product("ANGULAR-DESK")
+    assert product.is_allocated_for_order(line.orderid) is False
+
+    product.add_stock(batch)
+
+    assert product.allocations_for_order(line.orderid) == {line: {batch.reference}}
+
+
+def test_a_line_allocated_to_two_batches_stays_indexed_until_both_let_it_go():
+    warehouse = Batch("warehouse", "SCANDI-PEN", 10, eta=None)
+    shipment = Batch("shipment", "SCANDI-PEN", 100, eta=tomorrow)
+    product = Product(sku="SCANDI-PEN", batches=[warehouse, shipment])
+    line = OrderLine("order1", "SCANDI-PEN", 6)
+
+    assert product.allocate(line) == "warehouse"
+    assert product.allocate(line) == "shipment"  # the warehouse has 4 left
+    assert product.allocations_for_order("order1") == {line: {"warehouse", "shipment"}}
+
+    product.change_batch_quantity("shipment", 0)
+    assert product.is_allocated_for_line(line)
+    assert product.allocations_for_order("order1") == {line: {"warehouse"}}
+
+    product.change_batch_quantity("warehouse", 0)
+    assert product.is_allocated_for_line(line) is False
+    assert product.is_allocated_for_order("order1") is False
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+import redis
+
+from src.allocation.adapters.metrics import metrics
+from src.allocation.adapters.redis_eventpublisher import BatchingPublisher
+from src.allocation.domain import events
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def publish(self, channel, payload):
+        self.commands.append((channel, payload))
+
+    def execute(self):
+        if self.client.down:
+            raise redis.ConnectionError("redis is down")
+        self.client.round_trips.append(self.commands)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.round_trips = []
+        self.down = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+def test_publisher_buffers_until_the_batch_is_full():
+    client = FakeRedis()
+    publisher = BatchingPublisher(client, max_batch_size=3, max_delay=60)
+
+    for i in range(7):
+        publisher.publish("line_allocated", events.Allocated(f"o{i}", "RED-CHAIR", 1, "b1"))
+
+    assert [len(batch) for batch in client.round_trips] == [3, 3]
+    assert len(publisher) == 1
+    channel, payload = client.round_trips[0][0]
+    assert channel == "line_allocated"
+    assert json.loads(payload) == dict(orderid="o0", sku="RED-CHAIR", qty=1, batchref="b1")
+
+
+def test_publisher_flushes_by_time_and_on_demand():
+    client = FakeRedis()
+    publisher = BatchingPublisher(client, max_batch_size=100, max_delay=0)
+
+    publisher.publish("line_allocated", '{"orderid": "o1"}')
+    assert client.round_trips == [[("line_allocated", '{"orderid": "o1"}')]]
+
+    publisher.max_delay = 60
+    publisher.publish("line_allocated", '{"orderid": "o2"}')
+    publisher.flush()
+    publisher.flush()
+    assert len(client.round_trips) == 2
+
+
+def test_publisher_records_batch_metrics():
+    metrics.reset()
+    publisher = BatchingPublisher(FakeRedis(), max_batch_size=2, max_delay=60)
+
+    for i in range(4):
+        publisher.publish("line_allocated", "{}")
+
+    summaries = metrics.snapshot()["summaries"]
+    assert summaries["redis_publish_batch_size"]["count"] == 2
+    assert summaries["redis_publish_batch_size"]["mean"] == 2
+    assert summaries["redis_publish_flush_seconds"]["count"] == 2
+
+
+def test_a_failed_batch_is_dropped_for_its_senders_to_resend():
+    client = FakeRedis()
+    publisher = BatchingPublisher(client, max_batch_size=100, max_delay=60)
+    publisher.publish("line_allocated", '{"orderid": "o1"}')
+
+    client.down = True
+    with pytest.raises(redis.ConnectionError):
+        publisher.flush()
+    client.down = False
+    publisher.publish("line_allocated", '{"orderid": "o1"}')
+    publisher.flush()
+
+    assert client.round_trips == [[("line_allocated", '{"orderid": "o1"}')]]
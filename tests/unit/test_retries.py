@@ -0,0 +1,121 @@
+import time
+
+from src.allocation import bootstrap
+from src.allocation.adapters.retry_store import InMemoryRetryStore
+from src.allocation.domain import events, commands
+from src.allocation.service_layer import handlers, messagebus
+from src.allocation.service_layer.retries import RetryScheduler, RetryPolicy
+from tests.unit.test_handlers import FakeUnitOfWork, FakeNotifications
+
+FAR_FUTURE = time.time() + 10_000
+
+
+class FlakyHandler:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.handled = []
+
+    def __call__(self, event):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("redis is down")
+        self.handled.append(event)
+
+
+def build_bus(uow, flaky, max_attempts=3):
+    def flaky_publish(event):
+        flaky(event)
+
+    def reallocate(event):
+        handlers.reallocate(event, uow)
+
+    scheduler = RetryScheduler(InMemoryRetryStore(), RetryPolicy(max_attempts=max_attempts))
+    bus = messagebus.MessageBus(
+        uow=uow,
+        event_handlers={
+            events.Allocated: [flaky_publish],
+            events.Deallocated: [reallocate],
+            events.OutOfStock: [],
+        },
+        command_handlers={
+            commands.Allocate: lambda c: handlers.allocate(c, uow),
+            commands.CreateBatch: lambda c: handlers.add_batch(c, uow),
+        },
+        retries=scheduler,
+    )
+    return bus, scheduler
+
+
+def test_failed_event_handler_is_scheduled_instead_of_retried_inline():
+    flaky = FlakyHandler(failures=1)
+    bus, scheduler = build_bus(FakeUnitOfWork(), flaky)
+    bus.handle(commands.CreateBatch("b1", "COMPLICATED-LAMP", 100, None))
+
+    start = time.perf_counter()
+    bus.handle(commands.Allocate("o1", "COMPLICATED-LAMP", 10))
+
+    assert time.perf_counter() - start < 0.5
+    assert flaky.handled == []
+    assert len(scheduler.store) == 1
+
+
+def test_scheduled_retry_runs_the_handler_again_once_due():
+    flaky = FlakyHandler(failures=1)
+    bus, scheduler = build_bus(FakeUnitOfWork(), flaky)
+    bus.handle(commands.CreateBatch("b1", "COMPLICATED-LAMP", 100, None))
+    bus.handle(commands.Allocate("o1", "COMPLICATED-LAMP", 10))
+
+    assert scheduler.run_pending(now=time.time()) == 0
+    assert scheduler.run_pending(now=FAR_FUTURE) == 1
+
+    assert flaky.handled == [events.Allocated("o1", "COMPLICATED-LAMP", 10, "b1")]
+    assert len(scheduler.store) == 0
+
+
+def test_retried_handler_messages_are_handled():
+    uow = FakeUnitOfWork()
+    flaky = FlakyHandler(failures=0)
+    bus, scheduler = build_bus(uow, flaky)
+    bus.handle(commands.CreateBatch("b1", "COMPLICATED-LAMP", 100, None))
+    scheduler.schedule(events.Deallocated("o1", "COMPLICATED-LAMP", 10), "reallocate", attempt=1, error="")
+
+    scheduler.run_pending(now=FAR_FUTURE)
+
+    assert flaky.handled == [events.Allocated("o1", "COMPLICATED-LAMP", 10, "b1")]
+
+
+def test_handler_is_dead_lettered_after_max_attempts():
+    flaky = FlakyHandler(failures=10)
+    bus, scheduler = build_bus(FakeUnitOfWork(), flaky, max_attempts=3)
+    bus.handle(commands.CreateBatch("b1", "COMPLICATED-LAMP", 100, None))
+    bus.handle(commands.Allocate("o1", "COMPLICATED-LAMP", 10))
+
+    scheduler.run_pending(now=FAR_FUTURE)
+    scheduler.run_pending(now=FAR_FUTURE)
+
+    [dead] = scheduler.store.dead_letters
+    assert dead.handler == "flaky_publish"
+    assert dead.attempt == 3
+    assert "redis is down" in dead.error
+    assert len(scheduler.store) == 0
+
+
+def test_backoff_grows_exponentially_with_bounded_jitter():
+    policy = RetryPolicy(base_delay=1, max_delay=10, jitter=0.5)
+
+    for attempt, expected in [(1, 1), (2, 2), (3, 4), (4, 8), (5, 10), (9, 10)]:
+        delay = policy.delay(attempt)
+        assert expected <= delay <= expected * 1.5
+
+
+def test_buses_in_a_process_share_one_scheduler(monkeypatch):
+    monkeypatch.setattr(bootstrap, "_retries", None)
+    buses = [
+        bootstrap.bootstrap(start_orm=False, uow=FakeUnitOfWork(), notifications=FakeNotifications())
+        for _ in range(3)
+    ]
+    try:
+        assert all(bus.retries is buses[0].retries for bus in buses)
+        assert buses[0].retries.dispatch == buses[0].handle_retry
+    finally:
+        buses[0].retries.stop()
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from concurrent import futures
+from multiprocessing.connection import Listener
+
+import pytest
+
+from src.allocation import bootstrap
+from src.allocation.domain import commands
+from src.allocation.service_layer import handlers
+from src.allocation.service_layer.shards import ShardedMessageBus, ShardRouterClient, serve_router, _route
+
+
+def fake_bus():
+    # what a shard's bus would answer, plus which process answered it
+    def handle(command):
+        if isinstance(command, commands.AllocateMany):
+            return [[dict(orderid=line.orderid, sku=line.sku, pid=os.getpid()) for line in command.lines]]
+        sku = getattr(command, "sku", getattr(command, "ref", None))
+        if sku == "NOPE":
+            raise handlers.InvalidSku(f"Invalid sku {sku}")
+        if sku == "SLOW":
+            time.sleep(0.3)
+        return [(sku, os.getpid())]
+    return handle
+
+
+@pytest.fixture(scope="module")
+def bus():
+    # spawning the shards takes a while, so the tests share them
+    bus = ShardedMessageBus(fake_bus, shards=3, sku_for_batchref={"lamp-batch": "LAMP"}.get)
+    yield bus
+    bus.shutdown(wait=True)
+
+
+def owner(bus, sku):
+    [(_, pid)] = bus.handle(commands.Allocate("o1", sku, 1))
+    return pid
+
+
+def test_every_sku_has_a_single_owner_and_skus_are_spread(bus):
+    skus = [f"SKU-{n}" for n in range(12)]
+    owners = {sku: owner(bus, sku) for sku in skus}
+
+    assert all(owner(bus, sku) == owners[sku] for sku in skus)
+    assert len(set(owners.values())) == 3
+
+
+def test_batch_quantity_changes_go_to_the_owner_of_the_batch_sku(bus):
+    [(_, pid)] = bus.handle(commands.ChangeBatchQuantity("lamp-batch", 10))
+
+    assert pid == owner(bus, "LAMP")
+
+
+def test_allocate_many_is_split_by_owner_and_keeps_the_lines_order(bus):
+    lines = tuple(commands.Allocate(f"o{n}", f"SKU-{n % 5}", 1) for n in range(20))
+
+    [outcomes] = bus.handle(commands.AllocateMany(lines))
+
+    assert [o["orderid"] for o in outcomes] == [line.orderid for line in lines]
+    assert all(o["pid"] == owner(bus, o["sku"]) for o in outcomes)
+
+
+def test_errors_are_raised_in_the_caller(bus):
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku NOPE"):
+        bus.handle(commands.Allocate("o1", "NOPE", 1))
+
+    assert bus.handle(commands.Allocate("o1", "LAMP", 1))
+
+
+def test_a_command_that_times_out_is_forgotten(bus, monkeypatch):
+    monkeypatch.setattr(bus, "timeout", 0.05)
+
+    with pytest.raises(futures.TimeoutError):
+        bus.handle(commands.Allocate("o1", "SLOW", 1))
+
+    assert bus._pending == {}
+    time.sleep(0.3)  # its late result is dropped, the next ones still get theirs
+    monkeypatch.setattr(bus, "timeout", 30)
+    assert bus.handle(commands.Allocate("o1", "SLOW", 1))
+
+
+def test_the_api_and_the_consumers_go_through_a_single_router(bus):
+    listener = Listener(("localhost", 0), authkey=b"test")
+    threading.Thread(target=serve_router, args=(bus, listener), daemon=True).start()
+    api, consumer = (ShardRouterClient(listener.address, b"test") for _ in range(2))
+
+    [(_, from_api)] = api.handle(commands.Allocate("o1", "LAMP", 1))
+    [(_, from_consumer)] = consumer.handle(commands.ChangeBatchQuantity("lamp-batch", 10))
+    with pytest.raises(handlers.InvalidSku):
+        api.handle(commands.Allocate("o1", "NOPE", 1))
+    listener.close()
+
+    assert from_api == from_consumer == owner(bus, "LAMP")
+
+
+def test_a_client_that_went_away_only_ends_its_own_connection(bus):
+    class GoneClient:
+        def __init__(self):
+            self.messages = [("handle", commands.Allocate("o1", "LAMP", 1))]
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def recv(self):
+            return self.messages.pop()
+
+        def send(self, reply):
+            raise BrokenPipeError()
+
+    _route(bus, GoneClient())  # returns instead of raising
+
+
+def test_the_router_and_its_clients_need_an_authkey(monkeypatch):
+    monkeypatch.delenv("SHARD_ROUTER_AUTHKEY", raising=False)
+
+    with pytest.raises(ValueError, match="SHARD_ROUTER_AUTHKEY"):
+        bootstrap.shard_router_client()
+
+
+def test_shards_refuse_a_per_process_views_cache(monkeypatch):
+    monkeypatch.setenv("VIEWS_CACHE", "memory")
+
+    with pytest.raises(ValueError, match="VIEWS_CACHE"):
+        bootstrap.bootstrap_sharded(shards=2)
@@ -0,0 +1,145 @@
+import json
+from collections import defaultdict
+
+import redis
+
+from src.allocation.domain import commands
+from src.allocation.entrypoints.redis_streamconsumer import StreamConsumer
+
+
+class FakeStreams:
+    # just enough of the redis streams commands for one consumer group
+    def __init__(self):
+        self.entries = defaultdict(list)
+        self.groups = {}
+        self.pending = defaultdict(dict)  # stream -> entry id -> times delivered
+        self.next_id = 0
+
+    def xadd(self, stream, fields, **kwargs):
+        self.next_id += 1
+        entry_id = f"{self.next_id}-0".encode()
+        self.entries[stream].append((entry_id, {k.encode() if isinstance(k, str) else k: v for k, v in fields.items()}))
+        return entry_id
+
+    def xgroup_create(self, stream, group, id="0", mkstream=False):
+        if stream in self.groups:
+            raise redis.ResponseError("BUSYGROUP Consumer Group name already exists")
+        self.groups[stream] = 0
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        response = []
+        for stream in streams:
+            new = self.entries[stream][self.groups[stream]:][:count]
+            self.groups[stream] += len(new)
+            for entry_id, _ in new:
+                self.pending[stream][entry_id] = 1
+            if new:
+                response.append([stream.encode(), new])
+        return response
+
+    def xack(self, stream, group, *ids):
+        for entry_id in ids:
+            self.pending[stream].pop(entry_id, None)
+
+    def xpending_range(self, stream, group, min, max, count, idle=None):
+        return [dict(message_id=entry_id, times_delivered=times) for entry_id, times in self.pending[stream].items()]
+
+    def xrange(self, stream, min, max):
+        return [entry for entry in self.entries[stream] if min <= entry[0] <= max]
+
+    def xautoclaim(self, stream, group, consumer, min_idle_time, count=None):
+        for entry_id in self.pending[stream]:
+            self.pending[stream][entry_id] += 1
+        return [b"0-0", [entry for entry in self.entries[stream] if entry[0] in self.pending[stream]], []]
+
+
+def allocate_line(client, orderid):
+    client.xadd("allocate_line", {"data": json.dumps(dict(orderid=orderid, sku="RED-CHAIR", qty=1))})
+
+
+def consumer_for(client, handle, **kwargs):
+    consumer = StreamConsumer(client, handle, group="allocation", name="test", claim_idle_ms=0, **kwargs)
+    consumer.create_groups()
+    return consumer
+
+
+def test_handles_new_entries_in_batches_and_acks_them():
+    client = FakeStreams()
+    handled = []
+    consumer = consumer_for(client, handled.append, batch_size=2)
+    for orderid in ("o1", "o2", "o3"):
+        allocate_line(client, orderid)
+
+    assert consumer.read_once() == 2
+    assert consumer.read_once() == 1
+    assert consumer.read_once() == 0
+
+    assert handled == [commands.Allocate(orderid, "RED-CHAIR", 1) for orderid in ("o1", "o2", "o3")]
+    assert client.pending["allocate_line"] == {}
+    consumer.create_groups()  # the group already existing is fine
+
+
+def test_failed_entries_stay_pending_and_are_reclaimed():
+    client = FakeStreams()
+    handled = []
+
+    def handle_after_first_failure(cmd):
+        if not handled:
+            handled.append("failed")
+            raise ValueError("db is down")
+        handled.append(cmd.orderid)
+
+    consumer = consumer_for(client, handle_after_first_failure)
+    allocate_line(client, "o1")
+
+    assert consumer.read_once() == 0
+    assert list(client.pending["allocate_line"]) == [b"1-0"]
+
+    assert consumer.reclaim() == 1
+    assert handled == ["failed", "o1"]
+    assert client.pending["allocate_line"] == {}
+
+
+def test_entries_that_keep_failing_go_to_the_dead_stream():
+    client = FakeStreams()
+
+    def always_fail(cmd):
+        raise ValueError("poison")
+
+    consumer = consumer_for(client, always_fail, max_deliveries=3)
+    allocate_line(client, "o1")
+
+    consumer.read_once()
+    for _ in range(3):
+        consumer.reclaim()
+
+    assert client.pending["allocate_line"] == {}
+    [(_, fields)] = client.entries["allocate_line:dead"]
+    assert json.loads(fields[b"data"])["orderid"] == "o1"
+
+
+def test_entries_that_dont_decode_go_to_the_dead_stream_right_away():
+    client = FakeStreams()
+    handled = []
+    consumer = consumer_for(client, handled.append)
+    client.xadd("allocate_line", {"data": b'{"orderid": "o1"}'})
+    allocate_line(client, "o2")
+
+    assert consumer.read_once() == 2
+
+    assert handled == [commands.Allocate("o2", "RED-CHAIR", 1)]
+    assert client.pending["allocate_line"] == {}
+    [(_, fields)] = client.entries["allocate_line:dead"]
+    assert fields[b"data"] == b'{"orderid": "o1"}'
+
+
+def test_polling_reclaims_only_every_reclaim_interval():
+    client = FakeStreams()
+    reclaims = []
+    consumer = consumer_for(client, lambda cmd: None, reclaim_interval_ms=10_000)
+    consumer.reclaim = lambda: reclaims.append(1) or 0
+
+    for now in (100.0, 105.0, 109.9, 110.0, 115.0):
+        consumer.poll(now)
+
+    assert len(reclaims) == 2
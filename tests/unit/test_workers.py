@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import defaultdict
+
+from src.allocation.service_layer.workers import PartitionedWorkerPool
+
+
+def test_keeps_order_per_key_and_finishes_in_flight_work_on_shutdown():
+    handled = defaultdict(list)
+    threads = defaultdict(set)
+
+    def handler_factory():
+        def handle(message):
+            key, n = message
+            time.sleep(0.001)
+            handled[key].append(n)
+            threads[key].add(threading.current_thread().name)
+        return handle
+
+    pool = PartitionedWorkerPool(handler_factory, workers=3)
+    for n in range(20):
+        for key in ("RED-CHAIR", "BLUE-LAMP", "GREEN-SOFA", "TASTELESS-RUG"):
+            pool.submit(key, (key, n))
+    pool.shutdown(wait=True)
+
+    assert all(numbers == list(range(20)) for numbers in handled.values())
+    assert len(handled) == 4
+    assert all(len(names) == 1 for names in threads.values())
+
+
+def test_a_failing_message_does_not_stop_its_worker():
+    handled = []
+
+    def handle(message):
+        if message == "boom":
+            raise ValueError(message)
+        handled.append(message)
+
+    pool = PartitionedWorkerPool(lambda: handle, workers=1)
+    for message in ("a", "boom", "b"):
+        pool.submit("RED-CHAIR", message)
+    pool.shutdown(wait=True)
+
+    assert handled == ["a", "b"]
+
+
+def test_each_worker_builds_its_own_handler():
+    built = []
+
+    def handler_factory():
+        built.append(threading.current_thread().name)
+        return lambda message: None
+
+    PartitionedWorkerPool(handler_factory, workers=4).shutdown(wait=True)
+
+    assert sorted(built) == ["worker-0", "worker-1", "worker-2", "worker-3"]